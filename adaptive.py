@@ -0,0 +1,111 @@
+"""
+Adaptive load control. The controller watches the processing time of the camera loop and steps through
+load levels, each cheaper than the one before, to hold a target FPS. It steps back down once there is
+spare time again.
+"""
+import collections
+
+# skip_unchanged_render - Skip the render stage of frames whose projection did not change
+# bg_scale - Image scale of the background subtraction
+# aruco_scale - Image scale of the AruCo marker detection
+# marker_interval - Detect the markers every marker_interval frames while they are tracked
+LoadLevel = collections.namedtuple('LoadLevel', ['skip_unchanged_render', 'bg_scale', 'aruco_scale',
+                                                 'marker_interval'])
+
+DEFAULT_LEVELS = [LoadLevel(False, 1.0, 1.0, 1),
+                  LoadLevel(True, 1.0, 1.0, 1),
+                  LoadLevel(True, 0.5, 1.0, 1),
+                  LoadLevel(True, 0.5, 0.5, 1),
+                  LoadLevel(True, 0.5, 0.5, 2)]
+
+# frame_num - Manager.frame_num when the level changed
+# old_level, new_level - Level indices
+# loop_ms - Smoothed processing time per frame which caused the change
+LevelChange = collections.namedtuple('LevelChange', ['frame_num', 'old_level', 'new_level', 'loop_ms'])
+
+
+class AdaptiveController(object):
+    def __init__(self, target_fps=30.0, levels=DEFAULT_LEVELS, enabled=True, alpha=0.1, low_ratio=0.6,
+                 hold_frames=30, max_changes=100):
+        """
+
+        :param target_fps: Frame rate to hold
+        :param levels: List of LoadLevel, from the most accurate to the cheapest
+        :param enabled: If False, the level stays 0
+        :param alpha: Smoothing factor of the processing time
+        :param low_ratio: Step down a level when the processing time is below low_ratio of the frame budget
+        :param hold_frames: Number of consecutive frames over (or under) the budget before the level changes
+        :param max_changes: Number of level changes kept in changes
+        """
+        self.target_fps = target_fps
+        self.levels = list(levels)
+        self.enabled = enabled
+        self.alpha = alpha
+        self.low_ratio = low_ratio
+        self.hold_frames = hold_frames
+        self.level_ind = 0
+        self.loop_sec = None  # Smoothed processing time per frame
+        self.changes = collections.deque(maxlen=max_changes)  # Recent LevelChange
+        self.frames_per_level = [0] * len(self.levels)
+        self._num_over = 0
+        self._num_under = 0
+
+    @property
+    def level(self):
+        """ :return: LoadLevel to use """
+        return self.levels[self.level_ind]
+
+    def reset(self):
+        self.level_ind = 0
+        self.loop_sec = None
+        self.changes.clear()
+        self.frames_per_level = [0] * len(self.levels)
+        self._num_over = 0
+        self._num_under = 0
+
+    def update(self, loop_sec, frame_num=None):
+        """ Add the processing time of a frame, and change the level if needed.
+
+        :param loop_sec: Processing time of the frame in seconds, without the time spent waiting for the camera
+        :param frame_num: Frame number, for the changes log
+        :return: True if the level changed
+        """
+        self.frames_per_level[self.level_ind] += 1
+        if self.loop_sec is None:
+            self.loop_sec = loop_sec
+        else:
+            self.loop_sec += self.alpha * (loop_sec - self.loop_sec)
+        if not self.enabled:
+            return False
+
+        budget = 1.0 / self.target_fps
+        self._num_over = self._num_over + 1 if self.loop_sec > budget else 0
+        self._num_under = self._num_under + 1 if self.loop_sec < self.low_ratio * budget else 0
+        if self._num_over >= self.hold_frames and self.level_ind < len(self.levels) - 1:
+            return self._set_level(self.level_ind + 1, frame_num)
+        if self._num_under >= self.hold_frames and self.level_ind > 0:
+            return self._set_level(self.level_ind - 1, frame_num)
+        return False
+
+    def _set_level(self, level_ind, frame_num):
+        self.changes.append(LevelChange(frame_num, self.level_ind, level_ind, 1000.0 * self.loop_sec))
+        self.level_ind = level_ind
+        self._num_over = 0
+        self._num_under = 0
+        return True
+
+    def as_dict(self):
+        """ :return: dictionary with the current decisions, for monitoring """
+        d = {'enabled': self.enabled, 'target_fps': self.target_fps, 'level': self.level_ind,
+             'loop_ms': 1000.0 * self.loop_sec if self.loop_sec is not None else 0.0,
+             'frames_per_level': list(self.frames_per_level),
+             'changes': [x._asdict() for x in self.changes]}
+        d.update(self.level._asdict())
+        return d
+
+    def summary(self):
+        level = self.level
+        return ("load level %d/%d (%.1f ms, target %.1f fps) | skip render %s | bg x%.2f | aruco x%.2f | "
+                "markers every %d" % (self.level_ind, len(self.levels) - 1, 1000.0 * (self.loop_sec or 0.0),
+                                      self.target_fps, level.skip_unchanged_render, level.bg_scale,
+                                      level.aruco_scale, level.marker_interval))
@@ -0,0 +1,223 @@
+"""
+Low latency sound engine. All the notes are kept in one contiguous NumPy sample bank, and a single audio
+callback mixes the playing voices in small buffers. The bank is synthesized at startup, or loaded from the
+wav directory.
+
+Uses the sounddevice package (PortAudio) for output, which is imported only when the engine is started.
+"""
+from __future__ import print_function
+import os
+import threading
+import wave
+import numpy as np
+from notes import note_frequency
+
+
+def synthesize_bank(names, duration=1.5, sample_rate=44100, num_harmonics=6, attack_sec=0.005):
+    """ Synthesize piano like notes, vectorized over all the notes at once.
+
+    :param names: List of note names
+    :param duration: Note duration in seconds
+    :param sample_rate: Samples per second
+    :param num_harmonics: Number of harmonics of every note
+    :param attack_sec: Attack time in seconds
+    :return: (N, samples) float32 contiguous array, in the order of names
+    """
+    t = np.arange(int(duration * sample_rate), dtype=np.float32) / sample_rate
+    freqs = np.array([note_frequency(x) for x in names], np.float32)[:, np.newaxis]
+    bank = np.zeros((len(names), len(t)), np.float32)
+    for k in range(1, num_harmonics + 1):
+        # Higher harmonics are weaker and decay faster
+        amplitude = 1.0 / k ** 1.5
+        decay = np.exp(-t * (1.5 + 0.8 * k))
+        bank += amplitude * decay * np.sin(2 * np.pi * k * freqs * t)
+    attack = np.minimum(t / attack_sec, 1.0)
+    bank *= attack
+    bank /= np.abs(bank).max(axis=1, keepdims=True)
+    return np.ascontiguousarray(bank)
+
+
+def load_wav_bank(wav_directory, names, sample_rate=44100):
+    """ Load the note .wav files into one sample bank. Shorter notes are padded with silence.
+
+    :param wav_directory: Directory with <note name>.wav files
+    :param names: List of note names
+    :param sample_rate: Expected sample rate of the files
+    :return: (N, samples) float32 contiguous array, in the order of names
+    """
+    samples = []
+    for name in names:
+        w = wave.open(os.path.join(wav_directory, "%s.wav" % name), 'rb')
+        try:
+            if w.getframerate() != sample_rate or w.getsampwidth() != 2:
+                raise ValueError("%s.wav should be 16 bit at %d Hz" % (name, sample_rate))
+            data = np.frombuffer(w.readframes(w.getnframes()), np.int16).astype(np.float32) / 32768.0
+            data = data.reshape(-1, w.getnchannels()).mean(axis=1)
+        finally:
+            w.close()
+        samples.append(data)
+    bank = np.zeros((len(names), max(len(x) for x in samples)), np.float32)
+    for i, data in enumerate(samples):
+        bank[i, :len(data)] = data
+    return bank
+
+
+class SoundEngine(object):
+    def __init__(self, names, bank, sample_rate=44100, buffer_size=128, max_voices=16, release_sec=0.08,
+                 gain=0.3, max_commands=256, device=None):
+        """ Polyphonic sampler which mixes all voices in one audio callback.
+            Has play_note_sound(name) like media.Sound, so it can replace it.
+
+        :param names: Note names, in the order of the bank rows
+        :param bank: (N, samples) float32 sample bank
+        :param sample_rate: Samples per second
+        :param buffer_size: Samples per audio callback. 128 samples at 44100 Hz are 2.9 ms.
+        :param max_voices: Maximal number of notes playing at once. When all voices play, the oldest is stolen.
+        :param release_sec: Fade out time after note_off
+        :param gain: Output gain of every voice
+        :param max_commands: Size of the note on/off command queue
+        :param device: sounddevice output device, name or index. The default device if None.
+        """
+        self.names = list(names)
+        self.note_index = dict((name, i) for i, name in enumerate(self.names))
+        self.bank = np.ascontiguousarray(bank, np.float32)
+        self.sample_rate = sample_rate
+        self.buffer_size = buffer_size
+        self.max_voices = max_voices
+        self.gain = gain
+        self.device = device
+        self.stream = None
+
+        # Voices state, used only by the audio callback
+        self.voice_note = np.full(max_voices, -1, np.int32)  # Bank row of the voice, -1 if free
+        self.voice_pos = np.zeros(max_voices, np.int64)  # Next sample of the voice
+        self.voice_release_pos = np.full(max_voices, -1, np.int64)  # Position in the release curve, -1 if held
+        self.voice_age = np.zeros(max_voices, np.int64)  # Order of note on, for voice stealing
+        self._num_note_on = 0
+        # Playing voices in _active[:_num_active] and free voices in _free[:_num_free], so the callback finds them
+        # without allocating
+        self._active = np.zeros(max_voices, np.int32)
+        self._num_active = 0
+        self._free = np.arange(max_voices - 1, -1, -1, dtype=np.int32)
+        self._num_free = max_voices
+
+        # Release curve, with zeros after it so a slice never runs out
+        release_len = max(1, int(release_sec * sample_rate))
+        self.release_curve = np.zeros(release_len + buffer_size, np.float32)
+        self.release_curve[:release_len] = np.exp(-5.0 * np.arange(release_len) / release_len)
+
+        # Preallocated buffers of the callback
+        self._mix = np.zeros(buffer_size, np.float32)
+        self._tmp = np.zeros(buffer_size, np.float32)
+
+        # Commands ring written by play/stop and read by the callback: (bank row, 1 for on / 0 for off)
+        self._commands = np.zeros((max_commands, 2), np.int32)
+        self._commands_write = 0
+        self._commands_read = 0
+        self._commands_lock = threading.Lock()
+
+    def start(self):
+        import sounddevice
+        self.stream = sounddevice.OutputStream(samplerate=self.sample_rate, blocksize=self.buffer_size,
+                                               channels=1, dtype='float32', latency='low', device=self.device,
+                                               callback=self._callback)
+        self.stream.start()
+        print("Sound output latency: %.1f ms" % (1000.0 * self.stream.latency))
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.stop()
+            self.stream.close()
+            self.stream = None
+
+    def play_note_sound(self, name):
+        """ Start playing a note.
+
+        :param name: Note name, like in Piano class: "C#4", "D5", ...
+        """
+        if name == "br": return
+        self._push_command(self.note_index[name], 1)
+
+    def stop_note_sound(self, name):
+        """ Fade out all the voices playing a note """
+        if name == "br": return
+        self._push_command(self.note_index[name], 0)
+
+    def _push_command(self, note, is_on):
+        with self._commands_lock:
+            i = self._commands_write % len(self._commands)
+            self._commands[i, 0] = note
+            self._commands[i, 1] = is_on
+            self._commands_write += 1
+
+    def _handle_commands(self):
+        # Commands which were overwritten before the callback got to them are skipped
+        write = self._commands_write
+        self._commands_read = max(self._commands_read, write - len(self._commands))
+        while self._commands_read < write:
+            note, is_on = self._commands[self._commands_read % len(self._commands)]
+            self._commands_read += 1
+            if is_on:
+                self._note_on(note)
+            else:
+                self._note_off(note)
+
+    def _note_on(self, note):
+        if self._num_free > 0:
+            self._num_free -= 1
+            voice = self._free[self._num_free]
+            self._active[self._num_active] = voice
+            self._num_active += 1
+        else:
+            voice = np.argmin(self.voice_age)  # Steal the oldest voice, which stays active
+        self.voice_note[voice] = note
+        self.voice_pos[voice] = 0
+        self.voice_release_pos[voice] = -1
+        self.voice_age[voice] = self._num_note_on
+        self._num_note_on += 1
+
+    def _note_off(self, note):
+        for i in range(self._num_active):
+            voice = self._active[i]
+            if self.voice_note[voice] == note and self.voice_release_pos[voice] < 0:
+                self.voice_release_pos[voice] = 0
+
+    def _free_voice(self, i):
+        """ Free the i-th active voice. The last active voice takes its place. """
+        voice = self._active[i]
+        self.voice_note[voice] = -1
+        self._num_active -= 1
+        self._active[i] = self._active[self._num_active]
+        self._free[self._num_free] = voice
+        self._num_free += 1
+
+    def mix(self, frames):
+        """ Mix the next buffer of all the playing voices. Called by the audio callback.
+
+        :param frames: Number of samples, up to buffer_size
+        :return: View of the mixed samples
+        """
+        self._handle_commands()
+        out = self._mix[:frames]
+        out.fill(0)
+        bank_len = self.bank.shape[1]
+        # Backwards, so a freed voice is replaced by one which was already mixed
+        for i in range(self._num_active - 1, -1, -1):
+            voice = self._active[i]
+            pos = self.voice_pos[voice]
+            n = min(frames, bank_len - pos)
+            tmp = self._tmp[:n]
+            tmp[:] = self.bank[self.voice_note[voice], pos:pos + n]
+            release_pos = self.voice_release_pos[voice]
+            if release_pos >= 0:
+                tmp *= self.release_curve[release_pos:release_pos + n]
+                self.voice_release_pos[voice] = release_pos + n
+            out[:n] += tmp
+            self.voice_pos[voice] = pos + n
+            if pos + n >= bank_len or (release_pos >= 0 and release_pos + n >= len(self.release_curve) - self.buffer_size):
+                self._free_voice(i)
+        out *= self.gain
+        return out
+
+    def _callback(self, outdata, frames, time_info, status):
+        outdata[:, 0] = self.mix(frames)
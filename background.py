@@ -0,0 +1,119 @@
+"""
+Background subtraction of a region of the camera frame. The model runs only inside the region, optionally
+at a reduced scale, and the foreground mask is returned in full frame coordinates.
+
+Two models can be selected by name:
+    'mog2' - OpenCV's MOG2, robust to noise and lighting changes
+    'running_average' - running average background and a threshold on the difference from it, which is
+                        several times cheaper, for low power hosts
+"""
+import numpy as np
+import cv2
+
+
+def create_mog2():
+    return cv2.createBackgroundSubtractorMOG2(history=4, varThreshold=50.0, detectShadows=False)
+
+
+class RunningAverageModel(object):
+    def __init__(self, alpha=0.25, threshold=25):
+        """ Background which is a running average of the background pixels of the frames. Has apply() like MOG2.
+            Foreground stays foreground until it leaves, and the model restarts when the region moves.
+
+        :param alpha: Weight of a new frame in the average. 0.25 adapts like MOG2 with a history of 4 frames.
+        :param threshold: Gray level difference from the background above which a pixel is foreground
+        """
+        self.alpha = alpha
+        self.threshold = threshold
+        self.background = None
+        self._background_u8 = None
+        self._diff = None
+
+    def apply(self, img):
+        """ :param img: Gray image
+            :return: uint8 mask, 255 on foreground pixels
+        """
+        if self.background is None or self.background.shape != img.shape:
+            self.background = img.astype(np.float32)
+            return np.zeros_like(img)
+        self._background_u8 = cv2.convertScaleAbs(self.background, dst=self._background_u8)
+        self._diff = cv2.absdiff(img, self._background_u8, dst=self._diff)
+        fgmask = cv2.threshold(self._diff, self.threshold, 255, cv2.THRESH_BINARY)[1]
+        # Only the background pixels are learned, so a resting finger is not absorbed and lifting it is not a change
+        cv2.accumulateWeighted(img, self.background, self.alpha, mask=cv2.bitwise_not(fgmask))
+        return fgmask
+
+
+MODELS = {'mog2': create_mog2, 'running_average': RunningAverageModel}
+
+
+class RegionBackgroundSubtractor(object):
+    def __init__(self, image_size, model='mog2', move_threshold_px=8):
+        """
+
+        :param image_size: Camera image size (width, height)
+        :param model: Model name, one of MODELS
+        :param move_threshold_px: The model restarts when an edge of the region moves more than this. Smaller
+            moves keep the model, so jitter of the board does not restart it.
+        """
+        if model not in MODELS:
+            raise ValueError("Unknown background model %s, should be one of %s" % (model, sorted(MODELS)))
+        self.image_size = image_size
+        self.model_name = model
+        self.move_threshold_px = move_threshold_px
+        self.region = None  # (x0, y0, x1, y1) of the model, or None for the whole frame
+        self.scale = 1.0
+        self.model = MODELS[model]()
+        self.num_resets = 0
+        self._mask = np.zeros((image_size[1], image_size[0]), np.uint8)
+
+    def reset(self):
+        """ Restart the model, for example when the board moved """
+        self.model = MODELS[self.model_name]()
+        self.num_resets += 1
+
+    def set_region(self, region, scale=1.0):
+        """ Set the region and scale of the model. The model restarts if the region moved or the scale changed.
+
+        :param region: (x0, y0, x1, y1) in pixels, or None for the whole frame
+        :param scale: Image scale of the model
+        :return: True if the model restarted
+        """
+        if scale == self.scale and self._is_same_region(region):
+            return False
+        self.region = region
+        self.scale = scale
+        self.reset()
+        return True
+
+    def _is_same_region(self, region):
+        if region is None or self.region is None:
+            return region is None and self.region is None
+        return np.max(np.abs(np.subtract(region, self.region))) <= self.move_threshold_px
+
+    def apply(self, gray):
+        """ Update the model with a new frame.
+
+        :param gray: Gray camera image
+        :return: Foreground mask of the frame size. Zero outside the region.
+        """
+        if self.region is None:
+            img = gray
+        else:
+            x0, y0, x1, y1 = self.region
+            img = gray[y0:y1, x0:x1]
+        if self.scale != 1.0:
+            img = cv2.resize(img, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        mask = self.model.apply(img)
+        if self.region is None and self.scale == 1.0:
+            return mask
+
+        self._mask.fill(0)
+        if self.region is None:
+            out = self._mask
+        else:
+            out = self._mask[y0:y1, x0:x1]
+        if self.scale != 1.0:
+            mask = cv2.resize(mask, (out.shape[1], out.shape[0]), interpolation=cv2.INTER_NEAREST)
+        out[:] = mask
+        return self._mask
@@ -0,0 +1,86 @@
+"""
+Benchmark the background models on a recorded session: MOG2 and the running average, each on the whole frame
+and cropped to the piano bounding box. Reports the time per frame, and how well the key pixels of the
+foreground mask agree with full frame MOG2.
+
+For press detection accuracy of a model, run bench_sessions.py with --bg-model.
+
+Usage:
+    python bench_background.py <session dir> [max_frames]
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import numpy as np
+import cv2
+from background import MODELS, RegionBackgroundSubtractor
+from bench_marker_tracking import load_frames
+from capture import FRAMES_DIR
+from piano import Piano
+from tracking import MarkerTracker
+
+
+def find_piano(frames, aruco_dict):
+    """ :return: Piano with the pose of the first frame in which it was found, or None """
+    piano = Piano(image_size=(frames[0].shape[1], frames[0].shape[0]))
+    detect_params = cv2.aruco.DetectorParameters_create()
+    detect_params.doCornerRefinement = True
+    tracker = MarkerTracker(aruco_dict, detect_params, piano.markers_ids)
+    for gray in frames:
+        corners, ids = tracker.detect(gray)
+        if ids is not None:
+            piano.update_coordinates(corners, ids)
+        if piano.is_initialize():
+            return piano
+    return None
+
+
+def run_benchmark(frames, piano, padding_px=10):
+    """ Run every model on the frames, on the whole frame and cropped to the piano.
+
+    :return: dictionary (model name, 'full' or 'crop') -> {'ms', 'agreement'}. agreement is the intersection
+        over union of the foreground key pixels with full frame MOG2.
+    """
+    image_size = (frames[0].shape[1], frames[0].shape[0])
+    is_key = piano.get_label_map() >= 0
+    masks = {}
+    results = {}
+    for model in sorted(MODELS):
+        for mode in ['full', 'crop']:
+            subtractor = RegionBackgroundSubtractor(image_size, model=model)
+            if mode == 'crop':
+                subtractor.set_region(piano.get_bounding_box(padding_px))
+            key_masks = []
+            t_start = time.perf_counter()
+            for gray in frames:
+                fgmask = subtractor.apply(gray)
+                key_masks.append(fgmask[is_key] > 0)
+            sec = time.perf_counter() - t_start
+            masks[(model, mode)] = np.array(key_masks)
+            results[(model, mode)] = {'ms': 1000.0 * sec / len(frames)}
+
+    reference = masks[('mog2', 'full')]
+    for key, m in masks.items():
+        union = np.count_nonzero(m | reference)
+        results[key]['agreement'] = np.count_nonzero(m & reference) / float(union) if union > 0 else 1.0
+    return results
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    max_frames = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    frames = load_frames(os.path.join(sys.argv[1], FRAMES_DIR), max_frames)
+    print("Loaded %d frames" % len(frames))
+    aruco_dict = cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_ARUCO_ORIGINAL)
+    piano = find_piano(frames, aruco_dict)
+    if piano is None:
+        print("The piano was not found")
+        sys.exit(1)
+    res = run_benchmark(frames, piano)
+    base_ms = res[('mog2', 'full')]['ms']
+    for (model, mode), r in sorted(res.items()):
+        print("%-16s %-4s %6.2f ms/frame | %5.2fx | key pixels agreement with full MOG2 %.3f" %
+              (model, mode, r['ms'], base_ms / r['ms'] if r['ms'] > 0 else 0.0, r['agreement']))
@@ -0,0 +1,57 @@
+"""
+Microbenchmark of Display.show_array: frames per second and bytes allocated per frame, for the
+default path and for the zero copy path.
+
+Usage:
+    python bench_display.py [num_frames] [--headless]
+
+With --headless SDL's dummy video driver is used, so no window is opened.
+Allocated bytes are measured with tracemalloc, which sees NumPy and Python allocations but not memory
+allocated inside SDL for new surfaces.
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import tracemalloc
+import numpy as np
+
+
+def run_benchmark(display, frames, is_bgr=False):
+    """ Show the frames one after the other.
+
+    :return: (frames per second, bytes allocated per frame)
+    """
+    display.show_array(frames[0], is_bgr=is_bgr)  # Warm up, so persistent buffers are not counted
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    t_start = time.perf_counter()
+    for frame in frames:
+        display.show_array(frame, is_bgr=is_bgr)
+    sec = time.perf_counter() - t_start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    num_frames = len(frames)
+    # Each frame's buffers are freed before the next one, so the peak is what one frame allocated
+    return num_frames / sec, float(peak)
+
+
+if __name__ == "__main__":
+    args = [x for x in sys.argv[1:] if not x.startswith('--')]
+    num_frames = int(args[0]) if args else 200
+    if '--headless' in sys.argv:
+        os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    from media import Display
+
+    screen_size = (1366, 768)
+    rng = np.random.RandomState(0)
+    frames = [rng.randint(0, 256, (screen_size[1], screen_size[0], 3)).astype(np.uint8) for _ in range(4)]
+    frames = [frames[i % len(frames)] for i in range(num_frames)]
+
+    for zero_copy in (False, True):
+        for is_bgr in (False, True):
+            display = Display(screen_width=screen_size[0], zero_copy=zero_copy)
+            fps, bytes_per_frame = run_benchmark(display, frames, is_bgr=is_bgr)
+            display.close()
+            print("zero_copy=%-5s is_bgr=%-5s | %7.1f fps | %10.0f bytes allocated per frame" %
+                  (zero_copy, is_bgr, fps, bytes_per_frame))
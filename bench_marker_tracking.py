@@ -0,0 +1,104 @@
+"""
+Benchmark full-frame AruCo detection against ROI tracking with MarkerTracker, on recorded frames.
+
+Usage:
+    python bench_marker_tracking.py <video file or directory of images> [max_frames]
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import numpy as np
+import cv2
+from piano import Piano
+from tracking import MarkerTracker
+
+
+def load_frames(path, max_frames=None):
+    """ Load recorded frames as gray images.
+
+    :param path: Video file, or directory of images which are read in sorted order
+    :param max_frames: Maximal number of frames to load. None for all.
+    :return: List of gray images
+    """
+    frames = []
+    if os.path.isdir(path):
+        for f in sorted(os.listdir(path)):
+            img = cv2.imread(os.path.join(path, f), cv2.IMREAD_GRAYSCALE)
+            if img is not None:
+                frames.append(img)
+            if max_frames is not None and len(frames) >= max_frames:
+                break
+    else:
+        cap = cv2.VideoCapture(path)
+        while max_frames is None or len(frames) < max_frames:
+            ret, img = cap.read()
+            if not ret:
+                break
+            frames.append(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY))
+        cap.release()
+    return frames
+
+
+def run_benchmark(frames, aruco_dict, marker_ids):
+    """ Run both detection methods on the frames.
+
+    :return: dictionary with the mean time per frame of each method, the speedup, the tracker scan counts
+        and the maximal corner difference between the methods in pixels
+    """
+    detect_params = cv2.aruco.DetectorParameters_create()
+    detect_params.doCornerRefinement = True
+
+    # Full frame detection
+    full_results = []
+    t_start = time.perf_counter()
+    for gray in frames:
+        corners, ids, rejectedImgPoints = cv2.aruco.detectMarkers(gray, aruco_dict, parameters=detect_params)
+        full_results.append((corners, ids))
+    full_sec = time.perf_counter() - t_start
+
+    # ROI tracking
+    tracker = MarkerTracker(aruco_dict, detect_params, marker_ids)
+    roi_results = []
+    t_start = time.perf_counter()
+    for gray in frames:
+        roi_results.append(tracker.detect(gray))
+    roi_sec = time.perf_counter() - t_start
+
+    # Compare the corners of the tracked markers
+    max_diff = 0.0
+    for (corners_full, ids_full), (corners_roi, ids_roi) in zip(full_results, roi_results):
+        if ids_full is None or ids_roi is None:
+            continue
+        ids_full = ids_full.flatten()
+        ids_roi = ids_roi.flatten()
+        for marker_id in marker_ids:
+            ind_full = np.flatnonzero(ids_full == marker_id)
+            ind_roi = np.flatnonzero(ids_roi == marker_id)
+            if len(ind_full) == 0 or len(ind_roi) == 0:
+                continue
+            diff = np.abs(corners_full[ind_full[0]] - corners_roi[ind_roi[0]]).max()
+            max_diff = max(max_diff, float(diff))
+
+    num_frames = max(len(frames), 1)
+    return {'full_ms': 1000.0 * full_sec / num_frames,
+            'roi_ms': 1000.0 * roi_sec / num_frames,
+            'speedup': full_sec / roi_sec if roi_sec > 0 else 0.0,
+            'num_full_scans': tracker.num_full_scans,
+            'num_roi_scans': tracker.num_roi_scans,
+            'max_corner_diff_px': max_diff}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    max_frames = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    frames = load_frames(sys.argv[1], max_frames)
+    print("Loaded %d frames" % len(frames))
+    aruco_dict = cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_ARUCO_ORIGINAL)
+    res = run_benchmark(frames, aruco_dict, Piano().markers_ids)
+    print("Full frame: %.2f ms/frame" % res['full_ms'])
+    print("ROI tracking: %.2f ms/frame (%d ROI scans, %d full scans)" %
+          (res['roi_ms'], res['num_roi_scans'], res['num_full_scans']))
+    print("Speedup: %.2fx | Max corner difference: %.3f px" % (res['speedup'], res['max_corner_diff_px']))
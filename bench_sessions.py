@@ -0,0 +1,121 @@
+"""
+Offline benchmark suite. Replays recorded sessions (see capture.py) through Manager without the camera,
+projector or sound, and reports FPS, per-stage latency percentiles and press detection accuracy against
+the session annotations. Several press detectors can be compared on the same sessions; the 'detect' stage is
+the CPU cost of the detector.
+
+Usage:
+    python bench_sessions.py <session dir> [<session dir> ...] [--pipelined] [--realtime] [--tolerance N]
+                             [--target-fps FPS] [--bg-model mog2|running_average]
+                             [--press-detectors fraction fingertip] [--no-light-compensation]
+"""
+from __future__ import print_function
+import argparse
+import numpy as np
+from capture import SessionPlayer, load_annotations
+from manager import Manager
+from media import HeadlessDisplay, HeadlessSound
+
+
+def match_presses(detected, annotated, tolerance=10):
+    """ Match detected key presses to the annotated ones. Each annotation matches at most one detection of
+        the same note within the tolerance.
+
+    :param detected: List of (frame number, note name). Frame numbers start from 1, like Manager.frame_num.
+    :param annotated: List of (frame index, note name). Frame indices start from 0.
+    :param tolerance: Maximal distance in frames between a detection and its annotation
+    :return: dictionary with true positives, false positives, false negatives, precision and recall
+    """
+    used = [False] * len(detected)
+    true_positives = 0
+    for frame_ann, note_ann in sorted(annotated):
+        best = None
+        for i, (frame_det, note_det) in enumerate(detected):
+            dist = abs((frame_det - 1) - frame_ann)
+            if used[i] or note_det != note_ann or dist > tolerance:
+                continue
+            if best is None or dist < best[1]:
+                best = (i, dist)
+        if best is not None:
+            used[best[0]] = True
+            true_positives += 1
+    false_positives = len(detected) - true_positives
+    false_negatives = len(annotated) - true_positives
+    return {'tp': true_positives, 'fp': false_positives, 'fn': false_negatives,
+            'precision': true_positives / float(len(detected)) if detected else 1.0,
+            'recall': true_positives / float(len(annotated)) if annotated else 1.0}
+
+
+def run_session(directory, pipelined=False, realtime=False, target_fps=None, bg_model=None, press_detector=None,
+                compensate_light=True):
+    """ Replay one session through a headless Manager.
+
+    :param target_fps: Frame rate for the adaptive load control. None to always run at full quality.
+    :param bg_model: Background model name. The configured model if None.
+    :param press_detector: Press detector name. The configured detector if None.
+    :param compensate_light: If False, press detection waits after every projected key change, like before the
+        projector light compensation.
+
+    :return: (Manager after the run, SessionPlayer)
+    """
+    player = SessionPlayer(directory, realtime=realtime)
+    manager = Manager()
+    manager.show_windows = False
+    manager.stats_print_freq = None
+    manager.score_log_dir = None
+    manager.controller.enabled = target_fps is not None
+    manager.compensate_projector_light = compensate_light
+    if bg_model is not None:
+        manager.bg_model = bg_model
+    if press_detector is not None:
+        manager.press_detector_name = press_detector
+    if target_fps is not None:
+        manager.controller.target_fps = target_fps
+    # Sessions recorded without a projector calibration are rendered with the identity
+    manager.cam_to_proj = player.cam_to_proj if player.cam_to_proj is not None else np.eye(3)
+    manager.run(pipelined=pipelined, cap=player, display=HeadlessDisplay(), sound=HeadlessSound())
+    return manager, player
+
+
+def print_report(directory, manager, player, tolerance):
+    stats = manager.stats.as_dict()
+    print("== %s | %d frames | %s detector" % (directory, len(player), manager.press_detector_name))
+    for name, s in stats['stages'].items():
+        print("  %-8s %7.1f fps | p50 %6.2f ms | p95 %6.2f ms | p99 %6.2f ms" %
+              (name, s['fps'], s['p50_ms'], s['p95_ms'], s['p99_ms']))
+    for name, q in stats['queues'].items():
+        print("  %s dropped %d/%d" % (name, q['dropped'], q['put']))
+    if manager.controller.enabled:
+        print("  %s | %d renders skipped" % (manager.controller.summary(), manager.num_skipped_renders))
+    annotated = load_annotations(directory)
+    if annotated is None:
+        print("  No annotations")
+        return
+    if 'capture->process' in stats['queues'] and stats['queues']['capture->process']['dropped'] > 0:
+        print("  Frames were dropped, so frame numbers do not match the annotations. Use serial mode for accuracy.")
+    acc = match_presses(manager.press_log, annotated, tolerance)
+    print("  presses: %d detected, %d annotated | precision %.3f | recall %.3f" %
+          (len(manager.press_log), len(annotated), acc['precision'], acc['recall']))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline benchmark on recorded sessions")
+    parser.add_argument('sessions', nargs='+', help="Session directories")
+    parser.add_argument('--pipelined', action='store_true', help="Run the pipelined mode")
+    parser.add_argument('--realtime', action='store_true', help="Replay at the recorded rate instead of as fast as possible")
+    parser.add_argument('--tolerance', type=int, default=10, help="Press matching tolerance, in frames")
+    parser.add_argument('--target-fps', type=float, default=None,
+                        help="Enable the adaptive load control with this frame rate")
+    parser.add_argument('--bg-model', choices=['mog2', 'running_average'], help="Background model")
+    parser.add_argument('--press-detectors', nargs='+', choices=['fraction', 'fingertip'], default=[None],
+                        help="Press detectors to compare. The configured detector if not given.")
+    parser.add_argument('--no-light-compensation', action='store_true',
+                        help="Wait after every projected key change instead of compensating the projector light")
+    args = parser.parse_args()
+    for directory in args.sessions:
+        for press_detector in args.press_detectors:
+            manager, player = run_session(directory, pipelined=args.pipelined, realtime=args.realtime,
+                                          target_fps=args.target_fps, bg_model=args.bg_model,
+                                          press_detector=press_detector,
+                                          compensate_light=not args.no_light_compensation)
+            print_report(directory, manager, player, args.tolerance)
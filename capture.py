@@ -0,0 +1,128 @@
+"""
+Recording and replay of camera sessions, so the app can run and be measured without the camera.
+
+A session is a directory with:
+    session.json - frame size, image format, capture timestamps and optionally the camera to projector homography
+    frames/      - one compressed image per frame: 000000.jpg, 000001.jpg, ...
+    annotations.json - optional ground truth key presses: {"presses": [{"frame": 12, "note": "C4"}, ...]}.
+                       "frame" is the frame index in the session, starting from 0.
+
+SessionRecorder and SessionPlayer have the read() / release() methods of cv2.VideoCapture, so they can be
+used wherever the camera is.
+"""
+import json
+import os
+import time
+import numpy as np
+import cv2
+
+SESSION_FILE = "session.json"
+ANNOTATIONS_FILE = "annotations.json"
+FRAMES_DIR = "frames"
+
+
+class SessionRecorder(object):
+    def __init__(self, cap_obj, directory, image_format=".jpg", jpeg_quality=95, cam_to_proj=None):
+        """ Record the frames read from a capture object.
+
+        :param cap_obj: OpenCV's VideoCapture object, or any object with read() and release()
+        :param directory: Session directory. Created if needed.
+        :param image_format: ".jpg" for small files or ".png" for lossless frames
+        :param jpeg_quality: JPEG quality, 0-100
+        :param cam_to_proj: Camera to projector homography to store with the session, or None
+        """
+        self.cap_obj = cap_obj
+        self.directory = directory
+        self.image_format = image_format
+        self.encode_params = [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality] if image_format == ".jpg" else []
+        self.cam_to_proj = cam_to_proj
+        self.timestamps = []
+        self.frame_size = None
+        frames_dir = os.path.join(directory, FRAMES_DIR)
+        if not os.path.exists(frames_dir):
+            os.makedirs(frames_dir)
+
+    def read(self):
+        ret, img = self.cap_obj.read()
+        if not ret:
+            return ret, img
+        t = time.time()
+        ok, buf = cv2.imencode(self.image_format, img, self.encode_params)
+        if ok:
+            fn = os.path.join(self.directory, FRAMES_DIR, "%06d%s" % (len(self.timestamps), self.image_format))
+            with open(fn, 'wb') as f:
+                f.write(buf.tobytes())
+            self.timestamps.append(t)
+            self.frame_size = (img.shape[1], img.shape[0])
+        return ret, img
+
+    def release(self):
+        """ Write the session file and release the capture object """
+        session = {'version': 1,
+                   'frame_size': self.frame_size,
+                   'image_format': self.image_format,
+                   'timestamps': self.timestamps,
+                   'cam_to_proj': None if self.cam_to_proj is None else np.asarray(self.cam_to_proj).tolist()}
+        with open(os.path.join(self.directory, SESSION_FILE), 'w') as f:
+            json.dump(session, f)
+        self.cap_obj.release()
+
+
+class SessionPlayer(object):
+    def __init__(self, directory, realtime=True, loop=False):
+        """ Replay a recorded session.
+
+        :param directory: Session directory
+        :param realtime: If True, frames are returned at the recorded rate. Otherwise as fast as possible.
+        :param loop: If True, start again from the first frame at the end of the session
+        """
+        self.directory = directory
+        self.realtime = realtime
+        self.loop = loop
+        with open(os.path.join(directory, SESSION_FILE)) as f:
+            session = json.load(f)
+        self.timestamps = session['timestamps']
+        self.frame_size = tuple(session['frame_size']) if session['frame_size'] is not None else None
+        self.image_format = session['image_format']
+        self.cam_to_proj = None if session.get('cam_to_proj') is None else np.array(session['cam_to_proj'])
+        self.frame_ind = 0  # Index of the next frame
+        self._t_start = None  # Clock time of the first frame of the current loop
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def read(self):
+        """ :return: (ret, img) like cv2.VideoCapture.read. ret is False at the end of the session. """
+        if self.frame_ind >= len(self.timestamps):
+            if not self.loop or len(self.timestamps) == 0:
+                return False, None
+            self.frame_ind = 0
+            self._t_start = None
+        if self.realtime:
+            now = time.time()
+            if self._t_start is None:
+                self._t_start = now
+            delay = self._t_start + (self.timestamps[self.frame_ind] - self.timestamps[0]) - now
+            if delay > 0:
+                time.sleep(delay)
+        fn = os.path.join(self.directory, FRAMES_DIR, "%06d%s" % (self.frame_ind, self.image_format))
+        img = cv2.imread(fn, cv2.IMREAD_COLOR)
+        self.frame_ind += 1
+        return img is not None, img
+
+    def release(self):
+        pass
+
+
+def load_annotations(directory):
+    """ Load the ground truth key presses of a session.
+
+    :param directory: Session directory
+    :return: List of (frame index, note name), or None if the session is not annotated
+    """
+    fn = os.path.join(directory, ANNOTATIONS_FILE)
+    if not os.path.exists(fn):
+        return None
+    with open(fn) as f:
+        annotations = json.load(f)
+    return [(int(x['frame']), x['note']) for x in annotations['presses']]
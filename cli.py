@@ -0,0 +1,124 @@
+"""
+Command line entry point of the interactive piano. Only the argument parser is loaded before the arguments are
+checked; OpenCV, the vision modules and the display and sound backends are imported when they are used.
+
+Usage:
+    python cli.py [--display projector|headless] [--sound wav|mixer|none] [--replay DIR] ...
+    python cli.py --help
+"""
+from __future__ import print_function
+import argparse
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Interactive piano")
+    parser.add_argument('--pipelined', action='store_true', help="Run capture, processing and rendering in parallel")
+    parser.add_argument('--workers', action='store_true',
+                        help="Run marker tracking and press detection in worker processes")
+    parser.add_argument('--calibrate', action='store_true', help="Calibrate the projector even if a calibration is stored")
+    parser.add_argument('--verify-calibration', action='store_true',
+                        help="Check the stored projector calibration by projecting the calibration board, and "
+                             "calibrate again if the camera or the projector moved")
+    parser.add_argument('--record', metavar='DIR', help="Record the camera session to a directory")
+    parser.add_argument('--replay', metavar='DIR', help="Replay a recorded session instead of the camera")
+    parser.add_argument('--display', choices=['projector', 'headless'], default='projector',
+                        help="headless shows nothing and opens no windows, for servers and tests")
+    parser.add_argument('--sound', choices=['wav', 'mixer', 'none'], default='wav',
+                        help="wav files with pygame, synthesized notes with the low latency mixer, or no sound")
+    parser.add_argument('--trace', metavar='FILE',
+                        help="Trace per-frame latencies. Written as Chrome trace if FILE ends with .json, else as CSV.")
+    parser.add_argument('--undistort', choices=['points', 'frames', 'none'], default='points',
+                        help="Lens undistortion, if the camera intrinsics are stored")
+    parser.add_argument('--target-fps', type=float, default=30.0,
+                        help="Frame rate to hold by lowering the processing cost under load. 0 to disable.")
+    parser.add_argument('--bg-model', choices=['mog2', 'running_average'],
+                        help="Background model. Taken from the configuration if not given.")
+    parser.add_argument('--press-detector', choices=['fraction', 'fingertip'],
+                        help="Key press detector. Taken from the configuration if not given.")
+    parser.add_argument('--no-light-compensation', action='store_true',
+                        help="Wait after every projected key change instead of compensating the projector light")
+    parser.add_argument('--song', default="default", help="Song name in the songs directory")
+    parser.add_argument('--score-log', metavar='DIR', help="Write the score of every session to a directory")
+    return parser
+
+
+def create_sound(name, manager):
+    """ :param name: 'wav', 'mixer' or 'none'
+        :param manager: The Manager. The mixer plays from its shared resources.
+        :return: Sound object with play_note_sound(name), and optionally close()
+    """
+    if name == 'mixer':
+        sound = manager.resources.create_sound_engine(device=manager.store.get('devices', 'sound_device'))
+        sound.start()
+        return sound
+    if name == 'none':
+        from media import HeadlessSound
+        return HeadlessSound()
+    from media import Sound
+    return Sound(wav_directory="wav")
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+
+    import cv2
+    import numpy as np
+    from manager import Manager
+    manager = Manager(undistort_mode=None if args.undistort == 'none' else args.undistort)
+    if args.bg_model:
+        manager.bg_model = args.bg_model
+    if args.press_detector:
+        manager.press_detector_name = args.press_detector
+    manager.compensate_projector_light = not args.no_light_compensation
+    manager.score_log_dir = args.score_log
+    manager.load_song(args.song)
+    manager.controller.enabled = args.target_fps > 0
+    if args.target_fps > 0:
+        manager.controller.target_fps = args.target_fps
+    manager.tracer.enabled = args.trace is not None
+
+    display = None
+    if args.display == 'headless':
+        from media import HeadlessDisplay
+        display = HeadlessDisplay()
+        manager.show_windows = False
+    manager.verify_calibration = args.verify_calibration
+    if args.calibrate:
+        manager.calibrate_cam_to_proj(force=True)
+    cap = None
+    if args.replay:
+        from capture import SessionPlayer
+        cap = SessionPlayer(args.replay, realtime=True)
+        if cap.cam_to_proj is not None:
+            manager.cam_to_proj = cap.cam_to_proj
+    if manager.cam_to_proj is None and args.display == 'headless':
+        # There is no projector to calibrate with
+        manager.cam_to_proj = manager.get_stored_cam_to_proj()
+        if manager.cam_to_proj is None:
+            print("No projector calibration, using the identity")
+            manager.cam_to_proj = np.eye(3)
+    if args.record:
+        from capture import SessionRecorder
+        if manager.cam_to_proj is None:
+            manager.calibrate_cam_to_proj()
+        cap = SessionRecorder(cv2.VideoCapture(manager.camera_index) if cap is None else cap, args.record,
+                              cam_to_proj=manager.cam_to_proj)
+
+    sound = create_sound(args.sound, manager)
+    try:
+        manager.run(pipelined=args.pipelined, cap=cap, display=display, sound=sound, use_workers=args.workers)
+    finally:
+        if hasattr(sound, 'close'):
+            sound.close()
+    if args.trace:
+        for (from_event, to_event), s in manager.tracer.summary().items():
+            print("%s -> %s: %d frames | p50 %.1f ms | p95 %.1f ms | p99 %.1f ms" %
+                  (from_event, to_event, s['count'], s['p50_ms'], s['p95_ms'], s['p99_ms']))
+        if args.trace.endswith('.json'):
+            manager.tracer.dump_chrome_trace(args.trace)
+        else:
+            manager.tracer.dump_csv(args.trace)
+
+
+if __name__ == "__main__":
+    main()
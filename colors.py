@@ -0,0 +1,31 @@
+"""
+Static key colour tables. They give the same colours as the matplotlib colormaps which were used before,
+without importing matplotlib.
+"""
+import numpy as np
+
+# matplotlib's 'Set2' colormap, RGB
+SET2 = [(102, 194, 165), (252, 141, 98), (141, 160, 203), (231, 138, 195), (166, 216, 84), (255, 217, 47),
+        (229, 196, 148), (179, 179, 179)]
+
+BRG_LUT_SIZE = 256  # Number of colours of matplotlib's 'brg' colormap
+
+
+def _levels_to_indices(num_of_levels, lut_size):
+    """ Colormap indices of the values i / num_of_levels, like matplotlib with Normalize(0, num_of_levels) """
+    x = np.arange(num_of_levels) / float(num_of_levels)
+    return np.minimum((x * lut_size).astype(int), lut_size - 1)
+
+
+def brg_colors(num_of_levels):
+    """ :return: List of num_of_levels [R, G, B] colours of matplotlib's 'brg' colormap: blue, red, green """
+    x = _levels_to_indices(num_of_levels, BRG_LUT_SIZE) / float(BRG_LUT_SIZE - 1)
+    r = np.where(x < 0.5, 2 * x, 2 - 2 * x)
+    g = np.clip(2 * x - 1, 0, 1)
+    b = np.clip(1 - 2 * x, 0, 1)
+    return np.uint8(np.round(255 * np.stack([r, g, b], axis=1))).tolist()
+
+
+def set2_colors(num_of_levels):
+    """ :return: List of num_of_levels [R, G, B] colours of matplotlib's 'Set2' colormap """
+    return [list(SET2[i]) for i in _levels_to_indices(num_of_levels, len(SET2))]
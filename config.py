@@ -0,0 +1,140 @@
+"""
+Persistent configuration and calibration store. Everything that depends on the physical setup (device
+indices, screen and camera sizes, camera intrinsics, projector calibration and the printed piano sizes)
+is kept in one versioned JSON file, which is read on first use.
+
+The file is piano_config.json in the working directory, or the path in the PIANO_CONFIG environment variable.
+
+Usage:
+    python config.py                                            # Print the configuration
+    python config.py --import-camera cam_mtx.npy dist_coeffs.npy  # Store camera intrinsics
+"""
+from __future__ import print_function
+import copy
+import json
+import os
+import numpy as np
+
+CONFIG_VERSION = 1
+DEFAULT_PATH = "piano_config.json"
+
+DEFAULT_CONFIG = {
+    'version': CONFIG_VERSION,
+    'devices': {'camera_index': 1,
+                'display_offset_x': 1366,  # Width of the laptop screen, where the projector screen starts
+                'sound_device': None},  # Output device of the low latency mixer. The default device if None.
+    'screen_size': [1366, 768],  # Projector (width, height)
+    'camera_size': [640, 480],  # Camera (width, height)
+    'camera': {'cam_mtx': None, 'dist_coeffs': None},
+    'projector': {'cam_to_proj': None, 'reproj_error': None, 'setup_hash': None},
+    # Background model: 'mog2', or 'running_average' for low power hosts.
+    # Press detector: 'fraction' of changed key pixels, or 'fingertip' tracking.
+    'processing': {'bg_model': 'mog2', 'press_detector': 'fraction'},
+    'aruco': {'marker_size_cm': 45},
+    # Keyboard layout (see layout.py). Without a marker size it is the original printed board, whose marker
+    # positions are learned.
+    'piano': {'first_note': 'C4', 'last_note': 'B5', 'marker_size_cm': None, 'marker_spacing_keys': 7,
+              'white_key_width_cm': 2.3, 'white_key_height_cm': 7.8,
+              'black_key_width_cm': 1.2, 'black_key_height_cm': 4.5},
+}
+
+
+class ConfigStore(object):
+    def __init__(self, path=None):
+        """
+
+        :param path: Configuration file. PIANO_CONFIG environment variable or piano_config.json if None.
+        """
+        self.path = path if path is not None else os.environ.get('PIANO_CONFIG', DEFAULT_PATH)
+        self._data = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = self._load()
+        return self._data
+
+    def get(self, section, key=None):
+        """ :return: A section of the configuration, or one value of it """
+        if key is None:
+            return self.data[section]
+        return self.data[section][key]
+
+    def set(self, section, key, value):
+        """ Set a value. Call save() to write it to the file. NumPy arrays are stored as lists. """
+        if isinstance(value, np.ndarray):
+            value = value.tolist()
+        self.data[section][key] = value
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.data, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def get_camera_intrinsics(self):
+        """ :return: (cam_mtx, dist_coeffs) as NumPy arrays, or (None, None) if the camera was not calibrated """
+        camera = self.data['camera']
+        if camera['cam_mtx'] is None or camera['dist_coeffs'] is None:
+            return None, None
+        return np.array(camera['cam_mtx']), np.array(camera['dist_coeffs'])
+
+    def set_camera_intrinsics(self, cam_mtx, dist_coeffs):
+        self.set('camera', 'cam_mtx', np.asarray(cam_mtx))
+        self.set('camera', 'dist_coeffs', np.asarray(dist_coeffs))
+
+    def get_projector_calibration(self, setup_hash):
+        """ :return: (cam_to_proj, reprojection error), or (None, None) if there is no calibration of this setup """
+        projector = self.data['projector']
+        if projector['cam_to_proj'] is None or projector['setup_hash'] != setup_hash:
+            return None, None
+        return np.array(projector['cam_to_proj']), projector['reproj_error']
+
+    def set_projector_calibration(self, setup_hash, cam_to_proj, reproj_error):
+        self.set('projector', 'cam_to_proj', np.asarray(cam_to_proj))
+        self.set('projector', 'reproj_error', reproj_error)
+        self.set('projector', 'setup_hash', setup_hash)
+
+    def _load(self):
+        data = copy.deepcopy(DEFAULT_CONFIG)
+        if not os.path.exists(self.path):
+            return data
+        with open(self.path) as f:
+            stored = json.load(f)
+        version = stored.get('version', 0)
+        if version > CONFIG_VERSION:
+            raise ValueError("%s has version %d, newer than the supported version %d" %
+                             (self.path, version, CONFIG_VERSION))
+        # Older files get the defaults of the sections and values they don't have
+        for section, value in stored.items():
+            if isinstance(value, dict) and isinstance(data.get(section), dict):
+                data[section].update(value)
+            else:
+                data[section] = value
+        data['version'] = CONFIG_VERSION
+        return data
+
+
+_store = None
+
+
+def get_store():
+    """ :return: The shared ConfigStore """
+    global _store
+    if _store is None:
+        _store = ConfigStore()
+    return _store
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Show or update the piano configuration")
+    parser.add_argument('--import-camera', nargs=2, metavar=('CAM_MTX', 'DIST_COEFFS'),
+                        help="Store camera intrinsics from .npy files")
+    args = parser.parse_args()
+    store = get_store()
+    if args.import_camera:
+        store.set_camera_intrinsics(np.load(args.import_camera[0]), np.load(args.import_camera[1]))
+        store.save()
+    print("%s:" % store.path)
+    print(json.dumps(store.data, indent=1, sort_keys=True))
@@ -0,0 +1,327 @@
+"""
+Key press detection. Two detectors can be selected by name:
+    'fraction' - a key is pressed when enough of its pixels changed in the background subtraction foreground mask
+    'fingertip' - the hand is segmented by skin colour in the piano area, fingertips are tracked from frame to
+                  frame, and a key is pressed when a fingertip dwells still inside it. Shadows and the projector
+                  light are not skin coloured, and a hovering finger does not stay still.
+Both have update(fgmask, label_map, geometry_version, img=None), which returns a list of KeyEvent, reset(),
+num_keys and is_pressed.
+"""
+import collections
+import numpy as np
+import cv2
+
+# key_ind - Piano key index
+# is_press - True for press, False for release
+# fraction - Fraction of the key pixels which changed, in the frame of the event
+KeyEvent = collections.namedtuple('KeyEvent', ['key_ind', 'is_press', 'fraction'])
+
+
+class KeyPressDetector(object):
+    def __init__(self, num_keys, press_threshold=0.05, release_threshold=0.02, press_frames=1, release_frames=3,
+                 erode_size=5):
+        """ Detects press and release of all the keys at once, from the fraction of changed pixels in each key.
+            The background model learns a finger which rests on a key within a few frames (MOG2 has a history
+            of 4), so a press is reported on the first changed frame, and the key is debounced by its release:
+            it must stay below release_threshold for release_frames before it can be pressed again.
+
+        :param num_keys: Number of piano keys
+        :param press_threshold: Fraction of changed pixels above which a key is considered pressed
+        :param release_threshold: Fraction of changed pixels below which a key is considered released
+        :param press_frames: Number of consecutive frames above press_threshold to report a press
+        :param release_frames: Number of consecutive frames below release_threshold to report a release
+        :param erode_size: Size of the erosion of the keys, so pixels at the key edges are ignored
+        """
+        self.num_keys = num_keys
+        self.press_threshold = press_threshold
+        self.release_threshold = release_threshold
+        self.press_frames = press_frames
+        self.release_frames = release_frames
+        self.erode_kernel = np.ones((erode_size, erode_size), np.uint8)
+        self.fractions = np.zeros(num_keys)  # Fraction of changed pixels of each key in the last frame
+        self.is_pressed = np.zeros(num_keys, bool)
+        self._counters = np.zeros(num_keys, np.int32)  # Consecutive frames towards changing the key state
+        self._bins = None  # Flattened key index + 1 of each pixel. 0 is outside the keys.
+        self._key_pixels = None  # Number of pixels in each key
+        self._geometry_version = None
+
+    def reset(self):
+        self.fractions[:] = 0
+        self.is_pressed[:] = False
+        self._counters[:] = 0
+
+    def update(self, fgmask, label_map, geometry_version, img=None):
+        """ Update the keys state with a new foreground mask.
+
+        :param fgmask: Foreground mask from the background subtraction. Non zero pixels changed.
+        :param label_map: Key index of every pixel, like Piano.get_label_map
+        :param geometry_version: Piano.geometry_version of the label map
+        :param img: Camera image. Not used, for the detectors interface.
+        :return: List of KeyEvent
+        """
+        if geometry_version != self._geometry_version:
+            self._set_label_map(label_map)
+            self._geometry_version = geometry_version
+
+        # Count the changed pixels of all the keys in one pass
+        changed = np.bincount(self._bins[fgmask.ravel() > 0], minlength=self.num_keys + 1)[1:]
+        self.fractions = changed / np.maximum(self._key_pixels, 1).astype(float)
+
+        # Debounce: the key state changes after enough consecutive frames
+        is_above = self.fractions > self.press_threshold
+        is_below = self.fractions < self.release_threshold
+        is_toward_change = np.where(self.is_pressed, is_below, is_above)
+        self._counters = np.where(is_toward_change, self._counters + 1, 0)
+        frames_needed = np.where(self.is_pressed, self.release_frames, self.press_frames)
+        changed_keys = np.flatnonzero(self._counters >= frames_needed)
+
+        events = []
+        for key_ind in changed_keys:
+            self.is_pressed[key_ind] = not self.is_pressed[key_ind]
+            self._counters[key_ind] = 0
+            events.append(KeyEvent(int(key_ind), bool(self.is_pressed[key_ind]), float(self.fractions[key_ind])))
+        return events
+
+    def _set_label_map(self, label_map):
+        # Keep only the key pixels whose whole neighbourhood is in the same key
+        eroded = cv2.erode(label_map, self.erode_kernel)
+        dilated = cv2.dilate(label_map, self.erode_kernel)
+        bins = label_map.astype(np.int64) + 1
+        bins[(eroded != label_map) | (dilated != label_map)] = 0
+        self._bins = bins.ravel()
+        self._key_pixels = np.bincount(self._bins, minlength=self.num_keys + 1)[1:]
+
+
+# Skin colour range in YCrCb
+SKIN_YCRCB_LOW = np.array([0, 133, 77], np.uint8)
+SKIN_YCRCB_HIGH = np.array([255, 173, 127], np.uint8)
+
+
+def get_hand_mask(fgmask, img=None):
+    """ :param fgmask: Foreground mask from the background subtraction
+        :param img: BGR camera image of the same region, or None
+        :return: uint8 mask, 255 on the skin coloured pixels of img. The foreground pixels if there is no colour image.
+    """
+    if img is None or img.ndim == 2:
+        return fgmask
+    return cv2.inRange(cv2.cvtColor(img, cv2.COLOR_BGR2YCrCb), SKIN_YCRCB_LOW, SKIN_YCRCB_HIGH)
+
+
+def find_fingertips(contour, step=12, max_angle_deg=60.0, merge_px=10.0):
+    """ Find the fingertips of a hand contour by the k-curvature of its convex hull points: a point is a
+        fingertip if the contour points step before and after it are seen from it at a sharp angle.
+
+    :param contour: Contour from cv2.findContours with CHAIN_APPROX_NONE
+    :param step: Contour step to the neighbours, about the finger width in pixels
+    :param max_angle_deg: Largest angle of a fingertip. Rectangle corners, like projected keys, are not fingertips.
+    :param merge_px: Fingertips closer than this are merged, sharpest first
+    :return: (N, 2) fingertips
+    """
+    pts = contour.reshape(-1, 2)
+    n = len(pts)
+    if n < 2 * step + 1:
+        return np.zeros((0, 2))
+    hull_inds = cv2.convexHull(contour, returnPoints=False).ravel()
+    tips = pts[hull_inds].astype(float)
+    v1 = pts[(hull_inds - step) % n] - tips
+    v2 = pts[(hull_inds + step) % n] - tips
+    cos_angle = np.sum(v1 * v2, axis=1) / np.maximum(np.linalg.norm(v1, axis=1) * np.linalg.norm(v2, axis=1), 1e-9)
+    is_sharp = cos_angle > np.cos(np.radians(max_angle_deg))
+    tips = tips[is_sharp]
+    order = np.argsort(-cos_angle[is_sharp])
+    kept = []
+    for i in order:
+        if all(np.linalg.norm(tips[i] - tips[j]) > merge_px for j in kept):
+            kept.append(i)
+    return tips[kept]
+
+
+class FingertipTrack(object):
+    def __init__(self, pt):
+        """ A fingertip tracked over frames
+
+        :param pt: (2,) position in the image
+        """
+        self.pt = pt
+        self.speed = 0.0  # Motion in pixels since the last frame
+        self.missed = 0  # Consecutive frames in which the fingertip was not found
+        self.key_ind = -1  # Key under the fingertip, -1 outside the keys
+        self.dwell = 0  # Consecutive frames in which the fingertip stood still in the key
+        self.is_pressing = False
+
+
+class FingertipTracker(object):
+    def __init__(self, max_jump_px=25.0, max_missed=2):
+        """ Tracks fingertips by nearest neighbour association between frames.
+
+        :param max_jump_px: Largest motion of a fingertip between frames
+        :param max_missed: A track is dropped after it was not found in more frames than this
+        """
+        self.max_jump_px = max_jump_px
+        self.max_missed = max_missed
+        self.tracks = []
+
+    def reset(self):
+        self.tracks = []
+
+    def update(self, pts):
+        """ Associate the fingertips of a new frame to the tracks, nearest pairs first.
+
+        :param pts: (N, 2) fingertips of the frame
+        :return: List of FingertipTrack. Tracks which were not found in the frame have missed > 0.
+        """
+        pts = np.asarray(pts, float).reshape(-1, 2)
+        matched_tracks = set()
+        matched_pts = set()
+        if self.tracks and len(pts) > 0:
+            prev = np.array([t.pt for t in self.tracks])
+            dist = np.linalg.norm(prev[:, np.newaxis, :] - pts[np.newaxis, :, :], axis=2)
+            for flat_ind in np.argsort(dist, axis=None):
+                track_ind, pt_ind = np.unravel_index(flat_ind, dist.shape)
+                if dist[track_ind, pt_ind] > self.max_jump_px:
+                    break
+                if track_ind in matched_tracks or pt_ind in matched_pts:
+                    continue
+                track = self.tracks[track_ind]
+                track.speed = float(dist[track_ind, pt_ind])
+                track.pt = pts[pt_ind]
+                track.missed = 0
+                matched_tracks.add(track_ind)
+                matched_pts.add(pt_ind)
+        for track_ind, track in enumerate(self.tracks):
+            if track_ind not in matched_tracks:
+                track.missed += 1
+        self.tracks = [t for t in self.tracks if t.missed <= self.max_missed]
+        self.tracks.extend(FingertipTrack(pts[i]) for i in range(len(pts)) if i not in matched_pts)
+        return self.tracks
+
+
+class FingertipPressDetector(object):
+    def __init__(self, num_keys, dwell_frames=3, still_px=3.0, min_hand_area_px=300, region_padding_px=40,
+                 curvature_step=12, max_tip_angle_deg=60.0, merge_px=10.0, max_jump_px=25.0, lost_frames=2):
+        """ Detects presses from fingertips which dwell inside a key. The hand is segmented by skin colour in the
+            piano area, or from the foreground mask if the image has no colour.
+
+        :param num_keys: Number of piano keys
+        :param dwell_frames: Number of consecutive frames a fingertip stands still in a key to report a press
+        :param still_px: Largest motion between frames of a fingertip which stands still
+        :param min_hand_area_px: Smaller blobs are not hands
+        :param region_padding_px: Padding around the keys in which the hand is segmented, so the hand contour
+            does not end at the keys edge
+        :param curvature_step: Like step of find_fingertips
+        :param max_tip_angle_deg: Like max_angle_deg of find_fingertips
+        :param merge_px: Like merge_px of find_fingertips
+        :param max_jump_px: Like max_jump_px of FingertipTracker
+        :param lost_frames: A fingertip which was not found in more frames than this releases its key
+        """
+        self.num_keys = num_keys
+        self.dwell_frames = dwell_frames
+        self.still_px = still_px
+        self.min_hand_area_px = min_hand_area_px
+        self.region_padding_px = region_padding_px
+        self.curvature_step = curvature_step
+        self.max_tip_angle_deg = max_tip_angle_deg
+        self.merge_px = merge_px
+        self.tracker = FingertipTracker(max_jump_px=max_jump_px, max_missed=lost_frames)
+        self.is_pressed = np.zeros(num_keys, bool)
+        self.fingertips = np.zeros((0, 2))  # Fingertips found in the last frame
+        self._open_kernel = np.ones((3, 3), np.uint8)
+        self._region = None  # (x0, y0, x1, y1) of the keys with the padding
+        self._geometry_version = None
+
+    def reset(self):
+        self.is_pressed[:] = False
+        self.fingertips = np.zeros((0, 2))
+        self.tracker.reset()
+
+    def update(self, fgmask, label_map, geometry_version, img=None):
+        """ Update the keys state with a new frame.
+
+        :param fgmask: Foreground mask from the background subtraction, used if img has no colour
+        :param label_map: Key index of every pixel, like Piano.get_label_map
+        :param geometry_version: Piano.geometry_version of the label map
+        :param img: BGR camera image, or None
+        :return: List of KeyEvent. The fraction is the fraction of the key pixels covered by the hand.
+        """
+        if geometry_version != self._geometry_version:
+            self._region = self._get_region(label_map)
+            self._geometry_version = geometry_version
+        if self._region is None:
+            return []
+        x0, y0, x1, y1 = self._region
+        hand = get_hand_mask(fgmask[y0:y1, x0:x1], None if img is None else img[y0:y1, x0:x1])
+        hand = cv2.morphologyEx(hand, cv2.MORPH_OPEN, self._open_kernel)
+        self.fingertips = self._find_fingertips(hand) + [x0, y0]
+
+        # A fingertip presses a key after it stood still in it for dwell_frames
+        height, width = label_map.shape
+        for track in self.tracker.update(self.fingertips):
+            if track.missed > 0:
+                continue
+            x = min(max(int(round(track.pt[0])), 0), width - 1)
+            y = min(max(int(round(track.pt[1])), 0), height - 1)
+            key_ind = int(label_map[y, x])
+            if key_ind != track.key_ind:
+                track.key_ind = key_ind
+                track.dwell = 0
+                track.is_pressing = False
+            elif track.speed <= self.still_px:
+                track.dwell += 1
+            else:
+                track.dwell = 0
+            if key_ind >= 0 and track.dwell >= self.dwell_frames:
+                track.is_pressing = True
+
+        is_pressed = np.zeros(self.num_keys, bool)
+        for track in self.tracker.tracks:
+            if track.is_pressing:
+                is_pressed[track.key_ind] = True
+        events = []
+        keys = label_map[y0:y1, x0:x1]
+        for key_ind in np.flatnonzero(is_pressed != self.is_pressed):
+            in_key = keys == key_ind
+            fraction = np.count_nonzero(hand[in_key]) / float(max(np.count_nonzero(in_key), 1))
+            events.append(KeyEvent(int(key_ind), bool(is_pressed[key_ind]), float(fraction)))
+        self.is_pressed = is_pressed
+        return events
+
+    def _find_fingertips(self, hand):
+        """ :return: (N, 2) fingertips in the hand mask """
+        contours = cv2.findContours(hand, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)[-2]
+        tips = [find_fingertips(c, self.curvature_step, self.max_tip_angle_deg, self.merge_px)
+                for c in contours if cv2.contourArea(c) >= self.min_hand_area_px]
+        if not tips:
+            return np.zeros((0, 2))
+        tips = np.vstack(tips)
+        # The hand is cut at the region edges, which makes sharp corners which are not fingertips
+        height, width = hand.shape
+        is_inside = ((tips[:, 0] > 1) & (tips[:, 0] < width - 2) & (tips[:, 1] > 1) & (tips[:, 1] < height - 2))
+        return tips[is_inside]
+
+    def _get_region(self, label_map):
+        """ :return: (x0, y0, x1, y1) bounding box of the keys with the padding, or None if there are no keys """
+        is_key = label_map >= 0
+        rows = np.flatnonzero(is_key.any(axis=1))
+        cols = np.flatnonzero(is_key.any(axis=0))
+        if len(rows) == 0:
+            return None
+        height, width = label_map.shape
+        pad = self.region_padding_px
+        return (max(0, cols[0] - pad), max(0, rows[0] - pad),
+                min(width, cols[-1] + 1 + pad), min(height, rows[-1] + 1 + pad))
+
+
+DETECTORS = {'fraction': KeyPressDetector, 'fingertip': FingertipPressDetector}
+
+
+def create_detector(name, num_keys, press_threshold=0.05):
+    """ :param name: Detector name, one of DETECTORS
+        :param num_keys: Number of piano keys
+        :param press_threshold: Press threshold of the 'fraction' detector
+        :return: The detector
+    """
+    if name not in DETECTORS:
+        raise ValueError("Unknown press detector %s, should be one of %s" % (name, sorted(DETECTORS)))
+    if name == 'fraction':
+        return KeyPressDetector(num_keys, press_threshold=press_threshold)
+    return DETECTORS[name](num_keys)
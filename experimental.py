@@ -1,40 +1,35 @@
 import os
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib
 import cv2
 from media import Display, calibrate_projector
+from config import get_store
+from colors import set2_colors
+from layout import KeyboardLayout
 
+STORE = get_store()
 PARAMS = {}
-PARAMS['aruco'] = {'dict': cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_ARUCO_ORIGINAL),
-                   'marker_size_cm': 45, 'markers_dist_cm': 18}
-PARAMS['camera'] = {'cam_mtx': np.load("/home/merav/code/proj1/calibration/cam_mtx.npy"),
-                    'dist_coeffs': np.load("/home/merav/code/proj1/calibration/dist_coeffs.npy")}
-PARAMS['piano'] = {'white_key_width_cm': 2.3, 'white_key_height_cm': 7.8,
-                   'black_key_width_cm': 1.2, 'black_key_height_cm': 4.5,
-                   'left_marker_tr_to_piano_cm': np.array([1.1, 1.8]),
-                   'size_cm': np.array([15.5, 7.7])}
-SCREEN_SIZE = (1366, 768)  # (width, height)
-IMG_SIZE = (640, 480)   # (width, height)
-NUM_OF_PIANO_KEYS = 7 * 2
+PARAMS['aruco'] = dict(STORE.get('aruco'), dict=cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_ARUCO_ORIGINAL))
+cam_mtx, dist_coeffs = STORE.get_camera_intrinsics()  # None if the camera was not calibrated
+PARAMS['camera'] = {'cam_mtx': cam_mtx, 'dist_coeffs': dist_coeffs}
+SCREEN_SIZE = tuple(STORE.get('screen_size'))  # (width, height)
+IMG_SIZE = tuple(STORE.get('camera_size'))   # (width, height)
+NUM_OF_PIANO_KEYS = KeyboardLayout.from_config(STORE.get('piano')).num_white_keys
 
 piano_key_ind = 0
 
 # define the piano keys colormap
-cmap = matplotlib.cm.get_cmap('Set2')
-norm = matplotlib.colors.Normalize(vmin=0, vmax=NUM_OF_PIANO_KEYS)
-cmap_keys = [cmap(norm(i))[:3] for i in range(NUM_OF_PIANO_KEYS)]
-cmap_keys = [np.uint8(np.round(255*np.array(x))).tolist() for x in cmap_keys]
+cmap_keys = set2_colors(NUM_OF_PIANO_KEYS)
 
 if __name__ == "__main__":
     # Calibrate camera and projector - find homography
-    cam_to_proj = calibrate_projector(screen_size=SCREEN_SIZE, aruco_dict=PARAMS['aruco']['dict'])
+    cam_to_proj = calibrate_projector(screen_size=SCREEN_SIZE, aruco_dict=PARAMS['aruco']['dict'], store=STORE,
+                                      camera_index=STORE.get('devices', 'camera_index'), camera_size=IMG_SIZE)
 
     # Start projector
     display = Display()
 
     # Start camera
-    cap = cv2.VideoCapture(1)
+    cap = cv2.VideoCapture(STORE.get('devices', 'camera_index'))
     while True:
         # Capture frame-by-frame
         ret, img = cap.read()
@@ -1,20 +1,130 @@
 """
 Generates wav file using PySynth:
 https://mdoege.github.io/PySynth/#s
+
+Notes are rendered in parallel processes. A manifest in the output folder keeps a hash of the parameters
+of every file, so only missing or changed notes are rendered again.
+
+Usage:
+    python generate_wavs.py [--range C4 B5] [--durations 4 8] [--instruments pysynth pysynth_b] [--jobs N]
+
+The default (all the keys of the configured layout, duration 4, instrument pysynth) is written to wav/<note>.wav,
+which is what media.Sound loads. Other durations and instruments go to wav/<instrument>_d<duration>/<note>.wav.
 """
+from __future__ import print_function
+import argparse
+import hashlib
+import importlib
+import json
+import multiprocessing
 import os
-import pysynth
-from piano import Piano
 
 output_folder = "wav"
+MANIFEST_FILE = "manifest.json"
+DEFAULT_DURATION = 4
+DEFAULT_INSTRUMENT = "pysynth"
+SYNTH_PARAMS = {'bpm': 120, 'boost': 1.1}  # Accepted by make_wav of all the PySynth modules
+
+
+def get_output_path(note, duration, instrument):
+    if duration == DEFAULT_DURATION and instrument == DEFAULT_INSTRUMENT:
+        return os.path.join(output_folder, "%s.wav" % note)
+    return os.path.join(output_folder, "%s_d%s" % (instrument, duration), "%s.wav" % note)
+
+
+def get_job_hash(note, duration, instrument):
+    job = {'note': note, 'duration': duration, 'instrument': instrument, 'params': SYNTH_PARAMS}
+    return hashlib.sha1(json.dumps(job, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def render_note(job):
+    """ Render one note. Runs in a worker process.
+
+    :param job: (note, duration, instrument, output path)
+    :return: The output path
+    """
+    note, duration, instrument, fn = job
+    synth = importlib.import_module(instrument)
+    out_dir = os.path.dirname(fn)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    synth.make_wav([[note.lower(), duration]], fn=fn, silent=True, **SYNTH_PARAMS)
+    return fn
+
+
+def get_notes(key_range=None):
+    """ :param key_range: (first note, last note), like ("A0", "C8"). None for the keys of the configured layout.
+        :return: List of note names
+    """
+    if key_range is None:
+        from config import get_store
+        from layout import KeyboardLayout
+        return list(KeyboardLayout.from_config(get_store().get('piano')).note_names)
+    from notes import midi_to_note, note_to_midi
+    first, last = note_to_midi(key_range[0]), note_to_midi(key_range[1])
+    return [midi_to_note(m) for m in range(first, last + 1)]
+
+
+def load_manifest():
+    fn = os.path.join(output_folder, MANIFEST_FILE)
+    if not os.path.exists(fn):
+        return {}
+    with open(fn) as f:
+        return json.load(f)
+
+
+def save_manifest(manifest):
+    with open(os.path.join(output_folder, MANIFEST_FILE), 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+
+def generate(notes, durations=(DEFAULT_DURATION,), instruments=(DEFAULT_INSTRUMENT,), jobs=None):
+    """ Render the notes which are missing or out of date.
 
-key_list = Piano().key_list
+    :param notes: List of note names
+    :param durations: Note durations, in PySynth units (4 is a quarter note)
+    :param instruments: PySynth module names, like "pysynth" or "pysynth_b"
+    :param jobs: Number of worker processes. Number of CPUs if None.
+    :return: Number of rendered notes
+    """
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+    manifest = load_manifest()
+    todo = []
+    for instrument in instruments:
+        for duration in durations:
+            for note in notes:
+                fn = get_output_path(note, duration, instrument)
+                key = os.path.relpath(fn, output_folder)
+                job_hash = get_job_hash(note, duration, instrument)
+                if os.path.exists(fn) and manifest.get(key) == job_hash:
+                    continue
+                todo.append(((note, duration, instrument, fn), key, job_hash))
+    print("%d notes up to date, %d to generate" % (len(notes) * len(durations) * len(instruments) - len(todo),
+                                                   len(todo)))
+    if len(todo) == 0:
+        return 0
 
-if not os.path.exists(output_folder):
-    os.makedirs(output_folder)
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for (job, key, job_hash), fn in zip(todo, pool.imap(render_note, [x[0] for x in todo])):
+            print("Generated %s" % fn)
+            manifest[key] = job_hash
+    finally:
+        pool.close()
+        pool.join()
+        # Keep the notes which were done even if another one failed
+        save_manifest(manifest)
+    return len(todo)
 
-for key in key_list:
-    print("Generating %s" % key['note'])
-    note_str = key['note'].lower()
-    pysynth.make_wav([[note_str, 4]], fn=os.path.join(output_folder, "%s.wav" % key['note']))
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate the note wav files")
+    parser.add_argument('--range', nargs=2, metavar=('FIRST', 'LAST'), help="Note range, like C4 B5")
+    parser.add_argument('--durations', nargs='+', type=int, default=[DEFAULT_DURATION],
+                        help="Note durations in PySynth units")
+    parser.add_argument('--instruments', nargs='+', default=[DEFAULT_INSTRUMENT],
+                        help="PySynth modules, like pysynth, pysynth_b, pysynth_s")
+    parser.add_argument('--jobs', type=int, default=None, help="Number of worker processes")
+    args = parser.parse_args()
+    generate(get_notes(args.range), args.durations, args.instruments, args.jobs)
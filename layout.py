@@ -0,0 +1,225 @@
+"""
+Keyboard layouts. A layout is the keys of a range of notes, up to the 88 keys of a full piano (A0 to C8), their
+geometry on the printed board and the placement of the AruCo markers around it. The geometry arrays are built
+once per layout, so every frame Piano only transforms them.
+
+The default layout is the original printed board, C4 to B5 with four corner markers, whose exact positions on
+the board are learned while the piano runs. A layout with a marker size places its markers at known positions:
+one at every corner and more along the top edge, so a long board is tracked from any part of it. Such a layout
+can be printed.
+
+Usage:
+    python layout.py --first A0 --last C8 --marker-size 3 --out board.png [--dpi 150]
+"""
+from __future__ import print_function
+import numpy as np
+from notes import midi_to_note, note_to_midi
+
+LOWEST_NOTE = 'A0'
+HIGHEST_NOTE = 'C8'
+FIRST_MARKER_ID = 203
+
+# (name, index of the marker corner on the piano corner) of the corner markers, in the order of the piano corners:
+# top left, top right, bottom right, bottom left. Every marker touches the piano at one corner, outside it.
+CORNER_MARKERS = [('top_left', 2), ('top_right', 3), ('bottom_right', 0), ('bottom_left', 1)]
+
+
+class KeyboardLayout(object):
+    def __init__(self, first_note='C4', last_note='B5', white_key_width_cm=2.3, white_key_height_cm=7.8,
+                 black_key_width=1.2 / 2.3, black_key_height=4.5 / 7.8, marker_size_cm=None, marker_spacing_keys=7,
+                 marker_ids=None, label_table_resolution=100):
+        """
+
+        :param first_note: Lowest key. Must be a white key.
+        :param last_note: Highest key. Must be a white key.
+        :param white_key_width_cm: Printed white key width
+        :param white_key_height_cm: Printed white key height
+        :param black_key_width: Black key width, in white key widths. The default is of the original board.
+        :param black_key_height: Black key height, in white key heights. The default is of the original board.
+        :param marker_size_cm: Printed marker size. If None, the layout has only the four corner markers, and their
+            positions on the board are not known.
+        :param marker_spacing_keys: White keys between the markers along the top edge
+        :param marker_ids: AruCo ids of the markers, corner markers first. Consecutive ids from 203 if None.
+        :param label_table_resolution: Label table bins per piano unit
+        """
+        first, last = note_to_midi(first_note), note_to_midi(last_note)
+        if not note_to_midi(LOWEST_NOTE) <= first <= last <= note_to_midi(HIGHEST_NOTE):
+            raise ValueError("Bad keyboard range %s-%s, should be in %s-%s" %
+                             (first_note, last_note, LOWEST_NOTE, HIGHEST_NOTE))
+        if '#' in midi_to_note(first) or '#' in midi_to_note(last):
+            raise ValueError("Keyboard range %s-%s should start and end with white keys" % (first_note, last_note))
+        self.white_key_width_cm = white_key_width_cm
+        self.white_key_height_cm = white_key_height_cm
+        self.black_key_width = black_key_width
+        self.black_key_height = black_key_height
+        self.marker_size_cm = marker_size_cm
+        self.marker_spacing_keys = marker_spacing_keys
+        self.label_table_resolution = label_table_resolution
+
+        # x is in white key widths. A black key is centered on the border of the white keys around it.
+        self.key_list = []
+        num_white_keys = 0
+        for midi in range(first, last + 1):
+            note = midi_to_note(midi)
+            if '#' in note:
+                self.key_list.append({'note': note, 'x': num_white_keys - black_key_width / 2.0})
+            else:
+                self.key_list.append({'note': note, 'x': float(num_white_keys)})
+                num_white_keys += 1
+        self.num_white_keys = num_white_keys
+        self.note_names = tuple(key['note'] for key in self.key_list)
+        self.is_black = np.array(['#' in name for name in self.note_names])
+        self.keys_unit_corners = self._get_keys_unit_corners()
+        self.label_table = self._get_label_table()
+        self.markers_list, self.markers_board_cm = self._place_markers(marker_ids)
+
+    @classmethod
+    def from_config(cls, piano_config, **kwargs):
+        """ :param piano_config: The 'piano' section of the configuration, like config.DEFAULT_CONFIG
+            :param kwargs: Arguments of KeyboardLayout which replace the configured ones
+            :return: KeyboardLayout
+        """
+        args = {'first_note': piano_config['first_note'], 'last_note': piano_config['last_note'],
+                'white_key_width_cm': piano_config['white_key_width_cm'],
+                'white_key_height_cm': piano_config['white_key_height_cm'],
+                'black_key_width': piano_config['black_key_width_cm'] / float(piano_config['white_key_width_cm']),
+                'black_key_height': piano_config['black_key_height_cm'] / float(piano_config['white_key_height_cm']),
+                'marker_size_cm': piano_config['marker_size_cm'],
+                'marker_spacing_keys': piano_config['marker_spacing_keys']}
+        args.update(kwargs)
+        return cls(**args)
+
+    def __len__(self):
+        return len(self.key_list)
+
+    def get_board_size_cm(self):
+        """ :return: (width, height) of the keys on the board, in cm """
+        return self.num_white_keys * self.white_key_width_cm, self.white_key_height_cm
+
+    def _get_keys_unit_corners(self):
+        """ :return: (N, 4, 2) key corners in piano units: top left, top right, bottom right, bottom left """
+        x = np.array([key['x'] for key in self.key_list], float)
+        w = np.where(self.is_black, self.black_key_width, 1.0)
+        h = np.where(self.is_black, self.black_key_height, 1.0)
+        zeros = np.zeros_like(x)
+        return np.stack([np.stack([x, zeros], axis=1),
+                         np.stack([x + w, zeros], axis=1),
+                         np.stack([x + w, h], axis=1),
+                         np.stack([x, h], axis=1)], axis=1)
+
+    def _get_label_table(self):
+        """ Build a table of the key index in piano units, in bins of 1 / label_table_resolution units.
+            Black keys are drawn after the white keys, so they are on top.
+
+        :return: int16 array with shape (rows, columns). -1 where there is no key.
+        """
+        res = self.label_table_resolution
+        corners = self.keys_unit_corners
+        width = int(np.ceil(corners[:, :, 0].max() * res))
+        height = int(np.ceil(corners[:, :, 1].max() * res))
+        table = np.full((height, width), -1, np.int16)
+        order = np.concatenate([np.flatnonzero(~self.is_black), np.flatnonzero(self.is_black)])
+        for key_ind in order:
+            x0, y0 = np.round(corners[key_ind, 0] * res).astype(int)
+            x1, y1 = np.round(corners[key_ind, 2] * res).astype(int)
+            table[y0:y1, x0:x1] = key_ind
+        return table
+
+    def _place_markers(self, marker_ids):
+        """ :return: (markers list like Piano.markers_list, marker ID -> (4, 2) marker corners on the board in cm,
+                or None if the positions are not known)
+        """
+        num_top = 0
+        if self.marker_size_cm is not None:
+            if self.marker_spacing_keys * self.white_key_width_cm < self.marker_size_cm:
+                raise ValueError("Markers of %.1f cm do not fit every %d white keys" %
+                                 (self.marker_size_cm, self.marker_spacing_keys))
+            num_top = (self.num_white_keys - 1) // self.marker_spacing_keys
+        if marker_ids is None:
+            marker_ids = range(FIRST_MARKER_ID, FIRST_MARKER_ID + len(CORNER_MARKERS) + num_top)
+        marker_ids = [int(x) for x in marker_ids]
+        if len(marker_ids) != len(CORNER_MARKERS) + num_top:
+            raise ValueError("The layout has %d markers, got %d ids" % (len(CORNER_MARKERS) + num_top,
+                                                                       len(marker_ids)))
+        markers_list = [{'id': marker_id, 'name': name, 'corner_ind': corner_ind, 'corners': None}
+                        for marker_id, (name, corner_ind) in zip(marker_ids, CORNER_MARKERS)]
+        markers_list += [{'id': marker_id, 'name': 'top_%d' % (i + 1), 'corner_ind': None, 'corners': None}
+                         for i, marker_id in enumerate(marker_ids[len(CORNER_MARKERS):])]
+        if self.marker_size_cm is None:
+            return markers_list, None
+
+        s = self.marker_size_cm
+        width, height = self.get_board_size_cm()
+        # Top left corner of every marker. The marker corners are in AruCo order: top left, top right,
+        # bottom right, bottom left.
+        origins = [(-s, -s), (width, -s), (width, height), (-s, height)]
+        origins += [((i + 1) * self.marker_spacing_keys * self.white_key_width_cm - s / 2.0, -s)
+                    for i in range(num_top)]
+        square = np.array([[0, 0], [s, 0], [s, s], [0, s]], float)
+        markers_board_cm = dict((m['id'], square + origin) for m, origin in zip(markers_list, origins))
+        return markers_list, markers_board_cm
+
+
+def render_board(layout, aruco_dict, px_per_cm, margin_cm=1.0):
+    """ Draw the printed board of a layout: the keys, the note names of the C keys and the markers.
+
+    :param layout: KeyboardLayout with a marker size
+    :param aruco_dict: OpenCV's AruCo dictionary of the markers
+    :param px_per_cm: Image resolution
+    :param margin_cm: White margin around the markers
+    :return: Gray image. Print it at px_per_cm so the keys have their sizes.
+    """
+    import cv2
+    if layout.markers_board_cm is None:
+        raise ValueError("The markers of the layout are not placed. Give it a marker size.")
+    s = layout.marker_size_cm
+    width_cm, height_cm = layout.get_board_size_cm()
+    offset_cm = margin_cm + s  # Board position of the image origin is -offset_cm
+    img = np.full((int(round((height_cm + 2 * offset_cm) * px_per_cm)),
+                   int(round((width_cm + 2 * offset_cm) * px_per_cm))), 255, np.uint8)
+
+    def to_px(pts_cm):
+        return np.round((np.asarray(pts_cm, float) + offset_cm) * px_per_cm).astype(np.int32)
+
+    corners_cm = layout.keys_unit_corners * np.array([layout.white_key_width_cm, layout.white_key_height_cm])
+    thickness = max(1, int(round(0.05 * px_per_cm)))
+    for key_ind in np.flatnonzero(~layout.is_black):
+        cv2.polylines(img, [to_px(corners_cm[key_ind])], True, 0, thickness)
+        note = layout.key_list[key_ind]['note']
+        if note.startswith('C'):
+            x, y = to_px(corners_cm[key_ind, 3] + [0.2 * layout.white_key_width_cm, -0.5])
+            cv2.putText(img, note, (int(x), int(y)), cv2.FONT_HERSHEY_SIMPLEX, 0.02 * px_per_cm, 0, thickness)
+    for key_ind in np.flatnonzero(layout.is_black):
+        cv2.fillPoly(img, [to_px(corners_cm[key_ind])], 0)
+
+    side_px = int(round(s * px_per_cm))
+    for marker_id, marker_cm in layout.markers_board_cm.items():
+        x, y = to_px(marker_cm[0])
+        img[y:y + side_px, x:x + side_px] = cv2.aruco.drawMarker(aruco_dict, marker_id, side_px)
+    return img
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Print the board of a keyboard layout")
+    parser.add_argument('--first', default='C4', help="Lowest key, a white key")
+    parser.add_argument('--last', default='B5', help="Highest key, a white key")
+    parser.add_argument('--marker-size', type=float, required=True, help="Marker size in cm")
+    parser.add_argument('--marker-spacing', type=int, default=7, help="White keys between the top markers")
+    parser.add_argument('--dpi', type=float, default=150, help="Print resolution")
+    parser.add_argument('--out', default="board.png", help="Output image")
+    args = parser.parse_args()
+
+    import cv2
+    from config import get_store
+    piano_config = get_store().get('piano')
+    layout = KeyboardLayout.from_config(piano_config, first_note=args.first, last_note=args.last,
+                                        marker_size_cm=args.marker_size, marker_spacing_keys=args.marker_spacing)
+    board = render_board(layout, cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_ARUCO_ORIGINAL),
+                         args.dpi / 2.54)
+    cv2.imwrite(args.out, board)
+    width_cm, height_cm = layout.get_board_size_cm()
+    print("%s | %d keys | keys %.1f x %.1f cm | %d markers | print at %g dpi" %
+          (args.out, len(layout), width_cm, height_cm, len(layout.markers_list), args.dpi))
+    print("Set 'first_note', 'last_note', 'marker_size_cm' and 'marker_spacing_keys' of the 'piano' configuration "
+          "section to use it")
@@ -1,154 +1,605 @@
+import multiprocessing
+import os
+import queue
+import threading
 import time
 import numpy as np
 import cv2
-from media import Display, Sound, calibrate_projector
+from media import Display, Sound, calibrate_projector, get_calibration_setup_hash
 from piano import Piano
-import matplotlib.pyplot as plt
+from layout import KeyboardLayout
+from pipeline import LatestFrameQueue, PipelineStats, StageThread
+from scheduler import NoteScheduler
+from resources import SharedResources
+from tracking import MarkerTracker
+from render import KeyDrawing, ProjectorRenderer, get_projection_key
+from detection import create_detector
+from tracing import Tracer
+from config import get_store
+from undistort import Undistorter
+from adaptive import AdaptiveController
+from background import RegionBackgroundSubtractor
+from scoring import ScoreKeeper, ScoreLog
+from projector_light import ProjectorLightModel
+import workers
 
 class Manager(object):
-    def __init__(self):
-        self.screen_size = (1366, 768)  # (width, height)
-        self.camera_size = (640, 480)   # (width, height)
+    def __init__(self, store=None, undistort_mode='points', resources=None):
+        """
+
+        :param store: config.ConfigStore with the setup and calibration. The shared store if None.
+        :param undistort_mode: Lens undistortion, used only if the camera intrinsics are stored:
+            'points' - undistort the marker corners and move the key polygons back to the camera image,
+            'frames' - undistort every camera frame with cached remap tables,
+            None - no undistortion.
+        :param resources: resources.SharedResources to share with other managers in the process. The manager
+            creates its own if None.
+        """
+        self.store = get_store() if store is None else store
+        self.screen_size = tuple(self.store.get('screen_size'))  # (width, height)
+        self.camera_size = tuple(self.store.get('camera_size'))   # (width, height)
+        self.camera_index = self.store.get('devices', 'camera_index')
+        self.display_offset_x = self.store.get('devices', 'display_offset_x')
         self.key_quit = 'q'
-        self.aruco_dict = cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_ARUCO_ORIGINAL)
-        self.update_piano_corners_freq = 5  # Number of frames to update piano corners
         self.img_to_project = np.zeros((self.camera_size[1], self.camera_size[0], 3), np.uint8)
-        # self.display = Display(screen_width=self.screen_size[0])
-        self.piano = Piano()
+        self.display = None
+        self.sound = None
+        cam_mtx, dist_coeffs = self.store.get_camera_intrinsics()
+        self.undistort_mode = undistort_mode if cam_mtx is not None else None
+        self.undistorter = None
+        if self.undistort_mode is not None:
+            self.undistorter = Undistorter(cam_mtx, dist_coeffs, self.camera_size)
+        self.layout = KeyboardLayout.from_config(self.store.get('piano'))
+        self.piano_kwargs = {'image_size': self.camera_size,
+                             'layout': self.layout,
+                             'undistorter': self.undistorter if self.undistort_mode == 'points' else None}
+        self.piano = Piano(**self.piano_kwargs)
+        note_names = tuple(x['note'] for x in self.piano.key_list)
+        if resources is None:
+            resources = SharedResources(note_names)
+        elif resources.note_names != note_names:
+            raise ValueError("The shared resources are of other piano keys")
+        self.resources = resources
+        self.aruco_dict_id = resources.aruco_dict_id
+        self.aruco_dict = resources.aruco_dict
         self.cam_to_proj = None  # Transformation from camera to projector coordinates
-        self.song = ["C#4", "C4", "F#5", "B4", "G5", "E5", "E5", "br", "F5", "D5", "D5", "br", "C5", "D5", "E5", "F5", "G5", "G5", "G5",
-         "br","G5", "E5", "E5", "br", "F5", "D5", "D5", "br", "C5", "E5", "G5", "G5", "C5"]
-
-    def calibrate_cam_to_proj(self):
-        self.cam_to_proj = calibrate_projector(screen_size=self.screen_size, aruco_dict=self.aruco_dict)
-
-    def run(self):
-        self.calibrate_cam_to_proj()
-        display = Display(screen_width=self.screen_size[0])
-        sound = Sound(wav_directory="wav")
-        cap = cv2.VideoCapture(1)
-        frame_num = 0
-        note_num = 0    # note index in the song
-        is_initial_song_played = True  # Flag which indicate if we did first play of the song
-        is_clicked = False   # Flag which indicate if user pressed on key
-        history_frame_num = 10
-        erode_kernel = np.ones((5, 5), np.uint8)
-        history_pts = None
-        aruco_detect_params = cv2.aruco.DetectorParameters_create()
-        aruco_detect_params.doCornerRefinement = True
-        fgbg = cv2.createBackgroundSubtractorMOG2(history=4, varThreshold=50.0, detectShadows=False)
-        while True:
-            # Get an image from camera
-            img = self._get_image(cap_obj=cap)
-            frame_num += 1
-            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-            fgmask = fgbg.apply(gray)  # Add to background subtraction model
-
-            # Find the piano board AruCo markers
-            corners, ids, rejectedImgPoints = cv2.aruco.detectMarkers(gray, self.aruco_dict, parameters=aruco_detect_params)
-            cv2.aruco.drawDetectedMarkers(img, corners, ids)
-
-            # Display image for debug
-            img_debug = img.copy()
-            cv2.putText(img_debug, "%d" % frame_num, (8, 25), cv2.FONT_HERSHEY_PLAIN, 1.5, (0, 255, 0))
-            cv2.imshow('camera', img_debug)
-
-            # If no markers were found continue to next frame
-            if ids is None:
-                continue
+        self.verify_calibration = False  # Check a stored calibration against the projected board before using it
+        self.renderer = None  # Draws and caches the projector frames
+        self.songbook = resources.songbook
+        self.song = None  # List of NoteEvent
+        self.song_tempo_bpm = None
+        self.load_song("default")
+        self.scheduler = None
+        self.stats = PipelineStats()  # Per-stage timing and queue drop counters
+        self.stats_print_freq = 300  # Number of processed frames between stats prints. None to disable.
+        self.show_windows = True  # Show the OpenCV debug windows. Set to False to run headless.
+        self.press_log = []  # (frame number, note name) of every detected key press
+        self.tracer = Tracer(enabled=False)  # Per-frame latency tracing. Set tracer.enabled to use it.
+        self.controller = AdaptiveController(target_fps=30.0)  # Steps down the processing cost under load
+        self.bg_model = self.store.get('processing', 'bg_model')  # Name of a background.MODELS model
+        self.press_detector_name = self.store.get('processing', 'press_detector')  # Name of a detection.DETECTORS
+        self.bg_padding_px = 10  # Padding of the piano bounding box, in which the background is modelled
+        # Subtract the predicted projector light from the frames, so presses are detected right after the projected
+        # key changes. If False, press detection waits for the background model to learn the new projection.
+        self.compensate_projector_light = True
+        self.light_model = None  # ProjectorLightModel of the current run, or None if the light is not compensated
+        self.score_log_dir = None  # Directory of the per-session score logs. None to not write them.
+        self.scorer = None  # ScoreKeeper of the current run
+        self.is_running = False
 
-            # If we found the piano markers
-            if len(ids) > 0:
-                if frame_num % self.update_piano_corners_freq == 0:
-                    self.piano.update_coordinates(corners, ids)
-
-            # Project a key
-            self.img_to_project.fill(0)
-            if self.piano.is_initialize():
-                if self.song[note_num] != 'br':
-                    # If note is not break
-                    piano_key_ind = self.piano.get_key_index_by_name(self.song[note_num])
-                    pts = self.piano.get_key_polygon(piano_key_ind)
-                    if not(is_initial_song_played):
-                        color = self.piano.get_key_color(piano_key_ind)
-                    else:
-                        color = (0, 0, 255)
-                    cv2.fillPoly(self.img_to_project, [pts], color, cv2.LINE_AA)
-                    x = int((pts[0, 0, 0] + pts[1, 0, 0]) / 2.0 - 5)
-                    y = int((pts[0, 0, 1] + pts[1, 0, 1]) / 2.0 - 10)
-
-                    cv2.putText(self.img_to_project, "%s" % self.song[note_num], (x, y), cv2.FONT_HERSHEY_COMPLEX, 0.5, (0, 255, 0))
-
-                    # cv2.putText(self.img_to_project, "%d" % piano_key_ind, tuple(pts[3, 0, :]),
-                    #             cv2.FONT_HERSHEY_PLAIN, 1.5, (255, 0, 0))
-
-                else:
-                    if is_initial_song_played:
-                        is_clicked = True
-
-                # Play sound
-                if not(is_initial_song_played):
-                    # Play note sound
-                    sound.play_note_sound(self.song[note_num])
-
-                    # Advance to the next note
-                    time.sleep(0.5)
-                    note_num += 1
-                    history_frame_num = frame_num
-                else:
-                    if is_clicked:
-                        sound.play_note_sound(self.song[note_num])
-                        time.sleep(0.5)
-                        note_num += 1
-                        is_clicked = False
-                        history_frame_num = frame_num
-                        # history_pts = pts
-
-                # Check if song has ended
-                if note_num >= len(self.song):
-                    print("Song Finished!")
-                    time.sleep(0.5)
-                    if not(is_initial_song_played):
-                        is_initial_song_played = True
-                        note_num = 0
-                    else:
-                        break
+    def load_song(self, name):
+        """ Set the song to play from the songbook
+
+        :param name: Song name, the file name in the songs directory without the extension
+        """
+        song = self.resources.get_song(name)
+        self.song = song.to_note_events()
+        self.song_tempo_bpm = song.tempo_bpm
 
-            # Plot debug image
-            # cv2.imshow('img_to_project', self.img_to_project)
-
-            # Detect key press
-            if frame_num > history_frame_num + 7:
-                key_mask = cv2.cvtColor(self.img_to_project, cv2.COLOR_BGR2GRAY) > 5
-                key_mask = np.uint8(key_mask) * 255
-                key_mask = cv2.erode(key_mask, erode_kernel)
-                key_mask = key_mask.astype(bool)
-                fgmask[~key_mask] = 0
-                num_pixels_in_key = np.sum(key_mask)
-                num_pixels_changed = np.sum(fgmask > 0)
-                frac_pixels_changed = float(num_pixels_changed) / float(num_pixels_in_key)
-                if frac_pixels_changed > 0.05:
-                    print("Key clicked | Num pixels = %d | fraction = %.3f" % (num_pixels_changed, frac_pixels_changed))
-                    is_clicked = True
-                cv2.imshow('background_mask', fgmask)
+    def calibrate_cam_to_proj(self, force=False):
+        """ Load the camera to projector calibration from the store, or calibrate if it is not valid
+
+        :param force: If True, calibrate even if there is a stored calibration
+        """
+        self.cam_to_proj = calibrate_projector(screen_size=self.screen_size, aruco_dict=self.aruco_dict, auto=True,
+                                               store=self.store, force=force, camera_index=self.camera_index,
+                                               camera_size=self.camera_size,
+                                               display_offset_x=self.display_offset_x,
+                                               verify=self.verify_calibration)
+
+    def get_stored_cam_to_proj(self):
+        """ :return: The stored camera to projector calibration of this setup, or None """
+        setup_hash = get_calibration_setup_hash(self.screen_size, self.aruco_dict, self.camera_index, self.camera_size)
+        return self.store.get_projector_calibration(setup_hash)[0]
+
+    def run(self, pipelined=False, cap=None, display=None, sound=None, use_workers=False):
+        """ Run the interactive piano.
+
+        :param pipelined: If True, camera capture and frame processing run on their own threads, and
+            rendering runs on the main thread, so the cost of the stages overlap. Processing always
+            works on the newest camera frame and older frames are dropped.
+        :param use_workers: If True, marker tracking and press detection run in worker processes, which get
+            the frames through shared memory (see workers.py). The adaptive load control and the projector light
+            compensation are not used.
+        :param cap: Capture object with read() and release(), like capture.SessionPlayer. The camera if None.
+        :param display: Display object, like media.HeadlessDisplay. The projector if None.
+        :param sound: Sound object, like media.HeadlessSound. The wav files if None.
+        """
+        cap = self.open_session(cap, display, sound)
+        try:
+            if use_workers:
+                self._run_workers(cap)
+            elif pipelined:
+                self._run_pipelined(cap)
             else:
-                if history_pts is not None:
-                   cv2.fillPoly(self.img_to_project, [history_pts], (0, 255, 0), cv2.LINE_AA)
+                self._run_serial(cap)
+        finally:
+            self.close_session(cap)
 
-            # Transform image to projector coordinates
-            dst = cv2.warpPerspective(self.img_to_project, self.cam_to_proj, self.screen_size)
-            dst = cv2.cvtColor(dst, cv2.COLOR_BGR2RGB)
-            display.show_array(dst)
+    def open_session(self, cap=None, display=None, sound=None):
+        """ Prepare a run. run() does it, and a host which drives the manager frame by frame calls it itself,
+            then capture_step(), process_step() and render_step() for every frame, and close_session().
 
-            # Wait for key from user
-            key = cv2.waitKey(1)
-            if key & 0xFF == ord(self.key_quit):
-                break
+        :param cap: Like in run()
+        :param display: Like in run()
+        :param sound: Like in run()
+        :return: The capture object
+        """
+        if self.cam_to_proj is None:
+            self.calibrate_cam_to_proj()
+        self.renderer = ProjectorRenderer(self.cam_to_proj, self.screen_size)
+        if display is None:
+            display = Display(screen_width=self.display_offset_x, zero_copy=True)
+        self.display = display
+        self.sound = Sound(wav_directory="wav") if sound is None else sound
+        cap = cv2.VideoCapture(self.camera_index) if cap is None else cap
+        self._reset_session()
+        self.stats = PipelineStats()
+        return cap
 
+    def close_session(self, cap):
         # When everything done, release the capture
+        print(self.stats.summary())
+        print(self.scorer.summary_text())
+        if self.scorer.log is not None:
+            self.scorer.log.close(self.scorer.summary())
         cap.release()
-        cv2.destroyAllWindows()
-        display.close()
+        if self.show_windows:
+            cv2.destroyAllWindows()
+        self.display.close()
+
+    def capture_step(self, cap):
+        """ :return: (frame id, image), or None at the end of the capture """
+        with self.stats.timer('capture'):
+            return self._capture_stage(cap)
+
+    def process_step(self, item):
+        """ :param item: (frame id, image) from capture_step()
+            :return: dictionary like _process_frame
+        """
+        with self.stats.timer('process'):
+            return self._process_frame(*item)
+
+    def render_step(self, result):
+        """ :param result: dictionary from process_step()
+            :return: False if the run ended
+        """
+        if not self.is_running:
+            return False
+        render_timer = self.stats.timer('render')
+        with render_timer:
+            if not self._render_frame(result):
+                return False
+        self.controller.update(self.stats.timer('process').last + render_timer.last, self.frame_num)
+        return True
+
+    def _run_serial(self, cap):
+        while self.is_running:
+            # Get an image from camera
+            item = self.capture_step(cap)
+            if item is None:
+                break
+            if not self.render_step(self.process_step(item)):
+                break
+
+    def _run_pipelined(self, cap):
+        frames_queue = LatestFrameQueue(maxsize=1)
+        results_queue = LatestFrameQueue(maxsize=1)
+        self.stats.add_queue('capture->process', frames_queue)
+        self.stats.add_queue('process->render', results_queue)
+        stop_event = threading.Event()
+        threads = [StageThread('capture', lambda _: self._capture_stage(cap), None, frames_queue,
+                               self.stats.timer('capture'), stop_event),
+                   StageThread('process', self._process_stage, frames_queue, results_queue,
+                               self.stats.timer('process'), stop_event)]
+        process_timer = self.stats.timer('process')
+        render_timer = self.stats.timer('render')
+        for t in threads:
+            t.start()
+        try:
+            # OpenCV and pygame windows must be handled from the main thread
+            while self.is_running and not stop_event.is_set():
+                result = results_queue.get(timeout=0.1)
+                if result is None:
+                    continue
+                with render_timer:
+                    if not self._render_frame(result):
+                        break
+                # The slowest stage sets the frame rate
+                self.controller.update(max(process_timer.last, render_timer.last), self.frame_num)
+        finally:
+            stop_event.set()
+            frames_queue.close()
+            results_queue.close()
+            for t in threads:
+                t.join()
+        for t in threads:
+            if t.error is not None:
+                raise t.error
+
+    def _run_workers(self, cap):
+        width, height = self.camera_size
+        # The press worker does not get the projection
+        self.light_model = None
+        ctx = multiprocessing.get_context('spawn')
+        # The fingertip detector segments the hand by colour, so the workers get colour frames for it
+        is_color = self.press_detector_name == 'fingertip'
+        ring = workers.SharedFrameRing((height, width, 3) if is_color else (height, width))
+        marker_queue = ctx.Queue()
+        press_queue = ctx.Queue()
+        events_queue = ctx.Queue()
+        processes = [
+            ctx.Process(target=workers.marker_worker, name='markers', daemon=True,
+                        args=(ring.name, ring.shape, ring.num_slots, marker_queue, events_queue, self.aruco_dict_id,
+                              self.piano_kwargs)),
+            ctx.Process(target=workers.press_worker, name='presses', daemon=True,
+                        args=(ring.name, ring.shape, ring.num_slots, press_queue, events_queue, self.piano_kwargs,
+                              self.bg_model, self.bg_padding_px, self.press_detector_name,
+                              self.press_threshold))]
+        for p in processes:
+            p.start()
+        capture_timer = self.stats.timer('capture')
+        process_timer = self.stats.timer('process')
+        render_timer = self.stats.timer('render')
+        try:
+            while self.is_running:
+                with capture_timer:
+                    item = self._capture_stage(cap)
+                if item is None:
+                    break
+                with process_timer:
+                    frame_id, img = item
+                    if self.undistort_mode == 'frames':
+                        img = self.undistorter.undistort_image(img)
+                    ring.write(frame_id, img if is_color else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY))
+                    marker_queue.put(frame_id)
+                    press_queue.put((frame_id, self.frame_num + 1 > self.history_frame_num + 7))
+                    result = self._process_worker_events(frame_id, img, events_queue, press_queue)
+                if not self.is_running:
+                    break
+                with render_timer:
+                    if not self._render_frame(result):
+                        break
+        finally:
+            marker_queue.put(None)
+            press_queue.put(None)
+            for p in processes:
+                p.join(timeout=2.0)
+                if p.is_alive():
+                    p.terminate()
+            for q in [marker_queue, press_queue, events_queue]:
+                q.cancel_join_thread()
+            ring.close()
+
+    def _process_worker_events(self, frame_id, img, events_queue, press_queue):
+        """ Like _process_frame, with the piano pose and the key events which came from the workers since the
+            last frame.
+
+        :return: dictionary like _process_frame
+        """
+        self.frame_num += 1
+        result = {'frame_id': frame_id, 'img_debug': None, 'fgmask': None, 'img_to_project': None, 'projection': None}
+        img_debug = img.copy()
+        cv2.putText(img_debug, "%d" % self.frame_num, (8, 25), cv2.FONT_HERSHEY_PLAIN, 1.5, (0, 255, 0))
+        result['img_debug'] = img_debug
+
+        key_events = []
+        while True:
+            try:
+                event = events_queue.get_nowait()
+            except queue.Empty:
+                break
+            if event[0] == workers.ERROR:
+                raise RuntimeError("Error in the %s worker:\n%s" % (event[1], event[2]))
+            if event[0] == workers.POSE:
+                _, pose_frame_id, self.num_visible_markers, board_to_image, geometry_version = event
+                if board_to_image is not None:
+                    self.piano.set_pose(board_to_image, geometry_version)
+                    press_queue.put((workers.POSE, board_to_image, geometry_version))
+            elif event[0] == workers.KEYS:
+                key_events.append(event)
+
+        if not self._advance_song(frame_id):
+            return result
+
+        # If no markers were found continue to next frame
+        if self.num_visible_markers == 0:
+            return result
+
+        drawings, piano_key_ind, event = self._draw_projection()
+        for _, key_frame_id, events in key_events:
+            self._handle_key_events(key_frame_id, events, piano_key_ind, event)
+        self.tracer.mark(frame_id, 'detect')
+        return self._finish_result(result, drawings)
+
+    def _capture_stage(self, cap):
+        """ :return: (frame id, image), or None at the end of the capture """
+        img = self._get_image(cap_obj=cap)
+        if img is None:
+            # End of the recorded session, or the camera stopped
+            self.is_running = False
+            return None
+        self.capture_num += 1
+        self.tracer.mark(self.capture_num, 'capture')
+        return self.capture_num, img
+
+    def _process_stage(self, item):
+        result = self._process_frame(*item)
+        if result['img_to_project'] is not None:
+            # The render thread uses the image while we draw the next one
+            result['img_to_project'] = result['img_to_project'].copy()
+        if result['fgmask'] is not None:
+            result['fgmask'] = result['fgmask'].copy()
+        return result
+
+    def _reset_session(self):
+        """ Reset the state of the song and the detectors before a run """
+        self.is_running = True
+        self.frame_num = 0
+        self.capture_num = 0
+        self.press_log = []
+        self.is_initial_song_played = True  # Flag which indicate if we did first play of the song
+        self.scheduler = NoteScheduler(self.song, self.sound, tempo_bpm=self.song_tempo_bpm)
+        song_notes = [x for x in self.song if x.note is not None]
+        log = None
+        if self.score_log_dir is not None:
+            log = ScoreLog(os.path.join(self.score_log_dir, time.strftime("%Y%m%d_%H%M%S") + ".score"))
+        self.scorer = ScoreKeeper([self.piano.get_key_index_by_name(x.note) for x in song_notes],
+                                  [x.onset for x in song_notes], self.song_tempo_bpm, log=log)
+        self.history_frame_num = 10
+        self.press_threshold = 0.05
+        self.press_detector = create_detector(self.press_detector_name, len(self.piano.key_list),
+                                              press_threshold=self.press_threshold)
+        self.aruco_detect_params = self.resources.aruco_detect_params
+        self.marker_tracker = MarkerTracker(self.aruco_dict, self.aruco_detect_params, self.piano.markers_ids)
+        self.bg_subtractor = RegionBackgroundSubtractor(self.camera_size, model=self.bg_model)
+        self.light_model = ProjectorLightModel(self.camera_size) if self.compensate_projector_light else None
+        self.controller.reset()
+        self.last_render_key = None
+        self.num_skipped_renders = 0
+        self.num_visible_markers = 0  # Markers found by the marker worker in its last frame
+
+    def _process_frame(self, frame_id, img):
+        """ Detect the piano, advance the song and detect key press on a single camera frame.
+
+        :param frame_id: Id of the camera frame, for tracing
+        :param img: Camera image (BGR)
+        :return: dictionary with the images to render:
+            'frame_id' - the camera frame id,
+            'img_debug' - camera image with the detected markers,
+            'fgmask' - background mask of the projected key, or None if press detection did not run,
+            'img_to_project' - image of the projected keys in camera coordinates, or None if no markers were found,
+            'projection' - (KeyDrawing tuple, piano geometry version) describing the projector frame, or None if
+            no markers were found.
+        """
+        self.frame_num += 1
+        result = {'frame_id': frame_id, 'img_debug': None, 'fgmask': None, 'img_to_project': None, 'projection': None}
+        if self.undistort_mode == 'frames':
+            img = self.undistorter.undistort_image(img)
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+        # Apply the load level
+        level = self.controller.level
+        self.marker_tracker.scale = level.aruco_scale
+        self.marker_tracker.interval = level.marker_interval
+        # Only the pixels of the keys matter, so the background is modelled in the piano bounding box
+        # of the last frame. The model restarts when the board moves.
+        if self.bg_subtractor.set_region(self.piano.get_bounding_box(self.bg_padding_px), level.bg_scale):
+            # Wait for the new model to learn the background before detecting presses
+            self.history_frame_num = self.frame_num
+        if self.light_model is not None:
+            # Add to background subtraction model without the light of our own projection
+            fgmask = self.bg_subtractor.apply(self.light_model.compensate(gray, self.frame_num))
+        else:
+            fgmask = self.bg_subtractor.apply(gray)  # Add to background subtraction model
+
+        # Find the piano board AruCo markers. Once all were found, only the regions around them are searched.
+        corners, ids = self.marker_tracker.detect(gray)
+
+        # Image for debug. The camera image is kept clean for the press detector.
+        img_debug = img.copy()
+        cv2.aruco.drawDetectedMarkers(img_debug, corners, ids)
+        cv2.putText(img_debug, "%d" % self.frame_num, (8, 25), cv2.FONT_HERSHEY_PLAIN, 1.5, (0, 255, 0))
+        result['img_debug'] = img_debug
+
+        # If we found the piano markers, update the piano pose
+        if ids is not None and len(ids) > 0:
+            self.piano.update_coordinates(corners, ids)
+
+        if not self._advance_song(frame_id):
+            return result
+
+        # If no markers were found continue to next frame
+        if ids is None:
+            return result
+
+        # Project a key
+        drawings, piano_key_ind, event = self._draw_projection()
+        if self.light_model is not None:
+            self.light_model.set_projection(self.img_to_project, self.frame_num,
+                                            get_projection_key(drawings, self.piano.geometry_version))
+
+        # Detect key press on all the keys
+        if self.frame_num > self.history_frame_num + 7 and self.piano.is_initialize():
+            if self.light_model is not None:
+                unstable = self.light_model.get_unstable_mask(self.frame_num)
+                if unstable is not None:
+                    # The projection of these pixels may be changing in this frame
+                    fgmask = cv2.bitwise_and(fgmask, cv2.bitwise_not(unstable))
+            with self.stats.timer('detect'):
+                key_events = self.press_detector.update(fgmask, self.piano.get_label_map(),
+                                                        self.piano.geometry_version, img=img)
+            self._handle_key_events(frame_id, key_events, piano_key_ind, event)
+            result['fgmask'] = fgmask
+        self.tracer.mark(frame_id, 'detect')
+        return self._finish_result(result, drawings)
+
+    def _advance_song(self, frame_id):
+        """ Advance the song according to the clock
+
+        :param frame_id: Id of the camera frame, for tracing the automatically played notes
+        :return: False if the run ended
+        """
+        if not self.piano.is_initialize():
+            return True
+        if not self.scheduler.is_started():
+            self._start_song(wait_for_press=self.is_initial_song_played)
+        self.scorer.update()
+        if self.scheduler.update() and self.light_model is None:
+            # The projected key changed. Wait for the background model to learn it.
+            self.history_frame_num = self.frame_num
+        self._mark_played_notes(frame_id)
+
+        # Check if song has ended
+        if self.scheduler.is_finished():
+            print("Song Finished!")
+            if not(self.is_initial_song_played):
+                self.is_initial_song_played = True
+                self._start_song(wait_for_press=True)
+                self.history_frame_num = self.frame_num
+            else:
+                self.is_running = False
+                return False
+        return True
+
+    def _start_song(self, wait_for_press):
+        self.scheduler.start(wait_for_press=wait_for_press)
+        # When the song waits for every press, only the order of the notes is scored, not their time
+        self.scorer.strict_timing = not wait_for_press
+        self.scorer.start(self.scheduler.t0)
+
+    def _draw_projection(self):
+        """ Draw the projected key in img_to_project
+
+        :return: (list of KeyDrawing, index of the projected key or None, current NoteEvent or None)
+        """
+        self.img_to_project.fill(0)
+        drawings = []
+        piano_key_ind = None
+        event = self.scheduler.current_event
+        if self.piano.is_initialize() and event is not None and event.note is not None:
+            # If note is not break
+            piano_key_ind = self.piano.get_key_index_by_name(event.note)
+            pts = self.piano.get_key_polygon(piano_key_ind)
+            if not(self.is_initial_song_played):
+                color = self.piano.get_key_color(piano_key_ind)
+            else:
+                color = (0, 0, 255)
+            cv2.fillPoly(self.img_to_project, [pts], color, cv2.LINE_AA)
+            x = int((pts[0, 0, 0] + pts[1, 0, 0]) / 2.0 - 5)
+            y = int((pts[0, 0, 1] + pts[1, 0, 1]) / 2.0 - 10)
+
+            cv2.putText(self.img_to_project, "%s" % event.note, (x, y), cv2.FONT_HERSHEY_COMPLEX, 0.5, (0, 255, 0))
+            if self.undistort_mode == 'frames':
+                # The projector calibration is of the raw camera image
+                pts = np.round(self.undistorter.distort_points(pts)).astype(np.int32)
+                x, y = np.round(self.undistorter.distort_points(np.array([x, y], float))).astype(int)
+            drawings.append(KeyDrawing(piano_key_ind, tuple(color), event.note, pts, (int(x), int(y))))
+
+            # cv2.putText(self.img_to_project, "%d" % piano_key_ind, tuple(pts[3, 0, :]),
+            #             cv2.FONT_HERSHEY_PLAIN, 1.5, (255, 0, 0))
+
+        # Plot debug image
+        # cv2.imshow('img_to_project', self.img_to_project)
+        return drawings, piano_key_ind, event
+
+    def _handle_key_events(self, frame_id, key_events, piano_key_ind, event):
+        """ Play the projected key if it was pressed
+
+        :param frame_id: Id of the camera frame of the events, for tracing
+        :param key_events: List of detection.KeyEvent
+        :param piano_key_ind: Index of the projected key, or None
+        :param event: Current scheduler.NoteEvent, or None
+        """
+        for key_event in key_events:
+            if not key_event.is_press:
+                continue
+            note = self.piano.key_list[key_event.key_ind]['note']
+            self.tracer.mark(frame_id, 'press')
+            print("Key clicked | %s | fraction = %.3f" % (note, key_event.fraction))
+            self.press_log.append((self.frame_num, note))
+            self.scorer.press(key_event.key_ind)
+            if key_event.key_ind == piano_key_ind:
+                self.scheduler.press()
+                self._mark_played_notes(frame_id)
+            elif piano_key_ind is not None:
+                print("Wrong key | expected %s" % event.note)
+
+    def _mark_played_notes(self, frame_id):
+        """ Trace the sound of the notes the scheduler played, pressed or automatically
+
+        :param frame_id: Id of the camera frame which caused them
+        """
+        for _ in self.scheduler.pop_played():
+            self.tracer.mark(frame_id, 'sound')
+
+    def _finish_result(self, result, drawings):
+        result['img_to_project'] = self.img_to_project
+        result['projection'] = (tuple(drawings), self.piano.geometry_version)
+
+        if self.stats_print_freq and self.frame_num % self.stats_print_freq == 0:
+            print(self.stats.summary())
+            print(self.controller.summary())
+            print(self.scorer.summary_text())
+        return result
+
+    def _render_frame(self, result):
+        """ Show the debug windows and project the key image.
+
+        :param result: dictionary returned by _process_frame
+        :return: False if the user asked to quit
+        """
+        # Under load, skip the frames which would show the same projection
+        if self.controller.level.skip_unchanged_render and result['projection'] is not None:
+            render_key = get_projection_key(*result['projection'])
+            if render_key == self.last_render_key:
+                self.num_skipped_renders += 1
+                return self._poll_quit()
+            self.last_render_key = render_key
+
+        # Display image for debug
+        if self.show_windows:
+            cv2.imshow('camera', result['img_debug'])
+            if result['fgmask'] is not None:
+                cv2.imshow('background_mask', result['fgmask'])
+
+        if result['projection'] is not None:
+            # Get the frame in projector coordinates. Show it only if it changed.
+            frame, is_changed = self.renderer.render(*result['projection'])
+            if is_changed:
+                self.display.show_array(frame)
+                self.tracer.mark(result['frame_id'], 'flip')
+        return self._poll_quit()
+
+    def _poll_quit(self):
+        """ Wait for key from user
+
+        :return: False if the user asked to quit
+        """
+        if not self.show_windows:
+            return True
+        key = cv2.waitKey(1)
+        return not (key & 0xFF == ord(self.key_quit))
 
     def _get_image(self, cap_obj, debug_transformation=False):
         """ Get image from camera
@@ -162,16 +613,18 @@ class Manager(object):
         # for w in range(1):
         #     cap_obj.grab()
         ret, img = cap_obj.read()
+        if not ret:
+            return None
 
         # Test camera-to-projector transformation by projecting camera image
         # back through projector
         if debug_transformation:
             # Transform image to projector for debug
             dst = cv2.warpPerspective(img, self.cam_to_proj, self.screen_size)
-            self.display.show_array(dst)
+            self.display.show_array(dst, is_bgr=True)
             cv2.imshow('debug', img)
         return img
 
 if __name__ == "__main__":
-    manager = Manager()
-    manager.run()
+    from cli import main
+    main()
@@ -1,20 +1,67 @@
 from __future__ import print_function
+import hashlib
+import json
 import os
 import numpy as np
-import pygame
 import time
 import cv2
 
+pygame = None  # Imported when a Display or Sound is created, so the module loads fast and headless
 
-def calibrate_projector(screen_size, aruco_dict):
-    """ Calibrate projector to camera.
-        Finds the Homography between the coordinate systems.
-    :param screen_size: (x,y). Should be (1366, 768)
-    :param aruco_dict: OpenCV's AruCo dictionary type. From: cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_ARUCO_ORIGINAL)
-    :return:
+
+def _import_pygame():
+    global pygame
+    if pygame is None:
+        import pygame as _pygame
+        pygame = _pygame
+
+
+# Parameters of the AruCo grid board projected for calibration
+CALIBRATION_BOARD = {'markers_x': 9, 'markers_y': 6, 'marker_length': 0.025, 'marker_separation': 0.0125}
+
+
+def get_calibration_setup_hash(screen_size, aruco_dict, camera_index, camera_size=None):
+    """ Hash of everything the projector calibration depends on, except the physical placement.
+
+    :return: Hex string
+    """
+    setup = {'screen_size': list(screen_size), 'board': CALIBRATION_BOARD, 'camera_index': camera_index,
+             'camera_size': None if camera_size is None else list(camera_size)}
+    h = hashlib.sha1(json.dumps(setup, sort_keys=True).encode('utf-8'))
+    bytes_list = getattr(aruco_dict, 'bytesList', None)
+    if bytes_list is not None:
+        h.update(np.ascontiguousarray(bytes_list).tobytes())
+    return h.hexdigest()
+
+
+def find_cam_to_proj(cam_points, proj_points, ransac_threshold=3.0):
+    """ Robust homography from camera to projector points.
+        Uses MAGSAC when OpenCV has it, otherwise RANSAC.
+
+    :param cam_points: (N, 2) points in the camera image
+    :param proj_points: (N, 2) matching points in the projector image
+    :param ransac_threshold: Maximal reprojection error of an inlier, in projector pixels
+    :return: (cam_to_proj, RMS reprojection error of the inliers, number of inliers). cam_to_proj is None if
+        it could not be found.
     """
+    if len(cam_points) < 4:
+        return None, None, 0
+    method = getattr(cv2, 'USAC_MAGSAC', cv2.RANSAC)
+    cam_to_proj, inliers = cv2.findHomography(cam_points, proj_points, method, ransac_threshold)
+    if cam_to_proj is None:
+        return None, None, 0
+    inliers = inliers.ravel().astype(bool)
+    projected = cv2.perspectiveTransform(cam_points[inliers].reshape(-1, 1, 2), cam_to_proj).reshape(-1, 2)
+    reproj_error = float(np.sqrt(np.mean(np.sum((projected - proj_points[inliers]) ** 2, axis=1))))
+    return cam_to_proj, reproj_error, int(inliers.sum())
+
+
+def _get_calibration_board(screen_size, aruco_dict):
+    """ :return: (RGB image of the calibration board, marker ID -> (4, 2) marker corners in the projector image) """
     # Create grid board with AruCo markers
-    board = cv2.aruco.GridBoard_create(9, 6, 0.025, .0125, aruco_dict)
+    board = cv2.aruco.GridBoard_create(CALIBRATION_BOARD['markers_x'], CALIBRATION_BOARD['markers_y'],
+                                       CALIBRATION_BOARD['marker_length'], CALIBRATION_BOARD['marker_separation'],
+                                       aruco_dict)
     img_board = board.draw((screen_size[0]-200, screen_size[1]-100))
     img_board = np.pad(img_board, pad_width=10, mode='constant', constant_values=255)
     img_board_rgb = np.dstack((img_board, img_board, img_board))
@@ -22,83 +69,228 @@ def calibrate_projector(screen_size, aruco_dict):
     # Detect markers on projector image
     corners_proj, ids_proj, rejectedImgPoints = cv2.aruco.detectMarkers(img_board, aruco_dict)
     ids_proj = ids_proj.flatten()
-    # cv2.aruco.drawDetectedMarkers(img_board_rgb, corners_proj, ids_proj)
-    # plt.figure(), plt.imshow(img_board_rgb)
-    # plt.show()
+    proj_corners_by_id = dict((marker_id, corners_proj[i][0]) for i, marker_id in enumerate(ids_proj))
+    return img_board_rgb, proj_corners_by_id
+
+
+def _match_calibration_markers(gray, aruco_dict, aruco_detect_params, proj_corners_by_id):
+    """ Detect the projected board markers in a camera image.
+
+    :return: (marker corners, marker IDs or None if no markers were found, (N, 2) camera points, (N, 2) matching
+        projector points)
+    """
+    corners_cam, ids_cam, rejectedImgPoints = cv2.aruco.detectMarkers(gray, aruco_dict, parameters=aruco_detect_params)
+    if ids_cam is None:
+        return corners_cam, None, np.zeros((0, 2), np.float32), np.zeros((0, 2), np.float32)
+    ids_cam = ids_cam.flatten()
+    ids_intersection = [x for x in ids_cam if x in proj_corners_by_id]
+    if len(ids_intersection) == 0:
+        return corners_cam, ids_cam, np.zeros((0, 2), np.float32), np.zeros((0, 2), np.float32)
+    cam = np.vstack([corners_cam[np.flatnonzero(ids_cam == x)[0]][0] for x in ids_intersection])
+    proj = np.vstack([proj_corners_by_id[x] for x in ids_intersection])
+    return corners_cam, ids_cam, cam.astype(np.float32), proj.astype(np.float32)
+
+
+def verify_projector_calibration(cam_to_proj, screen_size, aruco_dict, camera_index=1, display_offset_x=1366,
+                                 num_frames=10, max_wait_frames=60):
+    """ Project the calibration board and measure the error of a camera to projector homography on it.
+
+    :param cam_to_proj: Camera to projector homography to check
+    :param num_frames: Number of frames with detected markers to measure on
+    :param max_wait_frames: Give up after this many camera frames
+    :return: RMS reprojection error in projector pixels, or None if the board was not seen
+    """
+    img_board_rgb, proj_corners_by_id = _get_calibration_board(screen_size, aruco_dict)
+    display = Display(screen_width=display_offset_x)
+    display.show_array(img_board_rgb)
+    aruco_detect_params = cv2.aruco.DetectorParameters_create()
+    aruco_detect_params.doCornerRefinement = True
+    cam_to_proj = np.asarray(cam_to_proj, np.float64)
+    sq_errors = []
+    num_found = 0
+    cap = cv2.VideoCapture(camera_index)
+    try:
+        for _ in range(max_wait_frames):
+            ret, img = cap.read()
+            if not ret:
+                break
+            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+            _, _, cam, proj = _match_calibration_markers(gray, aruco_dict, aruco_detect_params, proj_corners_by_id)
+            if len(cam) == 0:
+                continue
+            projected = cv2.perspectiveTransform(cam.reshape(-1, 1, 2).astype(np.float64), cam_to_proj)
+            sq_errors.append(np.sum((projected.reshape(-1, 2) - proj) ** 2, axis=1))
+            num_found += 1
+            if num_found >= num_frames:
+                break
+    finally:
+        cap.release()
+        display.close()
+    if not sq_errors:
+        return None
+    return float(np.sqrt(np.mean(np.concatenate(sq_errors))))
+
+
+def calibrate_projector(screen_size, aruco_dict, auto=False, max_reproj_error=1.0, min_frames=10, max_frames=300,
+                        stable_frames=5, max_points=20000, store=None, force=False, camera_index=1,
+                        camera_size=None, display_offset_x=1366, verify=False, max_verify_error=5.0):
+    """ Calibrate projector to camera.
+        Finds the Homography between the coordinate systems.
+        Marker corners are accumulated over frames and the homography is found with outlier rejection.
+    :param screen_size: (x,y). Should be (1366, 768)
+    :param aruco_dict: OpenCV's AruCo dictionary type. From: cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_ARUCO_ORIGINAL)
+    :param auto: If True, stop by itself once the reprojection error converged. Otherwise wait for 'c' key.
+    :param max_reproj_error: In auto mode, RMS reprojection error in projector pixels under which to stop
+    :param min_frames: In auto mode, minimal number of frames to accumulate
+    :param max_frames: In auto mode, stop after this many frames with the best result so far
+    :param stable_frames: In auto mode, number of consecutive frames the error must stay under max_reproj_error
+    :param max_points: Maximal number of accumulated correspondences. Older ones are dropped.
+    :param store: config.ConfigStore to load the calibration from and save it to. None to always calibrate.
+    :param force: If True, calibrate even if there is a stored calibration
+    :param camera_index: OpenCV camera index
+    :param camera_size: Camera (width, height), part of the setup of the stored calibration
+    :param display_offset_x: x where the projector screen starts, like Display's screen_width
+    :param verify: If True, a stored calibration is checked against the projected board before it is used. This
+        opens the projector and the camera, so it takes a few seconds, instead of loading in milliseconds.
+    :param max_verify_error: RMS reprojection error in projector pixels over which a stored calibration is
+        considered moved, and the projector is calibrated again
+    :return: Camera to projector homography
+    """
+    setup_hash = get_calibration_setup_hash(screen_size, aruco_dict, camera_index, camera_size)
+    if store is not None and not force:
+        cam_to_proj, reproj_error = store.get_projector_calibration(setup_hash)
+        if cam_to_proj is not None:
+            print("Loaded projector calibration | reprojection error = %.3f px" % reproj_error)
+            if not verify:
+                print("Run with --calibrate or --verify-calibration if the camera or the projector moved")
+                return cam_to_proj
+            # The hash does not cover the placement of the camera and the projector, so check it still holds
+            error = verify_projector_calibration(cam_to_proj, screen_size, aruco_dict, camera_index=camera_index,
+                                                 display_offset_x=display_offset_x)
+            if error is None:
+                print("Could not verify the projector calibration. Run with --calibrate if the camera or the "
+                      "projector moved.")
+                return cam_to_proj
+            if error <= max_verify_error:
+                print("Verified projector calibration | reprojection error = %.3f px" % error)
+                return cam_to_proj
+            print("Projector calibration is off by %.1f px, the camera or the projector moved. Calibrating." % error)
+
+    img_board_rgb, proj_corners_by_id = _get_calibration_board(screen_size, aruco_dict)
 
     # Project markers
-    display = Display()
+    display = Display(screen_width=display_offset_x)
     display.show_array(img_board_rgb)
 
     # Detect markers using the camera
     aruco_detect_params = cv2.aruco.DetectorParameters_create()
     aruco_detect_params.doCornerRefinement = True
-    proj_to_cam = None
-    cap = cv2.VideoCapture(1)
+    cam_to_proj = None
+    reproj_error = None
+    cam_points = np.zeros((0, 2), np.float32)
+    proj_points = np.zeros((0, 2), np.float32)
+    num_frames = 0
+    num_stable = 0
+    cap = cv2.VideoCapture(camera_index)
     while True:
         # Capture frame-by-frame
         ret, img = cap.read()
         gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
 
         # Find the marker corners
-        corners_cam, ids_cam, rejectedImgPoints = cv2.aruco.detectMarkers(gray, aruco_dict, parameters=aruco_detect_params)
+        corners_cam, ids_cam, new_cam, new_proj = _match_calibration_markers(gray, aruco_dict, aruco_detect_params,
+                                                                             proj_corners_by_id)
 
         # If no markers were found continue to next frame
         if ids_cam is None:
             continue
+        num_frames += 1
 
-        ids_cam = ids_cam.flatten()
+        # Accumulate the corners of the markers detected both in camera and projector image
+        if len(new_cam) > 0:
+            cam_points = np.vstack([cam_points, new_cam])[-max_points:].astype(np.float32)
+            proj_points = np.vstack([proj_points, new_proj])[-max_points:].astype(np.float32)
+            frame_cam_to_proj, frame_error, num_inliers = find_cam_to_proj(cam_points, proj_points)
+            if frame_cam_to_proj is not None:
+                cam_to_proj, reproj_error = frame_cam_to_proj, frame_error
+                num_stable = num_stable + 1 if reproj_error < max_reproj_error else 0
 
         # Draw markers on RGB image and display it
         cv2.aruco.drawDetectedMarkers(img, corners_cam, ids_cam)
-        cv2.putText(img, "Press 'c' to calibrate", (10, 30), cv2.FONT_HERSHEY_PLAIN, 1.5, (0, 255, 0))
+        if auto:
+            text = "Calibrating... error = %s" % ("%.2f px" % reproj_error if reproj_error is not None else "-")
+        else:
+            text = "Press 'c' to calibrate"
+        cv2.putText(img, text, (10, 30), cv2.FONT_HERSHEY_PLAIN, 1.5, (0, 255, 0))
         cv2.imshow('img', img)
 
         # Wait for key from user
         key = cv2.waitKey(10)
         if key & 0xFF == ord('q'):
             break
-        if key & 0xFF == ord('c'):
-            # Build a list of all markers corners detected both in camera and projector image
-            ids_intersection = list(set(ids_proj).intersection(set(ids_cam)))
-            proj_points = []
-            cam_points = []
-            for id in ids_intersection:
-                c_proj = corners_proj[np.flatnonzero(ids_proj == id)[0]][0]
-                proj_points.append(c_proj)
-                c_cam = corners_cam[np.flatnonzero(ids_cam == id)[0]][0]
-                cam_points.append(c_cam)
-            proj_points = np.vstack(proj_points)
-            cam_points = np.vstack(cam_points)
-
-            # Find homography
-            cam_to_proj, _ = cv2.findHomography(cam_points, proj_points)
-            print("Camera to projector:")
-            print(cam_to_proj)
+        if auto and num_frames >= min_frames and (num_stable >= stable_frames or num_frames >= max_frames):
             break
+        if not auto and key & 0xFF == ord('c') and cam_to_proj is not None:
+            break
+    cap.release()
+    cv2.destroyWindow('img')
     display.close()
+    if cam_to_proj is not None:
+        print("Camera to projector: (reprojection error = %.3f px, %d frames)" % (reproj_error, num_frames))
+        print(cam_to_proj)
+        if store is not None:
+            store.set_projector_calibration(setup_hash, cam_to_proj, reproj_error)
+            store.save()
     return cam_to_proj
 
 
 class Display:
-    def __init__(self, screen_width=1366):
+    def __init__(self, screen_width=1366, zero_copy=False):
         """
 
         :param screen_width: The width of the left display (laptop), so that the code will know
             where the second right monitor (projector) starts.
+        :param zero_copy: If True, frames are written directly into one persistent surface instead of
+            allocating a new surface for every frame.
         """
         self.screen_x = screen_width
         self.screen_y = 0
+        self.zero_copy = zero_copy
+        self.frame_surface = None  # Persistent surface of the zero copy mode
         os.environ['SDL_VIDEO_WINDOW_POS'] = "%d,%d" % (self.screen_x, self.screen_y)
         self.open()
 
-    def show_array(self, array):
-        a = np.swapaxes(array.copy(), 0, 1)
-        surf = pygame.surfarray.make_surface(a)
-        #surf = pygame.transform.scale(surf, self.size)
-        self.screen.blit(surf, (0, 0))
+    def show_array(self, array, is_bgr=False):
+        """ Show an image.
+
+        :param array: Image as NumPy array with shape (height, width, 3)
+        :param is_bgr: True if the channels are in OpenCV's BGR order, False for RGB
+        """
+        if self.zero_copy:
+            self._write_frame_surface(array, is_bgr)
+            self.screen.blit(self.frame_surface, (0, 0))
+        else:
+            if is_bgr:
+                array = array[:, :, ::-1]
+            a = np.swapaxes(array.copy(), 0, 1)
+            surf = pygame.surfarray.make_surface(a)
+            #surf = pygame.transform.scale(surf, self.size)
+            self.screen.blit(surf, (0, 0))
         pygame.display.flip()
 
+    def _write_frame_surface(self, array, is_bgr):
+        height, width = array.shape[:2]
+        if self.frame_surface is None or self.frame_surface.get_size() != (width, height):
+            self.frame_surface = pygame.Surface((width, height), 0, 24)
+        # Surface pixels are indexed [x, y], so write through transposed views. The only copy
+        # is the assignment into the surface memory.
+        if is_bgr:
+            array = array[:, :, ::-1]
+        pixels = pygame.surfarray.pixels3d(self.frame_surface)
+        pixels[...] = array.transpose(1, 0, 2)
+        # Release the surface lock before blitting
+        del pixels
+
     def show_image(self, image):
         image = self.scale_image(image)
         self.screen.blit(image, (0, 0))
@@ -108,6 +300,7 @@ class Display:
         return pygame.transform.scale(pygame.image.load(image), self.size)
 
     def open(self):
+        _import_pygame()
         pygame.display.init()
         #pygame.mouse.set_visible(False)
         self.screen = pygame.display.set_mode((self.screen_x, self.screen_y), pygame.NOFRAME)
@@ -116,12 +309,14 @@ class Display:
         # print(self.size)
 
     def close(self):
+        self.frame_surface = None
         pygame.display.quit()
 
 
 class Sound(object):
     def __init__(self, wav_directory):
         self.wav_directory = wav_directory
+        _import_pygame()
         pygame.mixer.init()
         self.wav_dict = self._load_wav_files()
 
@@ -148,6 +343,65 @@ class Sound(object):
         return d
 
 
+class WindowDisplay(object):
+    def __init__(self, name, offset_x=1366, offset_y=0, fullscreen=True):
+        """ Display in an OpenCV window. pygame has a single window per process, so this is the display of
+            the stations when one process drives several projectors. The windows are updated by cv2.waitKey(),
+            which the caller should run from the thread that shows the frames.
+
+        :param name: Window name, unique per projector
+        :param offset_x: x where the projector screen starts
+        :param offset_y: y where the projector screen starts
+        :param fullscreen: If True, the window covers the projector screen
+        """
+        self.name = name
+        self.num_frames = 0
+        cv2.namedWindow(name, cv2.WINDOW_NORMAL)
+        cv2.moveWindow(name, offset_x, offset_y)
+        if fullscreen:
+            cv2.setWindowProperty(name, cv2.WND_PROP_FULLSCREEN, cv2.WINDOW_FULLSCREEN)
+
+    def show_array(self, array, is_bgr=False):
+        """ Show an image.
+
+        :param array: Image as NumPy array with shape (height, width, 3)
+        :param is_bgr: True if the channels are in OpenCV's BGR order, False for RGB
+        """
+        cv2.imshow(self.name, array if is_bgr else cv2.cvtColor(array, cv2.COLOR_RGB2BGR))
+        self.num_frames += 1
+
+    def close(self):
+        cv2.destroyWindow(self.name)
+
+
+class HeadlessDisplay(object):
+    def __init__(self, keep_last=False):
+        """ Display which shows nothing, for running without a projector.
+
+        :param keep_last: If True, keep a reference to the last shown frame
+        """
+        self.num_frames = 0
+        self.last_array = None
+        self.keep_last = keep_last
+
+    def show_array(self, array, is_bgr=False):
+        self.num_frames += 1
+        if self.keep_last:
+            self.last_array = array
+
+    def close(self):
+        pass
+
+
+class HeadlessSound(object):
+    def __init__(self):
+        """ Sound which plays nothing and logs the played notes as (time, name) """
+        self.played = []
+
+    def play_note_sound(self, name):
+        if name == "br": return
+        self.played.append((time.time(), name))
+
 
 if __name__ == "__main__":
     display = Display()
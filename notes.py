@@ -0,0 +1,34 @@
+"""
+Note names, like in Piano class: "C#4", "D5", ... and their MIDI note numbers.
+"""
+import re
+
+NOTE_OFFSETS = {'C': 0, 'D': 2, 'E': 4, 'F': 5, 'G': 7, 'A': 9, 'B': 11}
+
+
+def note_to_midi(name):
+    """ :param name: Note name, like in Piano class: "C#4", "D5", ...
+        :return: MIDI note number. "A4" is 69.
+    """
+    match = re.match(r'^([A-Ga-g])(#|b)?(-?\d+)$', name)
+    if match is None:
+        raise ValueError("Bad note name: %s" % name)
+    letter, accidental, octave = match.groups()
+    midi = 12 * (int(octave) + 1) + NOTE_OFFSETS[letter.upper()]
+    if accidental == '#':
+        midi += 1
+    elif accidental == 'b':
+        midi -= 1
+    return midi
+
+
+def midi_to_note(midi):
+    """ :param midi: MIDI note number
+        :return: Note name with sharps, like in Piano class: "C#4", "D5", ...
+    """
+    names = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
+    return "%s%d" % (names[midi % 12], midi // 12 - 1)
+
+
+def note_frequency(name):
+    return 440.0 * 2.0 ** ((note_to_midi(name) - 69) / 12.0)
@@ -1,44 +1,86 @@
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib
+from colors import brg_colors
+from layout import KeyboardLayout
+
+
+class CornersFilter(object):
+    def __init__(self, alpha_min=0.2, fast_motion_px=8.0):
+        """ Exponential moving average of points, which follows fast motion and smooths jitter.
+            The smoothing factor grows from alpha_min for still points up to 1 for motion of fast_motion_px.
+
+        :param alpha_min: Smoothing factor when the points don't move. Smaller is smoother.
+        :param fast_motion_px: Motion in pixels from which the points are not smoothed
+        """
+        self.alpha_min = alpha_min
+        self.fast_motion_px = fast_motion_px
+        self.pts = None
+
+    def reset(self):
+        self.pts = None
+
+    def update(self, pts):
+        """
+        :param pts: (N, 2) array of the new measurement
+        :return: (N, 2) smoothed points
+        """
+        pts = np.asarray(pts, float)
+        if self.pts is None:
+            self.pts = pts.copy()
+            return self.pts
+        motion = np.max(np.linalg.norm(pts - self.pts, axis=1))
+        alpha = self.alpha_min + (1.0 - self.alpha_min) * min(1.0, motion / self.fast_motion_px)
+        self.pts += alpha * (pts - self.pts)
+        return self.pts
 
 
 class Piano(object):
-    def __init__(self, mode=0):
-        self.markers_list = [{'id': 203, 'name': 'top_left', 'corner_ind': 2, 'corners': None},
-                             {'id': 204, 'name': 'top_right', 'corner_ind': 3, 'corners': None},
-                             {'id': 205, 'name': 'bottom_right', 'corner_ind': 0, 'corners': None},
-                             {'id': 206, 'name': 'bottom_left', 'corner_ind': 1, 'corners': None}]
-        self.key_list = [{'note': 'C4',  'x': 0},
-                         {'note': 'C#4', 'x': 0.75},
-                         {'note': 'D4',  'x': 1},
-                         {'note': 'D#4', 'x': 1.75},
-                         {'note': 'E4',  'x': 2},
-                         {'note': 'F4',  'x': 3},
-                         {'note': 'F#4', 'x': 3.75},
-                         {'note': 'G4',  'x': 4},
-                         {'note': 'G#4', 'x': 4.75},
-                         {'note': 'A4',  'x': 5},
-                         {'note': 'A#4', 'x': 5.75},
-                         {'note': 'B4',  'x': 6},
-                         {'note': 'C5',  'x': 7},
-                         {'note': 'C#5', 'x': 7.75},
-                         {'note': 'D5',  'x': 8},
-                         {'note': 'D#5', 'x': 8.75},
-                         {'note': 'E5',  'x': 9},
-                         {'note': 'F5',  'x': 10},
-                         {'note': 'F#5', 'x': 10.75},
-                         {'note': 'G5',  'x': 11},
-                         {'note': 'G#5', 'x': 11.75},
-                         {'note': 'A5',  'x': 12},
-                         {'note': 'A#5', 'x': 12.75},
-                         {'note': 'B5',  'x': 13}]
+    def __init__(self, mode=0, image_size=(640, 480), white_key_width_cm=2.3, white_key_height_cm=7.8,
+                 undistorter=None, layout=None):
+        """
+
+        :param mode: 0 for a different color for every key, otherwise all keys are red
+        :param image_size: Camera image size (width, height), for the key label map
+        :param white_key_width_cm: Printed white key width, used if layout is None
+        :param white_key_height_cm: Printed white key height, used if layout is None
+        :param undistorter: undistort.Undistorter of the camera. If given, the pose is found from undistorted
+            marker corners, and the key polygons and label map are moved back to the raw camera image.
+        :param layout: layout.KeyboardLayout of the keys and markers. The original 2-octave board if None.
+        """
+        if layout is None:
+            layout = KeyboardLayout(white_key_width_cm=white_key_width_cm, white_key_height_cm=white_key_height_cm)
+        self.layout = layout
+        # The markers state is per piano, the layout may be shared
+        self.markers_list = [dict(x) for x in layout.markers_list]
+        self.key_list = layout.key_list
         if mode == 0:
             self.keys_color = self._generate_colormap(len(self.key_list))
         else:
             self.keys_color = [[0, 0, 255] for x in range(len(self.key_list))]
-        self.keys_im_polygon_list = None
-        self.num_white_keys = self._get_num_white_keys()
+        self.image_size = image_size
+        self.white_key_width_cm = layout.white_key_width_cm
+        self.white_key_height_cm = layout.white_key_height_cm
+        self.undistorter = undistorter
+        self.min_markers = 2  # Minimal number of visible markers to update the pose
+        self.geometry_change_px = 0.5  # Smaller changes of the piano corners don't change the key polygons
+        self.corners_filter = CornersFilter()
+        self.keys_polygons = None  # (N, 4, 2) key corners in image coordinates
+        # 3x3 transformation from piano units (x: 1 unit = 1 white key width, y: 1 unit = white key height) to image.
+        # With an undistorter, the image is the undistorted camera image.
+        self.board_to_image = None
+        # Marker ID -> (4, 2) marker corners on the board, in cm. Learned if the layout does not place the markers.
+        self.markers_board_corners = {}
+        if layout.markers_board_cm is not None:
+            self.markers_board_corners = dict((x, c.copy()) for x, c in layout.markers_board_cm.items())
+        self._markers_board_count = {}  # Marker ID -> number of frames averaged in markers_board_corners
+        self.geometry_version = 0  # Incremented whenever the key polygons change
+        # The geometry of the keys in piano units is built once by the layout
+        self.num_white_keys = layout.num_white_keys
+        self.keys_unit_corners = layout.keys_unit_corners
+        self.label_table_resolution = layout.label_table_resolution  # Label table bins per piano unit
+        self.label_table = layout.label_table
+        self._label_map = None
+        self._label_map_version = None
+        self.key_index = dict((key['note'], i) for i, key in enumerate(self.key_list))  # Note name -> key index
         self.markers_ids = self._get_markers_ids()
         self.markers_names = self._get_markers_names()
 
@@ -48,81 +90,215 @@ class Piano(object):
         # self.black_key_height = 1   # In size of the AruCo marker units which is printed
 
     def update_coordinates(self, corners, ids):
-        """
+        """ Update the piano pose from the detected markers.
+            The pose is a homography from the board, in cm, to the image. When all the markers are visible, it
+            is found from the piano corners, and the board position of every marker corner is learned. After that
+            any min_markers visible markers are enough. The piano corners are smoothed over frames.
 
         :param corners: AruCo markers corners
         :param ids: AruCo markers IDs
-        :return:
+        :return: True if the key polygons changed
         """
         ids = ids.flatten()
 
         # Filter out any marker id which is not related to the piano
-        ids_relevant = [x for x in ids if x in self.markers_ids]
+        found = {}
+        for i, marker_id in enumerate(ids):
+            if marker_id in self.markers_ids:
+                found[int(marker_id)] = np.asarray(corners[i], float).reshape(4, 2)
+                self.markers_list[self.markers_ids.index(marker_id)]['corners'] = corners[i].copy()
+        if self.undistorter is not None and len(found) > 0:
+            # The board is planar only in the undistorted image, so the homography is found there
+            undistorted = self.undistorter.undistort_points(np.array(list(found.values())))
+            found = dict(zip(found.keys(), undistorted))
+
+        if self.layout.markers_board_cm is None and len(found) == len(self.markers_list):
+            # Get specific piano board corner from the markers corners
+            piano_corners_im = np.array([found[item['id']][item['corner_ind']] for item in self.markers_list])
+            board_to_image_cm = self._find_homography(self._get_board_corners_cm(), piano_corners_im)
+            self._learn_markers_board_corners(found, np.linalg.inv(board_to_image_cm))
 
-        if len(ids_relevant) != len(self.markers_list):
-            # Don't update the corners if we didn't find them all
+        # Use every visible marker whose position on the board is known
+        visible = [x for x in found if x in self.markers_board_corners]
+        if len(visible) < self.min_markers:
             print("Did not update piano corners")
-            return
-
-        # Add 4 corners of markers to our dictionary
-        for i_tmp, id_tmp in enumerate(ids_relevant):
-            id_input = np.flatnonzero(ids == id_tmp)[0]
-            self.markers_list[self.markers_ids.index(id_tmp)]['corners'] = corners[id_input].copy()
-
-        # Get specific piano board corner from the markers corners
-        top_left_item = self.markers_list[self.markers_names.index('top_left')]
-        top_right_item = self.markers_list[self.markers_names.index('top_right')]
-        bottom_right_item = self.markers_list[self.markers_names.index('bottom_right')]
-        bottom_left_item = self.markers_list[self.markers_names.index('bottom_left')]
-        top_left_corner = top_left_item['corners'][0][top_left_item['corner_ind']].astype(float)
-        top_right_corner = top_right_item['corners'][0][top_right_item['corner_ind']].astype(float)
-        bottom_right_corner = bottom_right_item['corners'][0][bottom_right_item['corner_ind']].astype(float)
-        bottom_left_corner = bottom_left_item['corners'][0][bottom_left_item['corner_ind']].astype(float)
-
-        # Find image vectors in coordinates of the piano.
-        # 1 unit is equal to 1 white key
-        v_right_top = (top_right_corner-1 - top_left_corner+1) / float(self.num_white_keys)
-        v_right_bot = (bottom_right_corner-1 - bottom_left_corner+1) / float(self.num_white_keys)
-        v_right = (v_right_top + v_right_bot) / 2.0
-
-        v_down_left = (bottom_left_corner - top_left_corner)
-        v_down_right = (bottom_right_corner - top_right_corner)
-        v_down = (v_down_left + v_down_right) / 2.0
-        print([v_right, v_down])
-
-        piano_origin = top_left_corner
-
-        self.keys_im_polygon_list = []
-        for key in self.key_list:
-            if '#' in key['note']:
-                w = 0.5
-                h = 0.5
+            return False
+        board_pts = np.vstack([self.markers_board_corners[x] for x in visible])
+        image_pts = np.vstack([found[x] for x in visible])
+        board_to_image_cm = self._find_homography(board_pts, image_pts)
+
+        # Smooth the piano corners in the image
+        piano_corners_im = self._transform_points(board_to_image_cm, self._get_board_corners_cm())
+        piano_corners_im = self.corners_filter.update(piano_corners_im)
+        if self.board_to_image is not None:
+            current = self._transform_points(self.board_to_image, self._get_board_corners_units())
+            if np.max(np.abs(piano_corners_im - current)) < self.geometry_change_px:
+                return False
+
+        self.set_pose(self._find_homography(self._get_board_corners_units(), piano_corners_im),
+                      self.geometry_version + 1)
+        return True
+
+    def set_pose(self, board_to_image, geometry_version):
+        """ Set the pose and update the key polygons. Used by update_coordinates, and to copy the pose
+            found by a Piano in another process.
+
+        :param board_to_image: 3x3 transformation from piano units to the image, like board_to_image
+        :param geometry_version: Geometry version of the pose
+        """
+        self.board_to_image = np.asarray(board_to_image, float)
+        # Transform all the key corners in one step
+        self.keys_polygons = self._to_raw_image(self._transform_points(self.board_to_image, self.keys_unit_corners))
+        self.geometry_version = geometry_version
+
+    def _learn_markers_board_corners(self, found, image_to_board_cm, max_count=50):
+        """ Average the board position of the markers corners over the frames in which all markers are visible """
+        for marker_id, c in found.items():
+            c_board = self._transform_points(image_to_board_cm, c)
+            count = min(self._markers_board_count.get(marker_id, 0) + 1, max_count)
+            if marker_id not in self.markers_board_corners:
+                self.markers_board_corners[marker_id] = c_board
             else:
-                w = 1.0
-                h = 1.0
-            c = np.array([[piano_origin + key['x'] * v_right],
-                          [piano_origin + (key['x'] + w) * v_right],
-                          [piano_origin + (key['x'] + w) * v_right + h * v_down],
-                          [piano_origin + (key['x']) * v_right + h * v_down]])
-            self.keys_im_polygon_list.append(c)
+                self.markers_board_corners[marker_id] += (c_board - self.markers_board_corners[marker_id]) / count
+            self._markers_board_count[marker_id] = count
+
+    def _to_raw_image(self, pts):
+        """ Move points from the board_to_image image to the raw camera image """
+        if self.undistorter is None:
+            return pts
+        return self.undistorter.distort_points(pts)
+
+    def _get_board_corners_units(self):
+        """ :return: (4, 2) piano corners in piano units: top left, top right, bottom right, bottom left """
+        return np.array([[0, 0], [self.num_white_keys, 0], [self.num_white_keys, 1], [0, 1]], float)
+
+    def _get_board_corners_cm(self):
+        """ :return: (4, 2) piano corners in cm: top left, top right, bottom right, bottom left """
+        return self._get_board_corners_units() * np.array([self.white_key_width_cm, self.white_key_height_cm])
 
     def get_key_polygon(self, key_ind):
-        return self.keys_im_polygon_list[key_ind].astype(np.int32)
+        """ :return: (4, 1, 2) int32 key corners in image coordinates, as OpenCV's polygons """
+        return self.keys_polygons[key_ind].reshape(4, 1, 2).astype(np.int32)
+
+    def get_bounding_box(self, padding_px=0):
+        """ :param padding_px: Padding around the keys
+            :return: (x0, y0, x1, y1) bounding box of the keys in the image, clipped to the image, or None if
+                the piano was not initialized
+        """
+        if not self.is_initialize():
+            return None
+        width, height = self.image_size
+        pts = self.keys_polygons.reshape(-1, 2)
+        x0 = int(max(0, np.floor(pts[:, 0].min() - padding_px)))
+        y0 = int(max(0, np.floor(pts[:, 1].min() - padding_px)))
+        x1 = int(min(width, np.ceil(pts[:, 0].max() + padding_px) + 1))
+        y1 = int(min(height, np.ceil(pts[:, 1].max() + padding_px) + 1))
+        return x0, y0, x1, y1
+
+    def get_label_map(self):
+        """ Get an image where each pixel holds the index of the key it belongs to, or -1 outside the keys.
+            Black keys are on top of white keys. The map is rebuilt only when the geometry changes.
+
+        :return: int16 array of the image size, or None if the piano was not initialized
+        """
+        if not self.is_initialize():
+            return None
+        if self._label_map_version != self.geometry_version:
+            self._label_map = self._build_label_map()
+            self._label_map_version = self.geometry_version
+        return self._label_map
+
+    def get_key_index_at(self, x, y):
+        """ Get the key at an image pixel.
+
+        :param x: Pixel column
+        :param y: Pixel row
+        :return: Key index, or None if there is no key at the pixel
+        """
+        label_map = self.get_label_map()
+        if label_map is None:
+            return None
+        x = int(x)
+        y = int(y)
+        if not (0 <= y < label_map.shape[0] and 0 <= x < label_map.shape[1]):
+            return None
+        key_ind = label_map[y, x]
+        return int(key_ind) if key_ind >= 0 else None
 
     def get_key_color(self, key_ind):
         return self.keys_color[key_ind]
 
     def is_initialize(self):
-        return self.keys_im_polygon_list is not None
+        return self.keys_polygons is not None
 
     @staticmethod
     def _generate_colormap(num_of_levels):
         # define the piano keys colormap
-        cmap = matplotlib.cm.get_cmap('brg')
-        norm = matplotlib.colors.Normalize(vmin=0, vmax=num_of_levels)
-        cmap_keys = [cmap(norm(i))[:3] for i in range(num_of_levels)]
-        cmap_keys = [np.uint8(np.round(255 * np.array(x))).tolist() for x in cmap_keys]
-        return cmap_keys
+        return brg_colors(num_of_levels)
+
+    @staticmethod
+    def _find_homography(src, dst):
+        """ Least squares homography (normalized DLT) from (N, 2) src points to (N, 2) dst points. N >= 4. """
+        def normalization(pts):
+            mean = pts.mean(axis=0)
+            scale = np.sqrt(2.0) / max(np.mean(np.linalg.norm(pts - mean, axis=1)), 1e-12)
+            return np.array([[scale, 0, -scale * mean[0]], [0, scale, -scale * mean[1]], [0, 0, 1.0]])
+
+        src = np.asarray(src, float)
+        dst = np.asarray(dst, float)
+        t_src = normalization(src)
+        t_dst = normalization(dst)
+        x, y = Piano._transform_points(t_src, src).T
+        u, v = Piano._transform_points(t_dst, dst).T
+        ones = np.ones_like(x)
+        zeros = np.zeros_like(x)
+        a = np.empty((2 * len(x), 9))
+        a[0::2] = np.stack([x, y, ones, zeros, zeros, zeros, -u * x, -u * y, -u], axis=1)
+        a[1::2] = np.stack([zeros, zeros, zeros, x, y, ones, -v * x, -v * y, -v], axis=1)
+        h = np.linalg.svd(a)[2][-1].reshape(3, 3)
+        h = np.dot(np.linalg.inv(t_dst), np.dot(h, t_src))
+        return h / h[2, 2]
+
+    @staticmethod
+    def _transform_points(mtx, pts):
+        """ Apply a 3x3 transformation on an array of points with shape (..., 2) """
+        pts_h = np.dot(pts, mtx[:, :2].T) + mtx[:, 2]
+        return pts_h[..., :2] / pts_h[..., 2:]
+
+    def _build_label_map(self):
+        width, height = self.image_size
+        label_map = np.full((height, width), -1, np.int16)
+
+        # Only pixels in the bounding box of the piano can hold a key
+        outer = self._to_raw_image(self._transform_points(self.board_to_image, np.array(
+            [[0, 0], [self.label_table.shape[1], 0], self.label_table.shape[::-1], [0, self.label_table.shape[0]]],
+            float) / self.label_table_resolution))
+        pad = 0 if self.undistorter is None else 3  # The piano edges are slightly curved in the raw image
+        x0 = int(max(0, np.floor(outer[:, 0].min()) - pad))
+        y0 = int(max(0, np.floor(outer[:, 1].min()) - pad))
+        x1 = int(min(width, np.ceil(outer[:, 0].max()) + 1 + pad))
+        y1 = int(min(height, np.ceil(outer[:, 1].max()) + 1 + pad))
+        if x1 <= x0 or y1 <= y0:
+            return label_map
+
+        # Map every pixel to piano units and look up its key in the table
+        image_to_board = np.linalg.inv(self.board_to_image)
+        if self.undistorter is None:
+            xs = np.arange(x0, x1, dtype=float)[np.newaxis, :]
+            ys = np.arange(y0, y1, dtype=float)[:, np.newaxis]
+        else:
+            # Undistorted position of every raw pixel, from the cached table
+            grid = self.undistorter.get_undistorted_grid()[y0:y1, x0:x1]
+            xs = grid[:, :, 0].astype(float)
+            ys = grid[:, :, 1].astype(float)
+        w = image_to_board[2, 0] * xs + image_to_board[2, 1] * ys + image_to_board[2, 2]
+        u = (image_to_board[0, 0] * xs + image_to_board[0, 1] * ys + image_to_board[0, 2]) / w
+        v = (image_to_board[1, 0] * xs + image_to_board[1, 1] * ys + image_to_board[1, 2]) / w
+        col = np.floor(u * self.label_table_resolution).astype(np.int64)
+        row = np.floor(v * self.label_table_resolution).astype(np.int64)
+        inside = (col >= 0) & (col < self.label_table.shape[1]) & (row >= 0) & (row < self.label_table.shape[0])
+        label_map[y0:y1, x0:x1][inside] = self.label_table[row[inside], col[inside]]
+        return label_map
 
     def _get_markers_ids(self):
         return [x['id'] for x in self.markers_list]
@@ -130,9 +306,5 @@ class Piano(object):
     def _get_markers_names(self):
         return [x['name'] for x in self.markers_list]
 
-    def _get_num_white_keys(self):
-        return len([x for x in self.key_list if '#' not in x['note']])
-
     def get_key_index_by_name(self, name):
-        tmp = [x['note'] for x in self.key_list]
-        return tmp.index(name)
+        return self.key_index[name]
@@ -0,0 +1,170 @@
+"""
+Helpers for running the camera loop as a threaded capture -> process -> render pipeline.
+Each stage runs on its own thread and hands its output to the next stage through a
+bounded "latest frame wins" queue, so a slow stage drops old frames instead of
+building up latency.
+"""
+import collections
+import threading
+import time
+
+
+class LatestFrameQueue(object):
+    def __init__(self, maxsize=1):
+        """ Bounded queue in which a new item replaces the oldest one when the queue is full.
+
+        :param maxsize: Maximum number of items waiting in the queue
+        """
+        self.maxsize = maxsize
+        self.num_put = 0
+        self.num_dropped = 0
+        self._items = collections.deque()
+        self._cond = threading.Condition()
+        self._closed = False
+
+    def put(self, item):
+        with self._cond:
+            if len(self._items) >= self.maxsize:
+                self._items.popleft()
+                self.num_dropped += 1
+            self._items.append(item)
+            self.num_put += 1
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        """ Get the oldest item waiting in the queue.
+
+        :param timeout: Seconds to wait for an item. None waits forever.
+        :return: The item, or None on timeout or if the queue was closed
+        """
+        with self._cond:
+            if not self._items and not self._closed:
+                self._cond.wait(timeout)
+            if not self._items:
+                return None
+            return self._items.popleft()
+
+    def close(self):
+        """ Wake up any waiting consumer. Following get() calls return None once the queue is empty. """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+class StageTimer(object):
+    def __init__(self, name, history_size=1000):
+        """ Accumulates the run time of a pipeline stage. Use as a context manager around the stage work.
+            A timer is meant to be used from a single thread.
+
+        :param name: Stage name, for reports
+        :param history_size: Number of recent durations kept for percentiles
+        """
+        self.name = name
+        self.count = 0
+        self.total = 0.0
+        self.last = 0.0
+        self.max = 0.0
+        self.history = collections.deque(maxlen=history_size)
+        self._t_start = None
+
+    def __enter__(self):
+        self._t_start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.add(time.perf_counter() - self._t_start)
+        return False
+
+    def add(self, duration):
+        self.count += 1
+        self.total += duration
+        self.last = duration
+        self.max = max(self.max, duration)
+        self.history.append(duration)
+
+    def mean(self):
+        return self.total / self.count if self.count > 0 else 0.0
+
+    def percentile(self, q):
+        """ :param q: Percentile, 0-100
+            :return: Percentile of the recent durations, in seconds
+        """
+        if len(self.history) == 0:
+            return 0.0
+        values = sorted(self.history)
+        return values[min(len(values) - 1, int(round(q / 100.0 * (len(values) - 1))))]
+
+
+class PipelineStats(object):
+    def __init__(self):
+        """ Per-stage timing and queue drop counters of the pipeline. """
+        self.timers = collections.OrderedDict()
+        self.queues = collections.OrderedDict()
+        self.t_start = time.perf_counter()
+
+    def timer(self, name):
+        if name not in self.timers:
+            self.timers[name] = StageTimer(name)
+        return self.timers[name]
+
+    def add_queue(self, name, queue):
+        self.queues[name] = queue
+
+    def as_dict(self):
+        """ :return: dictionary with the statistics, for monitoring """
+        elapsed = time.perf_counter() - self.t_start
+        d = {'elapsed_sec': elapsed, 'stages': {}, 'queues': {}}
+        for name, t in self.timers.items():
+            d['stages'][name] = {'count': t.count, 'mean_ms': 1000.0 * t.mean(), 'last_ms': 1000.0 * t.last,
+                                 'max_ms': 1000.0 * t.max, 'p50_ms': 1000.0 * t.percentile(50),
+                                 'p95_ms': 1000.0 * t.percentile(95), 'p99_ms': 1000.0 * t.percentile(99),
+                                 'fps': t.count / elapsed if elapsed > 0 else 0.0}
+        for name, q in self.queues.items():
+            d['queues'][name] = {'put': q.num_put, 'dropped': q.num_dropped}
+        return d
+
+    def summary(self):
+        d = self.as_dict()
+        stages = ["%s: %.1f ms (max %.1f) %.1f fps" % (name, s['mean_ms'], s['max_ms'], s['fps'])
+                  for name, s in d['stages'].items()]
+        queues = ["%s dropped %d/%d" % (name, q['dropped'], q['put']) for name, q in d['queues'].items()]
+        return " | ".join(stages + queues)
+
+
+class StageThread(threading.Thread):
+    def __init__(self, name, func, in_queue, out_queue, timer, stop_event):
+        """ Runs one pipeline stage in a loop until stop_event is set.
+
+        :param name: Thread name
+        :param func: Stage function. Called as func(item) with an item from in_queue, or as func(None)
+            when there is no input queue (source stage). Results which are not None are put in out_queue.
+        :param in_queue: LatestFrameQueue to read from, or None for a source stage
+        :param out_queue: LatestFrameQueue to write to, or None for a sink stage
+        :param timer: StageTimer for the stage
+        :param stop_event: threading.Event which stops all the pipeline threads
+        """
+        super(StageThread, self).__init__(name=name)
+        self.daemon = True
+        self.func = func
+        self.in_queue = in_queue
+        self.out_queue = out_queue
+        self.timer = timer
+        self.stop_event = stop_event
+        self.error = None
+
+    def run(self):
+        try:
+            while not self.stop_event.is_set():
+                item = None
+                if self.in_queue is not None:
+                    item = self.in_queue.get(timeout=0.1)
+                    if item is None:
+                        continue
+                with self.timer:
+                    out = self.func(item)
+                if out is not None and self.out_queue is not None:
+                    self.out_queue.put(out)
+        except Exception as e:
+            # Keep the error for the main thread and stop the rest of the pipeline
+            self.error = e
+            self.stop_event.set()
@@ -0,0 +1,133 @@
+"""
+Model of the projector light in the camera image. The projected keys are drawn in camera coordinates
+(Manager.img_to_project), so the light they add to every camera pixel is predicted from that image, blurred
+like the projector focus, and scaled by a per-pixel gain which is learned from the projection changes.
+The light is subtracted from the camera frames before the background subtraction, so a change of the
+projected highlight does not look like a hand.
+
+The camera sees a new projection a few frames after it was drawn, and the frames in between may catch it
+half shown. The pixels which change are reported as unstable for those frames only, instead of stopping the
+press detection on all the keys.
+"""
+import collections
+import numpy as np
+import cv2
+
+
+class ProjectorLightModel(object):
+    def __init__(self, image_size, latency_frames=1, settle_frames=1, blur_size=7, initial_gain=0.6,
+                 gain_alpha=0.3, min_change=20.0):
+        """
+
+        :param image_size: Camera image size (width, height)
+        :param latency_frames: Frames from drawing a projection until the camera sees it
+        :param settle_frames: Frames after latency_frames in which the projection may still be half shown
+        :param blur_size: Size of the blur of the predicted light, for the projector focus and calibration error
+        :param initial_gain: Camera gray levels per projected gray level, before it is learned
+        :param gain_alpha: Weight of a new measurement in the learned gain
+        :param min_change: Smallest change of the predicted light, in gray levels, from which the gain is learned
+            and the pixels are unstable
+        """
+        self.image_size = tuple(image_size)
+        self.latency_frames = latency_frames
+        self.settle_frames = settle_frames
+        self.blur_size = blur_size
+        self.gain_alpha = gain_alpha
+        self.min_change = min_change
+        width, height = self.image_size
+        self.gain = np.full((height, width), initial_gain, np.float32)
+        self.light = np.zeros((height, width), np.float32)  # Predicted projector light seen in the camera
+        self.num_changes = 0
+        self._key = None  # Key of the last drawn projection
+        self._pending = collections.deque()  # (frame number it becomes visible, light) of the drawn projections
+        self._bbox = None  # (x0, y0, x1, y1) of the light, or None if there is none
+        # (frame number it became visible, bounding box, light change in the box, camera image in the box before it)
+        self._change = None
+        self._unstable_until = -1  # Last frame number in which the changed pixels are unstable
+        self._unstable = np.zeros((height, width), np.uint8)
+        self._last_gray = None
+        self._out = np.zeros((height, width), np.uint8)
+
+    def set_projection(self, img_to_project, frame_num, key):
+        """ Set the projection drawn in a frame. The light is predicted again only if the key changed.
+
+        :param img_to_project: Projected image in camera coordinates (BGR)
+        :param frame_num: Frame number in which the projection was drawn
+        :param key: Hashable key of the projection, like render.get_projection_key
+        """
+        if key == self._key:
+            return
+        self._key = key
+        light = cv2.cvtColor(img_to_project, cv2.COLOR_BGR2GRAY).astype(np.float32)
+        if self.blur_size > 1:
+            light = cv2.GaussianBlur(light, (self.blur_size, self.blur_size), 0)
+        self._pending.append((frame_num + self.latency_frames, light))
+
+        # The pixels which change are unstable from now until the camera surely sees the new projection
+        is_changed = np.abs(light - self.light) > self.min_change
+        if self._unstable_until < frame_num:
+            self._unstable.fill(0)
+        self._unstable[is_changed] = 255
+        self._unstable_until = frame_num + self.latency_frames + self.settle_frames
+
+    def compensate(self, gray, frame_num):
+        """ Remove the predicted projector light from a camera frame, and learn the gain.
+
+        :param gray: Gray camera image
+        :param frame_num: Frame number of the image
+        :return: Gray image without the projector light. The returned buffer is reused by the next call.
+        """
+        while self._pending and self._pending[0][0] <= frame_num:
+            visible_frame, light = self._pending.popleft()
+            self._start_change(visible_frame, light)
+        self._learn_gain(gray, frame_num)
+        self._last_gray = gray
+
+        if self._bbox is None:
+            return gray
+        np.copyto(self._out, gray)
+        x0, y0, x1, y1 = self._bbox
+        roi = gray[y0:y1, x0:x1].astype(np.float32) - self.gain[y0:y1, x0:x1] * self.light[y0:y1, x0:x1]
+        self._out[y0:y1, x0:x1] = np.clip(roi, 0, 255)
+        return self._out
+
+    def get_unstable_mask(self, frame_num):
+        """ :return: uint8 mask, 255 on the pixels whose projector light may be changing in the frame, or None if
+                there are none
+        """
+        if frame_num > self._unstable_until:
+            return None
+        return self._unstable
+
+    def _start_change(self, visible_frame, light):
+        change = light - self.light
+        self._change = None
+        box = self._get_bbox(np.abs(change) > self.min_change)
+        if box is not None and self._last_gray is not None:
+            x0, y0, x1, y1 = box
+            # The frame before the change is the reference of the gain measurement
+            self._change = (visible_frame, box, change[y0:y1, x0:x1], self._last_gray[y0:y1, x0:x1].copy())
+        self.light = light
+        self._bbox = self._get_bbox(light > 0.5)
+        self.num_changes += 1
+
+    def _learn_gain(self, gray, frame_num):
+        """ Measure the gain of the changed pixels once the change settled """
+        if self._change is None or frame_num < self._change[0] + self.settle_frames:
+            return
+        _, (x0, y0, x1, y1), change, before = self._change
+        self._change = None
+        is_valid = np.abs(change) > self.min_change
+        observed = gray[y0:y1, x0:x1].astype(np.float32) - before
+        measured = np.clip(observed[is_valid] / change[is_valid], 0.0, 3.0)
+        gain = self.gain[y0:y1, x0:x1]
+        gain[is_valid] += self.gain_alpha * (measured - gain[is_valid])
+
+    @staticmethod
+    def _get_bbox(mask):
+        """ :return: (x0, y0, x1, y1) bounding box of the mask, or None if it is empty """
+        rows = np.flatnonzero(mask.any(axis=1))
+        if len(rows) == 0:
+            return None
+        cols = np.flatnonzero(mask.any(axis=0))
+        return cols[0], rows[0], cols[-1] + 1, rows[-1] + 1
@@ -0,0 +1,99 @@
+"""
+Rendering of the projector frame. Key polygons are transformed from camera to projector coordinates
+and drawn directly on the projector frame, instead of warping a whole camera size image every frame.
+Rendered frames are cached, so a frame is only drawn when the projected keys or the piano geometry change.
+"""
+import collections
+import numpy as np
+import cv2
+
+# key_ind - Piano key index
+# color - Key color (B, G, R)
+# label - Text to write on the key, or None
+# pts - Key polygon in camera coordinates, like Piano.get_key_polygon
+# label_pos - (x, y) of the label in camera coordinates
+KeyDrawing = collections.namedtuple('KeyDrawing', ['key_ind', 'color', 'label', 'pts', 'label_pos'])
+
+
+def get_projection_key(drawings, geometry_version):
+    """ :return: Hashable key of a projector frame. Equal keys have equal frames. """
+    return tuple((d.key_ind, tuple(d.color), d.label) for d in drawings), geometry_version
+
+
+class ProjectorRenderer(object):
+    def __init__(self, cam_to_proj, screen_size, cache_size=16, label_color=(0, 255, 0), label_scale=0.5):
+        """
+
+        :param cam_to_proj: Homography from camera to projector coordinates
+        :param screen_size: Projector size (width, height)
+        :param cache_size: Maximal number of rendered frames to keep
+        :param label_color: Color of the key labels (B, G, R)
+        :param label_scale: Font scale of the labels, in camera pixels
+        """
+        self.cam_to_proj = cam_to_proj
+        self.screen_size = screen_size
+        self.cache_size = cache_size
+        self.label_color = label_color
+        self.label_scale = label_scale
+        self.cache = collections.OrderedDict()
+        self.last_cache_key = None
+        self.num_hits = 0
+        self.num_misses = 0
+
+    def set_transformation(self, cam_to_proj):
+        self.cam_to_proj = cam_to_proj
+        self.cache.clear()
+        self.last_cache_key = None
+
+    def render(self, drawings, geometry_version):
+        """ Get the projector frame showing the given keys.
+
+        :param drawings: Sequence of KeyDrawing
+        :param geometry_version: Piano.geometry_version of the key polygons
+        :return: (frame, is_changed). frame is an RGB image of the projector size. is_changed is False if
+            it is the same frame as in the previous call, so there is no need to show it again.
+        """
+        cache_key = get_projection_key(drawings, geometry_version)
+        is_changed = cache_key != self.last_cache_key
+        self.last_cache_key = cache_key
+
+        frame = self.cache.get(cache_key)
+        if frame is not None:
+            self.num_hits += 1
+            self.cache.move_to_end(cache_key)
+            return frame, is_changed
+
+        self.num_misses += 1
+        frame = self._draw(drawings)
+        self.cache[cache_key] = frame
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return frame, is_changed
+
+    def transform_points(self, pts):
+        """ Transform points from camera to projector coordinates.
+
+        :param pts: Array of points with shape (N, 1, 2) or (N, 2)
+        :return: (N, 1, 2) float32 array
+        """
+        pts = np.asarray(pts, np.float32).reshape(-1, 1, 2)
+        return cv2.perspectiveTransform(pts, self.cam_to_proj)
+
+    def _draw(self, drawings):
+        # Drawn in RGB, which is what Display expects
+        frame = np.zeros((self.screen_size[1], self.screen_size[0], 3), np.uint8)
+        label_color = tuple(self.label_color[::-1])
+        for d in drawings:
+            pts_proj = self.transform_points(d.pts)
+            cv2.fillPoly(frame, [np.round(pts_proj).astype(np.int32)], tuple(d.color[::-1]), cv2.LINE_AA)
+            if d.label is None:
+                continue
+            # Scale the font like the warp scales the top edge of the key
+            pts_cam = np.asarray(d.pts, np.float32).reshape(-1, 2)
+            len_cam = np.linalg.norm(pts_cam[1] - pts_cam[0])
+            len_proj = np.linalg.norm(pts_proj[1, 0] - pts_proj[0, 0])
+            scale = len_proj / len_cam if len_cam > 0 else 1.0
+            pos = self.transform_points([d.label_pos])[0, 0]
+            cv2.putText(frame, "%s" % d.label, (int(pos[0]), int(pos[1])), cv2.FONT_HERSHEY_COMPLEX,
+                        self.label_scale * scale, label_color)
+        return frame
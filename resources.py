@@ -0,0 +1,52 @@
+"""
+Resources which do not change while the piano runs, so several stations in one process can share them instead
+of loading a copy each: the AruCo dictionary and detector parameters, the compiled songs and the sound sample
+bank. They are created once and only read after that.
+"""
+import threading
+import cv2
+from audio import SoundEngine, load_wav_bank, synthesize_bank
+from songs import Songbook
+
+
+class SharedResources(object):
+    def __init__(self, note_names, songs_directory="songs", aruco_dict_id=cv2.aruco.DICT_ARUCO_ORIGINAL):
+        """
+
+        :param note_names: Note name of every key index, like Piano.key_list. Every station which shares the
+            resources must have these keys.
+        :param songs_directory: Directory of the songbook
+        :param aruco_dict_id: OpenCV's AruCo dictionary id of the piano markers
+        """
+        self.note_names = tuple(note_names)
+        self.aruco_dict_id = aruco_dict_id
+        self.aruco_dict = cv2.aruco.getPredefinedDictionary(aruco_dict_id)
+        # The marker tracker only reads the parameters
+        self.aruco_detect_params = cv2.aruco.DetectorParameters_create()
+        self.aruco_detect_params.doCornerRefinement = True
+        self.songbook = Songbook(songs_directory, self.note_names)
+        self._banks = {}  # (source, sample rate) -> sample bank
+        self._lock = threading.Lock()
+
+    def get_song(self, name):
+        """ :return: songs.Song. Stations may ask from their threads, so a song is compiled only once. """
+        with self._lock:
+            return self.songbook.get(name)
+
+    def get_sample_bank(self, wav_directory=None, sample_rate=44100):
+        """ :param wav_directory: Directory of the note wav files. The notes are synthesized if None.
+            :return: (N, samples) float32 sample bank in the order of note_names, loaded once
+        """
+        bank_key = (wav_directory, sample_rate)
+        with self._lock:
+            if bank_key not in self._banks:
+                if wav_directory is None:
+                    self._banks[bank_key] = synthesize_bank(self.note_names, sample_rate=sample_rate)
+                else:
+                    self._banks[bank_key] = load_wav_bank(wav_directory, self.note_names, sample_rate)
+            return self._banks[bank_key]
+
+    def create_sound_engine(self, wav_directory=None, sample_rate=44100, **kwargs):
+        """ :return: audio.SoundEngine which plays from the shared sample bank. Call start() to open its stream. """
+        return SoundEngine(self.note_names, self.get_sample_bank(wav_directory, sample_rate),
+                           sample_rate=sample_rate, **kwargs)
@@ -0,0 +1,156 @@
+"""
+Clock driven song playback. A song is a list of NoteEvent items with onset and duration in beats,
+and NoteScheduler plays it according to the clock without blocking the camera loop.
+"""
+import collections
+import time
+
+# Note name of a rest in the song lists
+REST = 'br'
+
+# note - Note name, like in Piano class: "C#4", "D5", ... or None for a rest
+# onset, duration - In beats from the start of the song
+NoteEvent = collections.namedtuple('NoteEvent', ['note', 'onset', 'duration'])
+
+
+def events_from_note_names(names, note_beats=1.0, rest_beats=1.0):
+    """ Convert a list of note names to note events played one after the other.
+
+    :param names: List of note names. 'br' is a rest.
+    :param note_beats: Duration of each note in beats
+    :param rest_beats: Duration of each rest in beats
+    :return: List of NoteEvent
+    """
+    events = []
+    onset = 0.0
+    for name in names:
+        if name == REST:
+            events.append(NoteEvent(None, onset, rest_beats))
+            onset += rest_beats
+        else:
+            events.append(NoteEvent(name, onset, note_beats))
+            onset += note_beats
+    return events
+
+
+class NoteScheduler(object):
+    def __init__(self, events, sound, tempo_bpm=120.0, clock=time.perf_counter):
+        """ Plays a song from a clock. Call update() once per frame.
+
+        In the default mode every event starts at its onset time and the notes are played automatically.
+        In wait for press mode the song stops on every note until press() is called. The note is then
+        played and the song continues with the following events after the note duration. Rests are
+        never waited for. Either way the played notes are kept until pop_played() is called.
+
+        :param events: List of NoteEvent
+        :param sound: Object with play_note_sound(name) method, like media.Sound
+        :param tempo_bpm: Tempo in beats per minute
+        :param clock: Function which returns the time in seconds
+        """
+        self.events = events
+        self.sound = sound
+        self.tempo_bpm = tempo_bpm
+        self.clock = clock
+        self.wait_for_press = False
+        self.event_ind = None  # Index of the current event. None if the song was not started.
+        self.is_pressed = False  # If the current note was pressed, in wait for press mode
+        self.t0 = None  # Clock time of beat 0
+        self.played = []  # NoteEvent of the notes played since the last pop_played()
+
+    def start(self, wait_for_press=False, t=None):
+        """ Start the song from the beginning.
+
+        :param wait_for_press: If True, wait for press() on every note
+        :param t: Current time. Taken from the clock if None.
+        """
+        t = self.clock() if t is None else t
+        self.wait_for_press = wait_for_press
+        self.is_pressed = False
+        self.t0 = t
+        if len(self.events) == 0:
+            self.event_ind = 0
+            return
+        self.event_ind = -1
+        self.update(t)
+
+    def update(self, t=None):
+        """ Advance the song according to the clock and play the notes whose time has come.
+
+        :param t: Current time. Taken from the clock if None.
+        :return: True if the current event changed
+        """
+        if not self.is_started() or self.is_finished():
+            return False
+        t = self.clock() if t is None else t
+        is_changed = False
+        while not self.is_finished() and not self._is_waiting() and t >= self._next_event_time():
+            self._advance(t)
+            is_changed = True
+        return is_changed
+
+    def press(self, t=None):
+        """ Mark the current note as pressed by the user. Only has effect in wait for press mode.
+
+        :param t: Current time. Taken from the clock if None.
+        :return: True if the press was accepted
+        """
+        if not self._is_waiting():
+            return False
+        t = self.clock() if t is None else t
+        event = self.current_event
+        self.is_pressed = True
+        # Continue the song from the press time
+        self.t0 = t - self.beats_to_sec(event.onset)
+        self._play(event)
+        return True
+
+    def pop_played(self):
+        """ :return: List of the NoteEvent played since the last call, automatically or by press() """
+        played = self.played
+        self.played = []
+        return played
+
+    @property
+    def current_event(self):
+        """ :return: The current NoteEvent, or None before start and after the song finished """
+        if self.event_ind is None or not (0 <= self.event_ind < len(self.events)):
+            return None
+        return self.events[self.event_ind]
+
+    def is_started(self):
+        return self.event_ind is not None
+
+    def is_finished(self):
+        return self.event_ind is not None and self.event_ind >= len(self.events)
+
+    def beats_to_sec(self, beats):
+        return beats * 60.0 / self.tempo_bpm
+
+    def _is_waiting(self):
+        event = self.current_event
+        return self.wait_for_press and event is not None and event.note is not None and not self.is_pressed
+
+    def _next_event_time(self):
+        next_ind = self.event_ind + 1
+        if next_ind < len(self.events):
+            beats = self.events[next_ind].onset
+        else:
+            # End of the last event
+            beats = self.events[-1].onset + self.events[-1].duration
+        return self.t0 + self.beats_to_sec(beats)
+
+    def _advance(self, t):
+        self.event_ind += 1
+        self.is_pressed = False
+        event = self.current_event
+        if event is None:
+            return
+        if self.wait_for_press:
+            # The song waits for the user, so time is counted from when the event was reached
+            self.t0 = t - self.beats_to_sec(event.onset)
+        elif event.note is not None:
+            self._play(event)
+
+    def _play(self, event):
+        self.sound.play_note_sound(event.note)
+        self.played.append(event)
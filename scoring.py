@@ -0,0 +1,233 @@
+"""
+Performance scoring. ScoreKeeper aligns the stream of key presses with the expected notes of the song as they
+come, and keeps running accuracy and timing metrics in constant memory. Every aligned event can be written to
+a compact binary session log.
+
+Alignment is a windowed matching which follows the player's tempo: the expected time of a note is predicted
+from the last matched note and the measured tempo, and a press matches the nearest unmatched note of the same
+key inside the window. Expected notes which were skipped are missed, and presses which match nothing are
+wrong notes.
+"""
+from __future__ import print_function
+import json
+import os
+import time
+import numpy as np
+
+# Kinds of the log records
+HIT = 0
+WRONG = 1
+MISSED = 2
+KIND_NAMES = ['hit', 'wrong', 'missed']
+
+# t - Time from the start of the song in seconds
+# key - Pressed key index, or the expected key index for a missed note
+# expected_ind - Index of the expected note, -1 for a wrong note
+# error_ms - Press time minus the predicted time of the expected note, 0 if not a hit
+# kind - HIT, WRONG or MISSED
+LOG_DTYPE = np.dtype([('t', np.float64), ('key', np.int16), ('expected_ind', np.int32), ('error_ms', np.float32),
+                      ('kind', np.int8)])
+
+
+class ScoreLog(object):
+    def __init__(self, fn, buffer_size=256):
+        """ Log of LOG_DTYPE records. Records are kept in a fixed buffer and appended to the file when it is
+            full, so logging never allocates and rarely writes.
+
+        :param fn: Log file. A JSON summary is written next to it, with the .json extension.
+        :param buffer_size: Number of records written at once
+        """
+        self.fn = fn
+        self._buffer = np.zeros(buffer_size, LOG_DTYPE)
+        self._num_buffered = 0
+        self.num_records = 0
+        directory = os.path.dirname(fn)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        open(fn, 'wb').close()
+
+    def add(self, t, key, expected_ind, error_ms, kind):
+        self._buffer[self._num_buffered] = (t, key, expected_ind, error_ms, kind)
+        self._num_buffered += 1
+        self.num_records += 1
+        if self._num_buffered == len(self._buffer):
+            self.flush()
+
+    def flush(self):
+        if self._num_buffered == 0:
+            return
+        with open(self.fn, 'ab') as f:
+            self._buffer[:self._num_buffered].tofile(f)
+        self._num_buffered = 0
+
+    def close(self, summary=None):
+        """ :param summary: dictionary to write as the JSON summary, like ScoreKeeper.summary() """
+        self.flush()
+        if summary is not None:
+            with open(os.path.splitext(self.fn)[0] + ".json", 'w') as f:
+                json.dump(summary, f, indent=1, sort_keys=True)
+
+
+def load_score_log(fn):
+    """ :return: LOG_DTYPE array of a session log """
+    return np.fromfile(fn, LOG_DTYPE)
+
+
+class ScoreKeeper(object):
+    def __init__(self, keys, onsets_beats, tempo_bpm, strict_timing=True, window_beats=0.5, lookahead=4,
+                 tempo_alpha=0.2, log=None):
+        """
+
+        :param keys: Key index of every expected note. Rests are not included.
+        :param onsets_beats: Onset of every expected note, in beats
+        :param tempo_bpm: Tempo of the song
+        :param strict_timing: If True, a press matches a note only inside the time window, and notes are missed
+            when their window passed. If False, like when the song waits for every press, a press matches the
+            first of the next lookahead notes with its key, whatever the time.
+        :param window_beats: Half size of the matching window, in beats of the player's tempo
+        :param lookahead: Number of next expected notes a press can match
+        :param tempo_alpha: Smoothing factor of the tempo ratio
+        :param log: ScoreLog, or None
+        """
+        self.keys = np.asarray(keys, np.int32)
+        self.onsets = np.asarray(onsets_beats, np.float64) * 60.0 / tempo_bpm  # In seconds of the song tempo
+        self.strict_timing = strict_timing
+        self.window_beats = window_beats
+        self.beat_sec = 60.0 / tempo_bpm
+        self.lookahead = lookahead
+        self.tempo_alpha = tempo_alpha
+        self.log = log
+        self.reset()
+
+    def reset(self):
+        self.t0 = None  # Clock time of the song start
+        self.next_ind = 0  # First expected note which was not matched or missed
+        self.anchor_t = 0.0  # Song time of the last matched note
+        self.anchor_onset = 0.0  # Expected onset of the last matched note
+        self.tempo_ratio = 1.0  # Played beat duration / expected beat duration
+        self.num_hits = 0
+        self.num_wrong = 0
+        self.num_missed = 0
+        self.streak = 0
+        self.best_streak = 0
+        # Running mean and variance of the timing error (Welford)
+        self._error_mean = 0.0
+        self._error_m2 = 0.0
+        self._abs_error_sum = 0.0
+
+    def start(self, t=None):
+        """ Start scoring from the song start.
+
+        :param t: Clock time of the song start. time.perf_counter() if None.
+        """
+        self.reset()
+        self.t0 = time.perf_counter() if t is None else t
+
+    def is_started(self):
+        return self.t0 is not None
+
+    def predicted_time(self, ind):
+        """ :return: Song time at which the expected note is predicted, from the last match and the tempo """
+        return self.anchor_t + (self.onsets[ind] - self.anchor_onset) * self.tempo_ratio
+
+    def press(self, key, t=None):
+        """ Add a key press.
+
+        :param key: Key index
+        :param t: Clock time of the press. time.perf_counter() if None.
+        :return: Index of the matched expected note, or None for a wrong note
+        """
+        if not self.is_started():
+            return None
+        t = (time.perf_counter() if t is None else t) - self.t0
+        if self.strict_timing:
+            self._miss_until(t)
+        end = min(len(self.keys), self.next_ind + self.lookahead)
+        candidates = self.next_ind + np.flatnonzero(self.keys[self.next_ind:end] == key)
+        match = None
+        if len(candidates) > 0:
+            errors = t - (self.anchor_t + (self.onsets[candidates] - self.anchor_onset) * self.tempo_ratio)
+            if self.strict_timing:
+                best = np.argmin(np.abs(errors))
+                if abs(errors[best]) <= self.window_beats * self.beat_sec * self.tempo_ratio:
+                    match = best
+            else:
+                match = 0
+        if match is None:
+            self.num_wrong += 1
+            self.streak = 0
+            self._log(t, key, -1, 0.0, WRONG)
+            return None
+
+        ind = int(candidates[match])
+        for skipped in range(self.next_ind, ind):
+            self._add_missed(skipped, self.predicted_time(skipped))
+        self._add_hit(ind, t, float(errors[match]))
+        return ind
+
+    def update(self, t=None):
+        """ Mark the notes whose matching window passed as missed. Only with strict_timing.
+
+        :param t: Current clock time. time.perf_counter() if None.
+        """
+        if self.is_started() and self.strict_timing:
+            self._miss_until((time.perf_counter() if t is None else t) - self.t0)
+
+    def is_finished(self):
+        return self.next_ind >= len(self.keys)
+
+    def _miss_until(self, t):
+        window = self.window_beats * self.beat_sec * self.tempo_ratio
+        while self.next_ind < len(self.keys) and self.predicted_time(self.next_ind) + window < t:
+            self._add_missed(self.next_ind, self.predicted_time(self.next_ind))
+
+    def _add_missed(self, ind, t):
+        self.num_missed += 1
+        self.streak = 0
+        self.next_ind = ind + 1
+        self._log(t, self.keys[ind], ind, 0.0, MISSED)
+
+    def _add_hit(self, ind, t, error):
+        # The local tempo, from the previous match
+        beats = self.onsets[ind] - self.anchor_onset
+        if self.num_hits > 0 and beats > 0:
+            ratio = (t - self.anchor_t) / beats
+            self.tempo_ratio += self.tempo_alpha * (ratio - self.tempo_ratio)
+        self.anchor_t = t
+        self.anchor_onset = self.onsets[ind]
+        self.next_ind = ind + 1
+        if self.num_hits > 0:
+            # The first hit sets the timeline, so it has no timing error
+            n = self.num_hits
+            delta = error - self._error_mean
+            self._error_mean += delta / n
+            self._error_m2 += delta * (error - self._error_mean)
+            self._abs_error_sum += abs(error)
+        self.num_hits += 1
+        self.streak += 1
+        self.best_streak = max(self.best_streak, self.streak)
+        self._log(t, self.keys[ind], ind, 1000.0 * error, HIT)
+
+    def _log(self, t, key, expected_ind, error_ms, kind):
+        if self.log is not None:
+            self.log.add(t, key, expected_ind, error_ms, kind)
+
+    def summary(self):
+        """ :return: dictionary with the running metrics """
+        num_timed = self.num_hits - 1
+        total = self.num_hits + self.num_wrong + self.num_missed
+        return {'hits': self.num_hits, 'wrong': self.num_wrong, 'missed': self.num_missed,
+                'expected': len(self.keys), 'progress': self.next_ind,
+                'accuracy': self.num_hits / float(total) if total > 0 else 1.0,
+                'timing_mean_ms': 1000.0 * self._error_mean if num_timed > 0 else 0.0,
+                'timing_std_ms': 1000.0 * np.sqrt(self._error_m2 / num_timed) if num_timed > 0 else 0.0,
+                'timing_mean_abs_ms': 1000.0 * self._abs_error_sum / num_timed if num_timed > 0 else 0.0,
+                'tempo_bpm': 60.0 / (self.beat_sec * self.tempo_ratio),
+                'streak': self.streak, 'best_streak': self.best_streak}
+
+    def summary_text(self):
+        s = self.summary()
+        return ("score: %d/%d hits, %d wrong, %d missed | accuracy %.1f%% | timing %+.0f ms (abs %.0f ms, "
+                "std %.0f ms) | tempo %.0f bpm | best streak %d" %
+                (s['hits'], s['expected'], s['wrong'], s['missed'], 100.0 * s['accuracy'], s['timing_mean_ms'],
+                 s['timing_mean_abs_ms'], s['timing_std_ms'], s['tempo_bpm'], s['best_streak']))
@@ -0,0 +1,297 @@
+"""
+Songs. A song is read from a MIDI file or from the simple text format below, and compiled once into a
+NumPy array of (key index, onset, duration, hand) for the keys of a piano. A Songbook is a directory of song
+files which are loaded only when asked for, with the compiled songs cached on disk.
+
+Text format (.song):
+    # Comment, at the start of a line or after a space
+    title: Ode to Joy
+    tempo: 120
+    hand: right
+    E4 E4 F4 G4:2 br C4+E4:2
+    hand: left
+    C3:4 G2:4
+
+    Notes are played one after the other. NOTE:BEATS sets the duration in beats (1 if not given), br is a
+    rest, and NOTE+NOTE is a chord. Every "hand:" line starts a new voice from the beginning of the song.
+"""
+from __future__ import print_function
+import hashlib
+import os
+import re
+import struct
+import numpy as np
+from notes import midi_to_note, note_to_midi
+from scheduler import REST, NoteEvent
+
+SONG_EXTENSIONS = ('.song', '.mid', '.midi')
+CACHE_DIR = ".compiled"
+
+RIGHT_HAND = 0
+LEFT_HAND = 1
+HANDS = {'right': RIGHT_HAND, 'r': RIGHT_HAND, 'left': LEFT_HAND, 'l': LEFT_HAND}
+
+# key - Piano key index, -1 for a rest
+# onset, duration - In beats from the start of the song
+# hand - RIGHT_HAND or LEFT_HAND
+EVENT_DTYPE = np.dtype([('key', np.int16), ('onset', np.float32), ('duration', np.float32), ('hand', np.int8)])
+
+
+class Song(object):
+    def __init__(self, title, events, tempo_bpm, note_names):
+        """
+
+        :param title: Song title
+        :param events: EVENT_DTYPE array sorted by onset
+        :param tempo_bpm: Tempo in beats per minute
+        :param note_names: Note name of every key index, like Piano.key_list
+        """
+        self.title = title
+        self.events = events
+        self.tempo_bpm = tempo_bpm
+        self.note_names = list(note_names)
+
+    def __len__(self):
+        return len(self.events)
+
+    def to_note_events(self, hand=None):
+        """ :param hand: RIGHT_HAND or LEFT_HAND for the notes of one hand, None for all
+            :return: List of scheduler.NoteEvent
+        """
+        events = self.events if hand is None else self.events[self.events['hand'] == hand]
+        return [NoteEvent(self.note_names[key] if key >= 0 else None, float(onset), float(duration))
+                for key, onset, duration in zip(events['key'], events['onset'], events['duration'])]
+
+
+def normalize_note_name(name):
+    """ :return: Note name as in Piano class, with sharps: "Db4" -> "C#4" """
+    return midi_to_note(note_to_midi(name))
+
+
+def parse_text(text):
+    """ Parse a song in the text format.
+
+    :return: (title, tempo in bpm or None, list of (note name or None for a rest, onset, duration, hand))
+    """
+    title = None
+    tempo = None
+    notes = []
+    hand = RIGHT_HAND
+    onset = 0.0
+    for line_num, line in enumerate(text.splitlines(), 1):
+        line = re.sub(r'(^|\s)#.*$', '', line).strip()  # Comments, but not the sharps
+        if not line:
+            continue
+        match = re.match(r'^([A-Za-z_]+)\s*:(.*)$', line)
+        if match is not None and match.group(1).lower() != REST:
+            key = match.group(1).lower()
+            value = match.group(2).strip()
+            if key == 'title':
+                title = value
+            elif key == 'tempo':
+                tempo = float(value)
+            elif key == 'hand':
+                if value.lower() not in HANDS:
+                    raise ValueError("Line %d: unknown hand %s" % (line_num, value))
+                hand = HANDS[value.lower()]
+                onset = 0.0
+            else:
+                raise ValueError("Line %d: unknown field %s" % (line_num, key))
+            continue
+        for token in line.split():
+            names, _, beats = token.partition(':')
+            try:
+                duration = float(beats) if beats else 1.0
+                if names.lower() == REST:
+                    notes.append((None, onset, duration, hand))
+                else:
+                    for name in names.split('+'):
+                        notes.append((normalize_note_name(name), onset, duration, hand))
+            except ValueError:
+                raise ValueError("Line %d: bad note %s" % (line_num, token))
+            onset += duration
+    return title, tempo, notes
+
+
+def _read_var_len(data, pos):
+    value = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        value = (value << 7) | (b & 0x7F)
+        if not b & 0x80:
+            return value, pos
+
+
+def parse_midi(data):
+    """ Parse a standard MIDI file. The first track with notes is the right hand, and the other tracks are the
+        left hand.
+
+    :param data: File contents
+    :return: (title, tempo in bpm or None, list of (note name, onset, duration, hand))
+    """
+    if data[:4] != b'MThd':
+        raise ValueError("Not a MIDI file")
+    header_len, midi_format, num_tracks, division = struct.unpack('>IHHH', data[4:14])
+    if division & 0x8000:
+        raise ValueError("SMPTE time division is not supported")
+    pos = 8 + header_len
+    title = None
+    tempo = None
+    notes = []
+    num_note_tracks = 0
+    for _ in range(num_tracks):
+        if data[pos:pos + 4] != b'MTrk':
+            raise ValueError("Bad MIDI track header")
+        track_len = struct.unpack('>I', data[pos + 4:pos + 8])[0]
+        pos += 8
+        end = pos + track_len
+        tick = 0
+        status = None
+        playing = {}  # (channel, MIDI note) -> start tick
+        track_notes = []
+        while pos < end:
+            delta, pos = _read_var_len(data, pos)
+            tick += delta
+            if data[pos] & 0x80:
+                status = data[pos]
+                pos += 1
+            if status == 0xFF:
+                meta_type = data[pos]
+                length, pos = _read_var_len(data, pos + 1)
+                if meta_type == 0x51 and tempo is None:
+                    tempo = 60e6 / int.from_bytes(data[pos:pos + 3], 'big')
+                elif meta_type == 0x03 and title is None:
+                    title = data[pos:pos + length].decode('latin-1')
+                pos += length
+                continue
+            if status in (0xF0, 0xF7):
+                length, pos = _read_var_len(data, pos)
+                pos += length
+                continue
+            kind = status & 0xF0
+            channel = status & 0x0F
+            if kind in (0xC0, 0xD0):
+                pos += 1
+                continue
+            note, velocity = data[pos], data[pos + 1]
+            pos += 2
+            if kind == 0x90 and velocity > 0:
+                playing.setdefault((channel, note), tick)
+            elif kind == 0x80 or kind == 0x90:
+                start = playing.pop((channel, note), None)
+                if start is not None:
+                    track_notes.append((note, start, tick))
+        pos = end
+        if track_notes:
+            hand = RIGHT_HAND if num_note_tracks == 0 else LEFT_HAND
+            num_note_tracks += 1
+            notes.extend((midi_to_note(note), start / float(division), (stop - start) / float(division), hand)
+                         for note, start, stop in track_notes)
+    return title, tempo, notes
+
+
+def compile_notes(notes, note_names):
+    """ Compile parsed notes for the keys of a piano. Notes which are not on the piano are dropped.
+
+    :param notes: List of (note name or None for a rest, onset, duration, hand)
+    :param note_names: Note name of every key index, like Piano.key_list
+    :return: (EVENT_DTYPE array sorted by onset, number of dropped notes)
+    """
+    key_index = dict((name, i) for i, name in enumerate(note_names))
+    events = np.zeros(len(notes), EVENT_DTYPE)
+    n = 0
+    for name, onset, duration, hand in notes:
+        key = -1 if name is None else key_index.get(name)
+        if key is None:
+            continue
+        events[n] = (key, onset, duration, hand)
+        n += 1
+    events = events[:n]
+    return events[np.argsort(events['onset'], kind='stable')], len(notes) - n
+
+
+def load_song(fn, note_names):
+    """ Read and compile a song file.
+
+    :param fn: .song or MIDI file
+    :param note_names: Note name of every key index, like Piano.key_list
+    :return: Song
+    """
+    if fn.lower().endswith('.song'):
+        with open(fn) as f:
+            title, tempo, notes = parse_text(f.read())
+    else:
+        with open(fn, 'rb') as f:
+            title, tempo, notes = parse_midi(f.read())
+    events, num_dropped = compile_notes(notes, note_names)
+    if num_dropped > 0:
+        print("%s: %d notes are not on the piano" % (fn, num_dropped))
+    title = title or os.path.splitext(os.path.basename(fn))[0]
+    return Song(title, events, tempo or 120.0, note_names)
+
+
+class Songbook(object):
+    def __init__(self, directory, note_names, cache_dir=None):
+        """ Songs of a directory, compiled when they are first asked for.
+
+        :param directory: Directory of .song and MIDI files
+        :param note_names: Note name of every key index, like Piano.key_list
+        :param cache_dir: Directory of the compiled songs. <directory>/.compiled if None.
+        """
+        self.directory = directory
+        self.note_names = list(note_names)
+        self.cache_dir = cache_dir if cache_dir is not None else os.path.join(directory, CACHE_DIR)
+        self._notes_hash = hashlib.sha1(" ".join(self.note_names).encode('utf-8')).hexdigest()[:12]
+        self._files = None
+        self._songs = {}
+
+    @property
+    def files(self):
+        """ :return: dictionary song name -> file. The directory is listed once. """
+        if self._files is None:
+            self._files = {}
+            for f in sorted(os.listdir(self.directory)):
+                name, ext = os.path.splitext(f)
+                if ext.lower() in SONG_EXTENSIONS:
+                    self._files.setdefault(name, os.path.join(self.directory, f))
+        return self._files
+
+    def names(self):
+        return sorted(self.files)
+
+    def __len__(self):
+        return len(self.files)
+
+    def __contains__(self, name):
+        return name in self.files
+
+    def get(self, name):
+        """ :return: The Song, from memory, the compiled cache or the song file """
+        song = self._songs.get(name)
+        if song is None:
+            if name not in self.files:
+                raise KeyError("No song %s in %s" % (name, self.directory))
+            song = self._load_cached(name)
+            if song is None:
+                song = load_song(self.files[name], self.note_names)
+                self._save_cached(name, song)
+            self._songs[name] = song
+        return song
+
+    def _get_cache_file(self, name):
+        return os.path.join(self.cache_dir, "%s.%s.npz" % (name, self._notes_hash))
+
+    def _load_cached(self, name):
+        fn = self._get_cache_file(name)
+        if not os.path.exists(fn) or os.path.getmtime(fn) < os.path.getmtime(self.files[name]):
+            return None
+        # Close the file here, so the cache can be replaced or deleted
+        with np.load(fn) as d:
+            title, events, tempo_bpm = str(d['title']), d['events'].copy(), float(d['tempo_bpm'])
+        return Song(title, events, tempo_bpm, self.note_names)
+
+    def _save_cached(self, name, song):
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        np.savez(self._get_cache_file(name), title=song.title, events=song.events, tempo_bpm=song.tempo_bpm)
@@ -0,0 +1,280 @@
+"""
+Multi-station host. One process drives several pianos, each with its own camera, projector, sound output,
+configuration file and calibration. Every station has its own Manager, so the piano state of the stations is
+apart, while the things which do not change (AruCo dictionary and detector parameters, compiled songs and the
+sound sample bank) are loaded once and shared, see resources.py.
+
+The stations run as asyncio tasks. Camera reads and frame processing run in a thread pool, where OpenCV
+releases the GIL, and rendering runs on the loop thread, which owns the windows. Processing takes a slot of a
+fair scheduler: a station which was just served waits behind the stations which asked before it, so a busy
+station can not starve the others.
+
+Usage:
+    python stations.py station1.json station2.json [--display window|headless] [--sound mixer|none]
+"""
+from __future__ import print_function
+import argparse
+import asyncio
+import collections
+import os
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2
+from config import ConfigStore
+from manager import Manager
+from media import HeadlessDisplay, HeadlessSound, WindowDisplay
+from pipeline import StageTimer
+
+
+class FairScheduler(object):
+    def __init__(self, num_slots):
+        """ Processing slots given in the order they were asked for. A released slot goes directly to the
+            longest waiting station.
+
+        :param num_slots: Number of stations which may process at once, about the number of free CPU cores
+        """
+        self.num_slots = num_slots
+        self._num_free = num_slots
+        self._waiters = collections.deque()
+
+    async def acquire(self):
+        if self._num_free > 0 and not self._waiters:
+            self._num_free -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was handed over just before the cancel
+                self.release()
+            raise
+
+    def release(self):
+        while self._waiters:
+            future = self._waiters.popleft()
+            if not future.done():
+                future.set_result(None)
+                return
+        self._num_free += 1
+
+
+class Station(object):
+    def __init__(self, name, manager, cap=None, display=None, sound=None):
+        """
+
+        :param name: Station name, for the stats and the window
+        :param manager: Manager of the station
+        :param cap: Capture object, like in Manager.run(). The camera of the station if None.
+        :param display: Display object, like media.WindowDisplay
+        :param sound: Sound object, like audio.SoundEngine
+        """
+        self.name = name
+        self.manager = manager
+        self.cap = cap
+        self.display = display
+        self.sound = sound
+        self.is_open = False
+        self.error = None  # Traceback text if the station stopped on an error
+        self.latency = StageTimer('latency')  # Camera read to rendered frame
+        self.wait = StageTimer('wait')  # Waiting for a processing slot
+        self.cpu_sec = 0.0  # Thread CPU time of the processing
+
+    def as_dict(self):
+        """ :return: dictionary with the station statistics, for monitoring """
+        stats = self.manager.stats.as_dict()
+        elapsed = stats['elapsed_sec']
+        render = self.manager.stats.timer('render')
+        return {'name': self.name, 'frames': render.count, 'fps': render.count / elapsed if elapsed > 0 else 0.0,
+                'latency_p50_ms': 1000.0 * self.latency.percentile(50),
+                'latency_p95_ms': 1000.0 * self.latency.percentile(95),
+                'wait_p95_ms': 1000.0 * self.wait.percentile(95),
+                'cpu_sec': self.cpu_sec, 'load_level': self.manager.controller.level_ind,
+                'error': self.error, 'stages': stats['stages']}
+
+    def summary(self):
+        d = self.as_dict()
+        text = ("%s: %.1f fps | latency p50 %.1f ms, p95 %.1f ms | wait p95 %.1f ms | cpu %.1f s | level %d" %
+                (d['name'], d['fps'], d['latency_p50_ms'], d['latency_p95_ms'], d['wait_p95_ms'], d['cpu_sec'],
+                 d['load_level']))
+        return text if self.error is None else text + " | stopped on error"
+
+
+def _process_timed(manager, item):
+    """ :return: (result of Manager.process_step, thread CPU time in seconds) """
+    t = time.thread_time()
+    result = manager.process_step(item)
+    return result, time.thread_time() - t
+
+
+class StationHost(object):
+    def __init__(self, stations, max_parallel=None):
+        """
+
+        :param stations: List of Station
+        :param max_parallel: Number of stations which may process frames at once. The number of CPU cores
+            less one, for the loop thread, if None.
+        """
+        self.stations = stations
+        self.max_parallel = max_parallel or max(1, (os.cpu_count() or 2) - 1)
+        self.stats_interval_sec = 10.0  # Seconds between stats prints. None to disable.
+        self.key_quit = 'q'
+        self.is_running = False
+        self._executor = None
+        self._scheduler = None
+
+    def run(self):
+        """ Run all the stations until they end, or until the quit key is pressed in a window """
+        try:
+            # Calibrations show on the projector of the station, so they run one after the other
+            for station in self.stations:
+                station.cap = station.manager.open_session(station.cap, station.display, station.sound)
+                station.is_open = True
+            # Every station may block on its camera, besides the processing slots
+            self._executor = ThreadPoolExecutor(max_workers=len(self.stations) + self.max_parallel)
+            asyncio.run(self._run())
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+            for station in self.stations:
+                if station.is_open:
+                    print("%s:" % station.name)
+                    station.manager.close_session(station.cap)
+                    station.is_open = False
+            print(self.summary())
+
+    async def _run(self):
+        self.is_running = True
+        self._scheduler = FairScheduler(self.max_parallel)
+        helpers = [asyncio.ensure_future(self._print_stats())]
+        if any(isinstance(x.display, WindowDisplay) for x in self.stations):
+            helpers.append(asyncio.ensure_future(self._poll_windows()))
+        try:
+            await asyncio.gather(*[self._run_station(x) for x in self.stations])
+        finally:
+            self.is_running = False
+            for task in helpers:
+                task.cancel()
+            await asyncio.gather(*helpers, return_exceptions=True)
+
+    async def _run_station(self, station):
+        loop = asyncio.get_running_loop()
+        manager = station.manager
+        try:
+            while self.is_running and manager.is_running:
+                t_start = time.perf_counter()
+                item = await loop.run_in_executor(self._executor, manager.capture_step, station.cap)
+                if item is None:
+                    break
+                t_wait = time.perf_counter()
+                await self._scheduler.acquire()
+                station.wait.add(time.perf_counter() - t_wait)
+                try:
+                    result, cpu_sec = await loop.run_in_executor(self._executor, _process_timed, manager, item)
+                finally:
+                    self._scheduler.release()
+                station.cpu_sec += cpu_sec
+                # The windows belong to the loop thread
+                if not manager.render_step(result):
+                    break
+                station.latency.add(time.perf_counter() - t_start)
+        except Exception:
+            # The other stations keep running
+            station.error = traceback.format_exc()
+            print("Station %s stopped:\n%s" % (station.name, station.error))
+
+    async def _poll_windows(self):
+        while self.is_running:
+            key = cv2.waitKey(1)
+            if key & 0xFF == ord(self.key_quit):
+                self.is_running = False
+                break
+            await asyncio.sleep(0.01)
+
+    async def _print_stats(self):
+        if not self.stats_interval_sec:
+            return
+        while self.is_running:
+            await asyncio.sleep(self.stats_interval_sec)
+            print(self.summary())
+
+    def as_dict(self):
+        return {'max_parallel': self.max_parallel, 'stations': [x.as_dict() for x in self.stations]}
+
+    def summary(self):
+        return "\n".join(x.summary() for x in self.stations)
+
+
+def create_stations(config_paths, display='window', sound='mixer', undistort_mode='points', song="default",
+                    score_log_dir=None):
+    """ Create a station of every configuration file. The stations share one SharedResources.
+
+    :param config_paths: Configuration file of every station, like piano_config.json
+    :param display: 'window' for a full screen window on the projector of the station, or 'headless'
+    :param sound: 'mixer' for the low latency mixer on the sound device of the station, or 'none'
+    :param undistort_mode: Like in Manager
+    :param song: Song name in the songs directory
+    :param score_log_dir: Directory of the score logs, with a subdirectory of every station. None to not write them.
+    :return: List of Station
+    """
+    stations = []
+    resources = None
+    for path in config_paths:
+        name = os.path.splitext(os.path.basename(path))[0]
+        store = ConfigStore(path)
+        manager = Manager(store, undistort_mode=undistort_mode, resources=resources)
+        resources = manager.resources
+        manager.load_song(song)
+        manager.show_windows = False  # The debug windows of the stations would have the same names
+        manager.stats_print_freq = None  # The host prints the stats of all the stations
+        if score_log_dir is not None:
+            manager.score_log_dir = os.path.join(score_log_dir, name)
+        if display == 'headless':
+            station_display = HeadlessDisplay()
+            if manager.cam_to_proj is None:
+                manager.cam_to_proj = manager.get_stored_cam_to_proj()
+                if manager.cam_to_proj is None:
+                    print("%s: no projector calibration, using the identity" % name)
+                    manager.cam_to_proj = np.eye(3)
+        else:
+            station_display = WindowDisplay(name, offset_x=manager.display_offset_x)
+        if sound == 'mixer':
+            station_sound = resources.create_sound_engine(device=store.get('devices', 'sound_device'))
+            station_sound.start()
+        else:
+            station_sound = HeadlessSound()
+        stations.append(Station(name, manager, display=station_display, sound=station_sound))
+    return stations
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run several piano stations in one process")
+    parser.add_argument('configs', nargs='+', help="Configuration file of every station")
+    parser.add_argument('--display', choices=['window', 'headless'], default='window')
+    parser.add_argument('--sound', choices=['mixer', 'none'], default='mixer')
+    parser.add_argument('--undistort', choices=['points', 'frames', 'none'], default='points')
+    parser.add_argument('--song', default="default", help="Song name in the songs directory")
+    parser.add_argument('--max-parallel', type=int, help="Stations which may process frames at once")
+    parser.add_argument('--stats-interval', type=float, default=10.0, help="Seconds between stats prints")
+    parser.add_argument('--score-log', metavar='DIR', help="Write the score of every session to a directory")
+    args = parser.parse_args(argv)
+
+    stations = create_stations(args.configs, display=args.display, sound=args.sound,
+                               undistort_mode=None if args.undistort == 'none' else args.undistort, song=args.song,
+                               score_log_dir=args.score_log)
+    host = StationHost(stations, max_parallel=args.max_parallel)
+    host.stats_interval_sec = args.stats_interval
+    try:
+        host.run()
+    finally:
+        for station in stations:
+            if hasattr(station.sound, 'close'):
+                station.sound.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Press detection through the real background model: frames go through RegionBackgroundSubtractor (MOG2) and
+the foreground masks into KeyPressDetector, like in Manager.
+"""
+import pytest
+
+np = pytest.importorskip('numpy')
+cv2 = pytest.importorskip('cv2')
+
+from background import RegionBackgroundSubtractor
+from detection import KeyPressDetector
+
+IMAGE_SIZE = (160, 120)  # (width, height)
+
+
+def make_label_map():
+    """ Two keys side by side """
+    label_map = np.full((IMAGE_SIZE[1], IMAGE_SIZE[0]), -1, np.int16)
+    label_map[30:90, 20:70] = 0
+    label_map[30:90, 90:140] = 1
+    return label_map
+
+
+def run_frames(frames, model='mog2'):
+    """ :return: List of (frame index, KeyEvent) """
+    bg_subtractor = RegionBackgroundSubtractor(IMAGE_SIZE, model=model)
+    detector = KeyPressDetector(2)
+    label_map = make_label_map()
+    events = []
+    for i, gray in enumerate(frames):
+        fgmask = bg_subtractor.apply(gray)
+        if i < 10:
+            # Wait for the model to learn the background, like Manager
+            continue
+        events.extend((i, e) for e in detector.update(fgmask, label_map, 1))
+    return events
+
+
+def board_frames(num_frames, finger_intervals=()):
+    """ :param finger_intervals: List of (first frame, end frame) in which a finger rests on key 1 """
+    rng = np.random.RandomState(0)
+    frames = []
+    for i in range(num_frames):
+        gray = np.clip(200 + rng.randint(-2, 3, (IMAGE_SIZE[1], IMAGE_SIZE[0])), 0, 255).astype(np.uint8)
+        if any(first <= i < end for first, end in finger_intervals):
+            gray[40:90, 105:125] = 80
+        frames.append(gray)
+    return frames
+
+
+@pytest.mark.parametrize('model', ['mog2', 'running_average'])
+def test_resting_finger_is_pressed_once(model):
+    events = run_frames(board_frames(40, [(20, 40)]), model=model)
+    presses = [(i, e.key_ind) for i, e in events if e.is_press]
+    assert presses == [(20, 1)]
+
+
+@pytest.mark.parametrize('model', ['mog2', 'running_average'])
+def test_press_again_after_release(model):
+    events = run_frames(board_frames(80, [(20, 30), (60, 80)]), model=model)
+    assert [i for i, e in events if e.is_press] == [20, 60]
+    assert all(e.key_ind == 1 for _, e in events)
+
+
+@pytest.mark.parametrize('model', ['mog2', 'running_average'])
+def test_lift_is_not_pressed(model):
+    events = run_frames(board_frames(50, [(20, 30)]), model=model)
+    assert [(i, e.key_ind) for i, e in events if e.is_press] == [(20, 1)]
+
+
+def test_static_board_is_not_pressed():
+    assert run_frames(board_frames(40)) == []
@@ -0,0 +1,37 @@
+from scheduler import NoteScheduler, events_from_note_names
+
+
+class FakeSound(object):
+    def __init__(self):
+        self.notes = []
+
+    def play_note_sound(self, name):
+        self.notes.append(name)
+
+
+def make_scheduler(names):
+    sound = FakeSound()
+    # 60 bpm, so a beat is a second
+    return NoteScheduler(events_from_note_names(names), sound, tempo_bpm=60.0, clock=lambda: 0.0), sound
+
+
+def test_auto_played_notes_are_reported():
+    scheduler, sound = make_scheduler(['C4', 'br', 'D4'])
+    scheduler.start(t=0.0)
+    assert [e.note for e in scheduler.pop_played()] == ['C4']
+    scheduler.update(t=2.5)
+    assert [e.note for e in scheduler.pop_played()] == ['D4']
+    assert scheduler.pop_played() == []
+    assert sound.notes == ['C4', 'D4']
+
+
+def test_pressed_notes_are_reported():
+    scheduler, sound = make_scheduler(['C4', 'D4'])
+    scheduler.start(wait_for_press=True, t=0.0)
+    scheduler.update(t=5.0)
+    assert scheduler.pop_played() == []
+    assert scheduler.press(t=5.0)
+    assert [e.note for e in scheduler.pop_played()] == ['C4']
+    assert not scheduler.press(t=5.5)
+    assert scheduler.pop_played() == []
+    assert sound.notes == ['C4']
@@ -0,0 +1,123 @@
+"""
+Per-frame latency tracing. Manager marks named events (capture, detect, press, sound, flip) with the id of
+the camera frame they belong to. The marks are kept in a fixed size ring buffer and can be written as
+Chrome trace JSON (chrome://tracing, Perfetto) or summarized as latency percentiles between events.
+"""
+import csv
+import itertools
+import json
+import time
+import numpy as np
+
+# Latencies reported by Tracer.summary, as (from event, to event) of the same frame
+DEFAULT_SPANS = [('capture', 'detect'), ('capture', 'press'), ('press', 'sound'), ('capture', 'sound'),
+                 ('capture', 'flip')]
+
+
+class Tracer(object):
+    def __init__(self, capacity=20000, enabled=False, clock=time.perf_counter):
+        """
+
+        :param capacity: Number of marks kept. Older marks are overwritten.
+        :param enabled: If False, mark() returns immediately
+        :param clock: Function which returns the time in seconds
+        """
+        self.enabled = enabled
+        self.capacity = capacity
+        self.clock = clock
+        self.event_names = []
+        self._event_codes = {}
+        self._frame_ids = np.zeros(capacity, np.int64)
+        self._codes = np.zeros(capacity, np.int16)
+        self._times = np.zeros(capacity, np.float64)
+        self._counter = itertools.count()  # next() is atomic, so marks may come from several threads
+        self._num_marks = 0
+
+    def mark(self, frame_id, name, t=None):
+        """ Mark an event of a frame.
+
+        :param frame_id: Camera frame id
+        :param name: Event name
+        :param t: Event time. Taken from the clock if None.
+        """
+        if not self.enabled:
+            return
+        t = self.clock() if t is None else t
+        code = self._event_codes.get(name)
+        if code is None:
+            code = self._event_codes.setdefault(name, len(self._event_codes))
+            if code == len(self.event_names):
+                self.event_names.append(name)
+        ind = next(self._counter)
+        i = ind % self.capacity
+        self._frame_ids[i] = frame_id
+        self._codes[i] = code
+        self._times[i] = t
+        self._num_marks = ind + 1
+
+    def clear(self):
+        self._counter = itertools.count()
+        self._num_marks = 0
+
+    def get_marks(self):
+        """ :return: (frame ids, event names, times) arrays of the kept marks, oldest first """
+        n = min(self._num_marks, self.capacity)
+        start = self._num_marks % self.capacity if self._num_marks > self.capacity else 0
+        order = (np.arange(n) + start) % self.capacity
+        names = np.array(self.event_names, dtype=object)[self._codes[order]] if n > 0 else np.array([], object)
+        return self._frame_ids[order], names, self._times[order]
+
+    def get_latencies(self, from_event, to_event):
+        """ Latency between two events of the same frame, for all the frames which have both.
+
+        :return: Array of latencies in seconds
+        """
+        frame_ids, names, times = self.get_marks()
+        first_from = {}
+        first_to = {}
+        for frame_id, name, t in zip(frame_ids, names, times):
+            if name == from_event:
+                first_from.setdefault(frame_id, t)
+            elif name == to_event:
+                first_to.setdefault(frame_id, t)
+        return np.array([first_to[x] - first_from[x] for x in first_to if x in first_from])
+
+    def summary(self, spans=DEFAULT_SPANS):
+        """ :return: dictionary (from event, to event) -> {'count', 'p50_ms', 'p95_ms', 'p99_ms'} """
+        d = {}
+        for span in spans:
+            lat = self.get_latencies(*span)
+            if len(lat) == 0:
+                d[span] = {'count': 0, 'p50_ms': 0.0, 'p95_ms': 0.0, 'p99_ms': 0.0}
+                continue
+            p50, p95, p99 = 1000.0 * np.percentile(lat, [50, 95, 99])
+            d[span] = {'count': len(lat), 'p50_ms': float(p50), 'p95_ms': float(p95), 'p99_ms': float(p99)}
+        return d
+
+    def dump_csv(self, fn, spans=DEFAULT_SPANS):
+        """ Write the latency summary as CSV """
+        with open(fn, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(['from', 'to', 'count', 'p50_ms', 'p95_ms', 'p99_ms'])
+            for (from_event, to_event), s in self.summary(spans).items():
+                writer.writerow([from_event, to_event, s['count'], "%.3f" % s['p50_ms'], "%.3f" % s['p95_ms'],
+                                 "%.3f" % s['p99_ms']])
+
+    def dump_chrome_trace(self, fn):
+        """ Write the marks as Chrome trace JSON. Every mark is an instant event, and every frame is a
+            complete event from its first mark to its last one.
+        """
+        frame_ids, names, times = self.get_marks()
+        events = []
+        frames = {}
+        for frame_id, name, t in zip(frame_ids, names, times):
+            ts = 1e6 * t
+            events.append({'name': name, 'ph': 'i', 's': 't', 'ts': ts, 'pid': 0, 'tid': 0,
+                           'args': {'frame': int(frame_id)}})
+            t_min, t_max = frames.get(frame_id, (ts, ts))
+            frames[frame_id] = (min(t_min, ts), max(t_max, ts))
+        for frame_id, (t_min, t_max) in frames.items():
+            events.append({'name': "frame %d" % frame_id, 'ph': 'X', 'ts': t_min, 'dur': t_max - t_min,
+                           'pid': 0, 'tid': 1})
+        with open(fn, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
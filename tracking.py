@@ -0,0 +1,123 @@
+"""
+AruCo marker tracking. After all the tracked markers were found in one frame, the next frames are searched
+only in small regions around the last known marker positions.
+"""
+import numpy as np
+import cv2
+
+
+class MarkerTracker(object):
+    def __init__(self, aruco_dict, detect_params, marker_ids, roi_padding=0.5, roi_min_padding_px=10):
+        """
+
+        :param aruco_dict: OpenCV's AruCo dictionary type
+        :param detect_params: OpenCV's AruCo DetectorParameters
+        :param marker_ids: List of the marker IDs to track, like Piano.markers_ids
+        :param roi_padding: Padding around the last marker position, in units of the marker size in pixels
+        :param roi_min_padding_px: Minimal padding around the last marker position, in pixels
+        """
+        self.aruco_dict = aruco_dict
+        self.detect_params = detect_params
+        self.marker_ids = list(marker_ids)
+        self.roi_padding = roi_padding
+        self.roi_min_padding_px = roi_min_padding_px
+        self.last_corners = {}  # Marker ID -> (4, 2) corners in the last frame the marker was found
+        self.is_locked = False  # If all the markers were found in the last frame
+        self.scale = 1.0  # Image scale of the detection. Smaller is faster and less accurate.
+        self.interval = 1  # While locked, detect every interval frames and return the last corners in between
+        self.num_full_scans = 0
+        self.num_roi_scans = 0
+        self.num_skipped_scans = 0
+        self._num_since_scan = 0
+
+    def reset(self):
+        self.last_corners = {}
+        self.is_locked = False
+
+    def detect(self, gray):
+        """ Detect the markers. Same output format as cv2.aruco.detectMarkers.
+            While locked only the tracked markers are returned.
+
+        :param gray: Gray image
+        :return: (corners, ids). corners is a list of (1, 4, 2) arrays and ids is a (N, 1) array, or None
+            if no markers were found.
+        """
+        if self.is_locked and self._num_since_scan + 1 < self.interval:
+            self._num_since_scan += 1
+            self.num_skipped_scans += 1
+            return ([self.last_corners[x].reshape(1, 4, 2).copy() for x in self.marker_ids],
+                    np.array(self.marker_ids, np.int32).reshape(-1, 1))
+        self._num_since_scan = 0
+
+        if self.is_locked:
+            corners, ids = self._detect_in_rois(gray)
+            if ids is not None:
+                self.num_roi_scans += 1
+                return corners, ids
+
+        # Not locked yet or a marker was lost, so scan the full frame
+        self.num_full_scans += 1
+        corners, ids = self._detect_markers(gray)
+        self._update(corners, ids)
+        return corners, ids
+
+    def get_roi(self, marker_id, image_shape):
+        """ Get the search region of a marker.
+
+        :param marker_id: Marker ID
+        :param image_shape: Shape of the image
+        :return: (x0, y0, x1, y1) in pixels, or None if the marker position is not known
+        """
+        if marker_id not in self.last_corners:
+            return None
+        c = self.last_corners[marker_id]
+        c_min = c.min(axis=0)
+        c_max = c.max(axis=0)
+        pad = max(self.roi_padding * float(np.max(c_max - c_min)), self.roi_min_padding_px)
+        x0 = int(max(0, np.floor(c_min[0] - pad)))
+        y0 = int(max(0, np.floor(c_min[1] - pad)))
+        x1 = int(min(image_shape[1], np.ceil(c_max[0] + pad)))
+        y1 = int(min(image_shape[0], np.ceil(c_max[1] + pad)))
+        return x0, y0, x1, y1
+
+    def _detect_in_rois(self, gray):
+        found_corners = []
+        for marker_id in self.marker_ids:
+            roi = self.get_roi(marker_id, gray.shape)
+            if roi is None:
+                return None, None
+            x0, y0, x1, y1 = roi
+            corners, ids = self._detect_markers(gray[y0:y1, x0:x1])
+            if ids is None:
+                return None, None
+            ind = np.flatnonzero(ids.flatten() == marker_id)
+            if len(ind) == 0:
+                # The marker was lost
+                return None, None
+            found_corners.append(corners[ind[0]] + np.array([x0, y0], np.float32))
+        ids = np.array(self.marker_ids, np.int32).reshape(-1, 1)
+        self._update(found_corners, ids)
+        return found_corners, ids
+
+    def _detect_markers(self, gray):
+        """ cv2.aruco.detectMarkers at the detection scale. The corners are in the coordinates of gray. """
+        if self.scale == 1.0:
+            corners, ids, rejectedImgPoints = cv2.aruco.detectMarkers(gray, self.aruco_dict,
+                                                                     parameters=self.detect_params)
+            return corners, ids
+        small = cv2.resize(gray, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        corners, ids, rejectedImgPoints = cv2.aruco.detectMarkers(small, self.aruco_dict,
+                                                                 parameters=self.detect_params)
+        # Pixel centers of the small image back to the full image
+        corners = [((c + 0.5) / self.scale - 0.5).astype(np.float32) for c in corners]
+        return corners, ids
+
+    def _update(self, corners, ids):
+        if ids is None:
+            self.is_locked = False
+            return
+        ids = ids.flatten()
+        for i, marker_id in enumerate(ids):
+            if marker_id in self.marker_ids:
+                self.last_corners[int(marker_id)] = corners[i][0].copy()
+        self.is_locked = all(x in ids for x in self.marker_ids)
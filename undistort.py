@@ -0,0 +1,101 @@
+"""
+Camera lens undistortion. Points can be moved between the raw (distorted) camera image and the undistorted
+image, which costs almost nothing per frame. Whole frames can also be undistorted with remap tables.
+The tables are built once per camera and resolution, and cached to disk.
+"""
+import hashlib
+import os
+import numpy as np
+import cv2
+
+
+class Undistorter(object):
+    def __init__(self, cam_mtx, dist_coeffs, image_size, cache_dir=".cache"):
+        """
+
+        :param cam_mtx: 3x3 camera matrix
+        :param dist_coeffs: Distortion coefficients, as from cv2.calibrateCamera
+        :param image_size: Camera image size (width, height)
+        :param cache_dir: Directory for the cached tables. None to not cache.
+        """
+        self.cam_mtx = np.asarray(cam_mtx, np.float64)
+        self.dist_coeffs = np.asarray(dist_coeffs, np.float64).ravel()
+        self.image_size = tuple(image_size)
+        self.cache_dir = cache_dir
+        self._tables = None
+
+    def undistort_points(self, pts):
+        """ Move points from the raw camera image to the undistorted image.
+
+        :param pts: Array of points with shape (..., 2)
+        :return: Array of the same shape
+        """
+        pts = np.asarray(pts, np.float64)
+        out = cv2.undistortPoints(pts.reshape(-1, 1, 2), self.cam_mtx, self.dist_coeffs, P=self.cam_mtx)
+        return out.reshape(pts.shape)
+
+    def distort_points(self, pts):
+        """ Move points from the undistorted image to the raw camera image.
+
+        :param pts: Array of points with shape (..., 2)
+        :return: Array of the same shape
+        """
+        pts = np.asarray(pts, np.float64)
+        flat = pts.reshape(-1, 2)
+        # Normalized camera coordinates, projected again through the lens model
+        normalized = (flat - self.cam_mtx[:2, 2]) / np.array([self.cam_mtx[0, 0], self.cam_mtx[1, 1]])
+        object_pts = np.hstack([normalized, np.ones((len(flat), 1))]).reshape(-1, 1, 3)
+        zeros = np.zeros(3)
+        out, _ = cv2.projectPoints(object_pts, zeros, zeros, self.cam_mtx, self.dist_coeffs)
+        return out.reshape(pts.shape)
+
+    def undistort_image(self, img):
+        """ Undistort a whole camera frame with the remap tables """
+        map1, map2, grid = self.get_tables()
+        return cv2.remap(img, map1, map2, cv2.INTER_LINEAR)
+
+    def get_undistorted_grid(self):
+        """ :return: (height, width, 2) float32 position in the undistorted image of every raw image pixel """
+        return self.get_tables()[2]
+
+    def get_tables(self):
+        """ :return: (map1, map2, grid). map1 and map2 are the fixed point remap tables of
+            cv2.initUndistortRectifyMap, grid is as returned by get_undistorted_grid.
+        """
+        if self._tables is None:
+            self._tables = self._load_tables()
+            if self._tables is None:
+                self._tables = self._build_tables()
+                self._save_tables(self._tables)
+        return self._tables
+
+    def _get_cache_file(self):
+        if self.cache_dir is None:
+            return None
+        h = hashlib.sha1(self.cam_mtx.tobytes() + self.dist_coeffs.tobytes() +
+                         np.array(self.image_size, np.int64).tobytes()).hexdigest()
+        return os.path.join(self.cache_dir, "undistort_%s.npz" % h[:16])
+
+    def _load_tables(self):
+        fn = self._get_cache_file()
+        if fn is None or not os.path.exists(fn):
+            return None
+        with np.load(fn) as d:
+            return d['map1'].copy(), d['map2'].copy(), d['grid'].copy()
+
+    def _save_tables(self, tables):
+        fn = self._get_cache_file()
+        if fn is None:
+            return
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        map1, map2, grid = tables
+        np.savez(fn, map1=map1, map2=map2, grid=grid)
+
+    def _build_tables(self):
+        width, height = self.image_size
+        map1, map2 = cv2.initUndistortRectifyMap(self.cam_mtx, self.dist_coeffs, None, self.cam_mtx,
+                                                 self.image_size, cv2.CV_16SC2)
+        xs, ys = np.meshgrid(np.arange(width, dtype=np.float64), np.arange(height, dtype=np.float64))
+        grid = self.undistort_points(np.dstack([xs, ys])).astype(np.float32)
+        return map1, map2, grid
@@ -0,0 +1,164 @@
+"""
+Multiprocess vision. The main process captures the camera frames and writes them, in gray, or in colour
+for the fingertip press detector, to a shared memory ring buffer. Two worker processes read them from there, so detection does not compete with rendering
+and sound for the GIL:
+    marker worker - tracks the AruCo markers and the piano pose
+    press worker - runs the background model and the key press detector
+Only frame ids go to the workers, and only small events come back: piano poses and key events.
+"""
+import queue
+import traceback
+from multiprocessing import shared_memory
+import numpy as np
+
+# Events sent to the main process
+POSE = 'pose'  # (POSE, frame id, number of visible markers, board_to_image or None if unchanged, geometry version)
+KEYS = 'keys'  # (KEYS, frame id, list of detection.KeyEvent)
+ERROR = 'error'  # (ERROR, worker name, traceback text)
+
+
+class SharedFrameRing(object):
+    def __init__(self, shape, dtype=np.uint8, num_slots=8, name=None):
+        """ Ring buffer of frames in shared memory. Frame i is written to slot i % num_slots, so a reader which
+            falls behind by num_slots frames loses frames instead of blocking the writer.
+
+        :param shape: Frame shape
+        :param dtype: Frame type
+        :param num_slots: Number of frames in the ring
+        :param name: Name of an existing ring to attach to. A new ring is created if None.
+        """
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.num_slots = num_slots
+        header_size = 8 * num_slots
+        frame_size = int(np.prod(self.shape)) * self.dtype.itemsize
+        self.is_owner = name is None
+        if self.is_owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=header_size + num_slots * frame_size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self._frame_ids = np.ndarray((num_slots,), np.int64, buffer=self.shm.buf)  # Frame id of every slot
+        self._frames = np.ndarray((num_slots,) + self.shape, self.dtype, buffer=self.shm.buf, offset=header_size)
+        if self.is_owner:
+            self._frame_ids[:] = -1
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def write(self, frame_id, frame):
+        i = frame_id % self.num_slots
+        self._frame_ids[i] = -1  # Readers skip the slot while it is written
+        self._frames[i] = frame
+        self._frame_ids[i] = frame_id
+
+    def read(self, frame_id, out):
+        """ Copy a frame.
+
+        :param frame_id: Id of the frame
+        :param out: Array of the frame shape to copy into
+        :return: out, or None if the frame was already overwritten
+        """
+        i = frame_id % self.num_slots
+        if self._frame_ids[i] != frame_id:
+            return None
+        out[:] = self._frames[i]
+        if self._frame_ids[i] != frame_id:
+            # Overwritten while copying
+            return None
+        return out
+
+    def close(self):
+        # The views must be released before the memory is closed
+        self._frame_ids = None
+        self._frames = None
+        self.shm.close()
+        if self.is_owner:
+            self.shm.unlink()
+
+
+def _get_latest(in_queue):
+    """ Wait for an item and skip to the newest one. None (stop) is never skipped. """
+    item = in_queue.get()
+    while item is not None:
+        try:
+            item = in_queue.get_nowait()
+        except queue.Empty:
+            break
+    return item
+
+
+def marker_worker(ring_name, shape, num_slots, in_queue, out_queue, aruco_dict_id, piano_kwargs):
+    """ Worker process which tracks the piano pose. Reads frame ids from in_queue, always the newest, and
+        stops at None.
+    """
+    import cv2
+    from piano import Piano
+    from tracking import MarkerTracker
+    ring = SharedFrameRing(shape, num_slots=num_slots, name=ring_name)
+    try:
+        piano = Piano(**piano_kwargs)
+        detect_params = cv2.aruco.DetectorParameters_create()
+        detect_params.doCornerRefinement = True
+        tracker = MarkerTracker(cv2.aruco.getPredefinedDictionary(aruco_dict_id), detect_params, piano.markers_ids)
+        frame = np.empty(shape, np.uint8)
+        while True:
+            frame_id = _get_latest(in_queue)
+            if frame_id is None:
+                break
+            if ring.read(frame_id, frame) is None:
+                continue
+            gray = frame if frame.ndim == 2 else cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            corners, ids = tracker.detect(gray)
+            is_changed = ids is not None and len(ids) > 0 and piano.update_coordinates(corners, ids)
+            out_queue.put((POSE, frame_id, 0 if ids is None else len(ids),
+                           piano.board_to_image if is_changed else None, piano.geometry_version))
+    except Exception:
+        out_queue.put((ERROR, 'markers', traceback.format_exc()))
+    finally:
+        ring.close()
+
+
+def press_worker(ring_name, shape, num_slots, in_queue, out_queue, piano_kwargs, bg_model, bg_padding_px,
+                 press_detector, press_threshold):
+    """ Worker process which detects key presses. Reads from in_queue, in order:
+            (frame id, True if presses should be detected in the frame) - a new frame
+            (POSE, board_to_image, geometry version) - a new piano pose from the marker worker
+            None - stop
+    """
+    import cv2
+    from background import RegionBackgroundSubtractor
+    from detection import create_detector
+    from piano import Piano
+    ring = SharedFrameRing(shape, num_slots=num_slots, name=ring_name)
+    try:
+        piano = Piano(**piano_kwargs)
+        bg_subtractor = RegionBackgroundSubtractor((shape[1], shape[0]), model=bg_model)
+        detector = create_detector(press_detector, len(piano.key_list), press_threshold=press_threshold)
+        frame = np.empty(shape, np.uint8)
+        num_model_frames = 0  # Frames since the background model started
+        while True:
+            item = in_queue.get()
+            if item is None:
+                break
+            if item[0] == POSE:
+                piano.set_pose(item[1], item[2])
+                continue
+            frame_id, is_detecting = item
+            if ring.read(frame_id, frame) is None:
+                continue
+            gray = frame if frame.ndim == 2 else cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            if bg_subtractor.set_region(piano.get_bounding_box(bg_padding_px)):
+                num_model_frames = 0
+            fgmask = bg_subtractor.apply(gray)
+            num_model_frames += 1
+            # Wait for the new model to learn the background, like Manager
+            if is_detecting and num_model_frames > 8 and piano.is_initialize():
+                key_events = detector.update(fgmask, piano.get_label_map(), piano.geometry_version,
+                                             img=None if frame.ndim == 2 else frame)
+                if key_events:
+                    out_queue.put((KEYS, frame_id, key_events))
+    except Exception:
+        out_queue.put((ERROR, 'presses', traceback.format_exc()))
+    finally:
+        ring.close()